@@ -0,0 +1,360 @@
+"""Sherlock Pro: Resident Service
+
+Keeps site definitions, resolved addresses, connection pools and
+calibrated pages warm, and runs investigations submitted over a local
+HTTP/JSON API, many of them at the same time:
+
+    POST   /jobs               Start job, body as in arkusz.json, optionally
+                               with "max_candidates", "priority", "weight"
+                               and "max_concurrency".
+    GET    /jobs               List of all jobs.
+    GET    /jobs/<id>          State of one job and the accounts found.
+    GET    /jobs/<id>/events   Events of the job as JSON lines, streamed
+                               as they happen until the job ends.
+    DELETE /jobs/<id>          Cancel job.
+    GET    /health             State of the service.
+
+Events are {"event": "found", "username", "site", "url", "response_time_ms"}
+for every account found, {"event": "checked", "username", "found"} after
+every candidate and {"event": "end", "status"} at the end.
+
+Running jobs share the worker pool fairly (see looker.scheduler): jobs
+with a higher "priority" go first, jobs of the same priority get workers
+in proportion to their "weight", and "max_concurrency" caps the probes of
+one job running at the same time.
+"""
+import itertools
+import json
+import threading
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from looker.fingerprint import calibrate
+from looker.index import ResultIndex, site_hashes
+from looker.pool import RunStats, get_pool, get_session
+from looker.probe import prepare_sites
+from looker.resolver import get_resolver, site_hosts
+from looker.sherlock import sherlock
+from looker.site_list import rank_order
+from looker.warmup import CONNECTIONS, get_warmer
+from priority import target_queue
+from ui_sherlock_pro import target_from_record, target_label
+
+HOST = "127.0.0.1"
+PORT = 8765
+
+# Jobs running at the same time; all of them share the worker pool.
+MAX_JOBS = 4
+
+# Candidates checked per job unless the job asks for another number.
+MAX_CANDIDATES = 200
+
+class Job:
+    """One investigation and the events it produced so far."""
+
+    def __init__(self, job_id, target, max_candidates=MAX_CANDIDATES, priority=0, weight=1.0,
+                 max_concurrency=None):
+        self.id = job_id
+        self.target = target
+        self.max_candidates = max_candidates
+        self.priority = priority
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.status = "queued"
+        self.checked = 0
+        self.found = []
+        self.events = []
+        self.condition = threading.Condition()
+        self.cancelled = threading.Event()
+
+    def emit(self, event):
+        with self.condition:
+            self.events.append(event)
+            if event["event"] == "found":
+                self.found.append(event)
+            elif event["event"] == "checked":
+                self.checked += 1
+            elif event["event"] == "end":
+                self.status = event["status"]
+            self.condition.notify_all()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "cancelled", "failed")
+
+    def stream(self):
+        """Yield all events of the job, waiting for new ones until it ends."""
+        position = 0
+        while True:
+            with self.condition:
+                while position == len(self.events) and not self.finished:
+                    self.condition.wait()
+                events = self.events[position:]
+                finished = self.finished
+            position += len(events)
+            yield from events
+            if finished and position == len(self.events):
+                return
+
+    def describe(self, found=False):
+        with self.condition:
+            description = {"id": self.id, "status": self.status, "checked": self.checked,
+                           "found": len(self.found), "max_candidates": self.max_candidates,
+                           "priority": self.priority, "weight": self.weight}
+            if found:
+                description["accounts"] = list(self.found)
+            return description
+
+
+class Service:
+    """Runs jobs against site data loaded once."""
+
+    def __init__(self, site_data, max_jobs=MAX_JOBS, fingerprints=None, http2=False, index=None,
+                 warm=CONNECTIONS):
+        """Create Service.
+
+        Keyword Arguments:
+        site_data              -- Dictionary containing all of the site data.
+        max_jobs               -- Number of jobs running at the same time,
+                                  the others wait.
+        fingerprints           -- Calibrated pages for soft-404 detection
+                                  (optional, see fingerprint.calibrate()).
+        http2                  -- Boolean indicating whether to use HTTP/2.
+        index                  -- ResultIndex all results are stored in
+                                  (optional).
+        warm                   -- Connections kept open per site host, 0
+                                  not to open any before jobs need them.
+        """
+        # Popular sites are probed first.
+        self.site_data = rank_order(site_data)
+        self.fingerprints = fingerprints
+        self.http2 = http2
+        self.index = index
+        self.warm = warm
+        self.run_id = index.start_run("daemon") if index is not None else None
+        self.hashes = site_hashes(site_data)
+        self.slots = threading.BoundedSemaphore(max_jobs)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.numbers = itertools.count(1)
+
+    def warm_up(self):
+        """Create the worker pool and session, resolve and connect to all site hosts."""
+        get_pool()
+        get_session()
+        prepared_sites = prepare_sites(self.site_data)
+        get_resolver().prefetch(site_hosts(prepared_sites))
+        if self.warm:
+            warmer = get_warmer(self.warm)
+            warmer.warm_up(prepared_sites)
+            warmer.start()
+
+    def submit(self, target, max_candidates=MAX_CANDIDATES, priority=0, weight=1.0, max_concurrency=None):
+        with self.lock:
+            job = Job(str(next(self.numbers)), target, max_candidates, priority, weight, max_concurrency)
+            self.jobs[job.id] = job
+        threading.Thread(target=self.run, args=(job,), name=f"sherlock-job-{job.id}", daemon=True).start()
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def run(self, job):
+        with self.slots:
+            if job.cancelled.is_set():
+                job.emit({"event": "end", "status": "cancelled"})
+                return
+            with job.condition:
+                job.status = "running"
+            try:
+                self.investigate(job)
+            except Exception as err:
+                job.emit({"event": "end", "status": "failed", "error": str(err)})
+                return
+        job.emit({"event": "end", "status": "cancelled" if job.cancelled.is_set() else "done"})
+
+    def investigate(self, job):
+        # Jobs stop after max_candidates, so combinations only fill the tail.
+        queue = target_queue(*job.target, combinations=True)
+        pool_job = get_pool().job(f"job-{job.id}", weight=job.weight, priority=job.priority,
+                                  max_running=job.max_concurrency)
+
+        for number, word in enumerate(queue):
+            if number >= job.max_candidates or job.cancelled.is_set():
+                break
+            found = []
+
+            def on_result(social_network, results_site):
+                if self.index is not None:
+                    self.index.add(self.run_id, word, social_network, results_site,
+                                   self.hashes[social_network])
+                if results_site["exists"] == "yes":
+                    found.append(social_network)
+                    job.emit({"event": "found", "username": word, "site": social_network,
+                              "url": results_site["url_user"],
+                              "response_time_ms": results_site["response_time_ms"]})
+
+            # sherlock() keeps the futures of a run in the site data, every
+            # run needs its own copy of it.
+            site_data = {social_network: dict(net_info) for social_network, net_info in self.site_data.items()}
+            sherlock(word, site_data, print_found_only=True, stats=RunStats(), http2=self.http2,
+                     fingerprints=self.fingerprints, on_result=on_result, job=pool_job)
+            if self.index is not None:
+                self.index.flush()
+                self.index.link_targets(word, [target_label(job.target)])
+            job.emit({"event": "checked", "username": word, "found": len(found)})
+            if found:
+                queue.report_hit(word, len(found))
+
+    def health(self):
+        jobs = self.list()
+        return {"sites": len(self.site_data),
+                "jobs": len(jobs),
+                "running": sum(job.status == "running" for job in jobs),
+                "scheduler": get_pool().scheduler.summary(),
+                "dns": get_resolver().summary(),
+                "warmup": get_warmer().summary() if self.warm else None}
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """HTTP/JSON API of the service."""
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def job(self):
+        parts = self.path.strip("/").split("/")
+        job = self.server.service.get(parts[1]) if len(parts) >= 2 and parts[0] == "jobs" else None
+        if job is None:
+            self.send_json(404, {"error": "no such job"})
+        return job, parts[2:]
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/health":
+            self.send_json(200, service.health())
+        elif self.path == "/jobs":
+            self.send_json(200, [job.describe() for job in service.list()])
+        else:
+            job, rest = self.job()
+            if job is None:
+                return
+            if rest == ["events"]:
+                self.send_events(job)
+            elif not rest:
+                self.send_json(200, job.describe(found=True))
+            else:
+                self.send_json(404, {"error": "not found"})
+
+    def send_events(self, job):
+        # No Content-Length, the end of the stream is the end of the job.
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        try:
+            for event in job.stream():
+                self.wfile.write(json.dumps(event).encode() + b"\n")
+                self.wfile.flush()
+        except OSError:
+            # Client went away, the job goes on.
+            pass
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            data = json.loads(self.rfile.read(length).decode("utf-8-sig"))
+            target = target_from_record(data)
+            max_candidates = int(data.get("max_candidates", MAX_CANDIDATES))
+            priority = int(data.get("priority", 0))
+            weight = float(data.get("weight", 1))
+            max_concurrency = data.get("max_concurrency")
+            max_concurrency = None if max_concurrency is None else int(max_concurrency)
+            if weight <= 0 or (max_concurrency is not None and max_concurrency < 1):
+                raise ValueError("weight and max_concurrency must be positive")
+        except (TypeError, ValueError) as err:
+            self.send_json(400, {"error": str(err)})
+            return
+        job = self.server.service.submit(target, max_candidates, priority, weight, max_concurrency)
+        self.send_json(201, job.describe())
+
+    def do_DELETE(self):
+        job, rest = self.job()
+        if job is None:
+            return
+        job.cancelled.set()
+        self.send_json(200, job.describe())
+
+
+def serve(service, host=HOST, port=PORT):
+    """Return started server of the API, serving in a background thread."""
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.daemon_threads = True
+    server.service = service
+    threading.Thread(target=server.serve_forever, name="sherlock-api", daemon=True).start()
+    return server
+
+
+def main():
+    parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
+                            description="Run investigations submitted over a local HTTP/JSON API.")
+    parser.add_argument("--host", default=HOST,
+                        help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=PORT,
+                        help="Port to listen on.")
+    parser.add_argument("--json", "-j", metavar="JSON_FILE",
+                        dest="json_file", default="data.json",
+                        help="Load site data from this JSON file.")
+    parser.add_argument("--jobs", type=int, default=MAX_JOBS,
+                        help="Number of jobs running at the same time.")
+    parser.add_argument("--dns-cache", metavar="DNS_CACHE_FILE",
+                        dest="dns_cache", default=None,
+                        help="Share resolved site addresses with other processes through this file.")
+    parser.add_argument("--index", metavar="INDEX_FILE",
+                        dest="index", default=None,
+                        help="Store all results in this SQLite index.")
+    parser.add_argument("--http2",
+                        action="store_true", dest="http2", default=False,
+                        help="Multiplex requests over HTTP/2 on sites which support it; requires httpx[http2].")
+    parser.add_argument("--soft404",
+                        action="store_true", dest="soft404", default=False,
+                        help="Detect sites showing a generic page for unknown users.")
+    parser.add_argument("--warm", metavar="CONNECTIONS", type=int, default=CONNECTIONS,
+                        help="Connections kept open per site host; 0 to connect only when jobs need it.")
+    args = parser.parse_args()
+
+    if args.dns_cache:
+        get_resolver(cache_path=args.dns_cache)
+    with open(args.json_file, "r", encoding="utf-8") as raw:
+        site_data = json.load(raw)
+
+    fingerprints = calibrate(site_data) if args.soft404 else None
+    index = ResultIndex(args.index) if args.index else None
+    service = Service(site_data, max_jobs=args.jobs, fingerprints=fingerprints, http2=args.http2, index=index,
+                      warm=args.warm)
+    service.warm_up()
+    server = serve(service, args.host, args.port)
+    print(f"Listening on http://{args.host}:{server.server_address[1]}/ with {len(site_data)} sites")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
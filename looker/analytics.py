@@ -0,0 +1,317 @@
+"""Sherlock: Run Analytics
+
+Aggregates over large sets of results, computed with NumPy instead of
+looping over the dictionaries returned by sherlock(). Results are loaded
+into columns (one array per field, usernames and sites as integer codes)
+and summarized with vectorized operations:
+
+    hit rates          checked, found and failed probes of every site
+    latencies          response time percentiles of every site
+    tokens             how often usernames made of a token were found,
+                       telling which parts of prepare()d usernames work
+    co-occurrence      how many usernames were found on both of two sites
+
+    python -m looker.analytics
+    python -m looker.analytics --run 3 --json output/analytics.json
+
+Results come from the index (see looker.index) or from sherlock() runs
+in memory (see Results.from_results()).
+"""
+import json
+import os
+import re
+import sqlite3
+import sys
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from urllib.request import pathname2url
+
+import numpy as np
+
+from looker.index import DEFAULT_PATH, STATUS_CODES
+
+# Rows fetched from the index at a time.
+FETCH_ROWS = 65536
+
+# Response time percentiles reported for every site.
+PERCENTILES = (50, 90, 99)
+
+# Elements of the usernames x sites matrix built at a time for the
+# co-occurrence counts.
+BLOCK_ELEMENTS = 1 << 22
+
+# Entries of the token and site pair rankings in the summary.
+TOP = 20
+
+# Parts of usernames without a vocabulary: runs of letters or of digits.
+TOKEN = re.compile(r"[^\W\d_]+|\d+")
+DIGITS = re.compile(r"\d+")
+
+YES = STATUS_CODES["yes"]
+ILLEGAL = STATUS_CODES["illegal"]
+ERROR = STATUS_CODES["error"]
+
+
+def tokenize(username, vocabulary=()):
+    """Return the distinct tokens username is made of.
+
+    Keyword Arguments:
+    username               -- Username to split.
+    vocabulary             -- Words known about the targets (names,
+                              nicknames...). If given, tokens are the words
+                              (longer than one character) contained in
+                              username and its numbers; otherwise its runs
+                              of letters and of digits.
+    """
+    lowered = username.lower()
+    if vocabulary:
+        tokens = [word for word in vocabulary if len(word) > 1 and word in lowered]
+        tokens += DIGITS.findall(lowered)
+    else:
+        tokens = TOKEN.findall(lowered)
+    return list(dict.fromkeys(tokens))
+
+
+def codes(values):
+    """Return (distinct values, integer code of every value)."""
+    distinct, inverse = np.unique(values, return_inverse=True)
+    return distinct, inverse.astype(np.int32).reshape(-1)
+
+
+class Results:
+    """Columns of a set of results, one row per probe."""
+
+    def __init__(self, user, site, status, elapsed, usernames, sites, vocabulary=()):
+        """Create Results.
+
+        Keyword Arguments:
+        user                   -- Code (index into usernames) of every row.
+        site                   -- Code (index into sites) of every row.
+        status                 -- STATUS_CODES value of every row.
+        elapsed                -- Response time in ms of every row, NaN if
+                                  not known.
+        usernames              -- Sequence of the usernames.
+        sites                  -- Sequence of the site names.
+        vocabulary             -- Words known about the targets, see
+                                  tokenize() (optional).
+        """
+        self.user = np.asarray(user, dtype=np.int32)
+        self.site = np.asarray(site, dtype=np.int32)
+        self.status = np.asarray(status, dtype=np.int8)
+        self.elapsed = np.asarray(elapsed, dtype=np.float32)
+        self.usernames = list(usernames)
+        self.sites = list(sites)
+        self.vocabulary = [word.lower() for word in vocabulary]
+
+    def __len__(self):
+        return len(self.status)
+
+    @classmethod
+    def from_results(cls, runs, vocabulary=()):
+        """Create from {username: results returned by sherlock()}."""
+        usernames = list(runs)
+        site_codes = {}
+        rows = []
+        for user_code, results in enumerate(runs.values()):
+            for social_network, results_site in results.items():
+                site_code = site_codes.setdefault(social_network, len(site_codes))
+                elapsed = results_site.get("response_time_ms")
+                rows.append((user_code, site_code,
+                             STATUS_CODES.get(results_site.get("exists"), ERROR),
+                             elapsed if isinstance(elapsed, (int, float)) else np.nan))
+        columns = np.array(rows, dtype=np.float64).reshape(-1, 4)
+        return cls(columns[:, 0], columns[:, 1], columns[:, 2], columns[:, 3],
+                   usernames, list(site_codes), vocabulary)
+
+    @classmethod
+    def load(cls, path=DEFAULT_PATH, run_id=None):
+        """Load the results of an index (of run_id, or of all runs).
+
+        The words of the target names stored in the index are the
+        vocabulary of the tokens. The index is opened read-only, a missing
+        one raises FileNotFoundError.
+        """
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"No index at {path}")
+        db = sqlite3.connect(f"file:{pathname2url(os.path.abspath(path))}?mode=ro", uri=True)
+        query = "SELECT username_id, site_id, status, IFNULL(response_time_ms, -1) FROM results"
+        arguments = ()
+        if run_id is not None:
+            query += " WHERE run_id = ?"
+            arguments = (run_id,)
+        chunks = []
+        try:
+            cursor = db.execute(query, arguments)
+            while True:
+                rows = cursor.fetchmany(FETCH_ROWS)
+                if not rows:
+                    break
+                chunks.append(np.array(rows, dtype=np.int64))
+            names = {table: dict(db.execute(f"SELECT id, name FROM {table}"))
+                     for table in ("usernames", "sites", "targets")}
+        finally:
+            db.close()
+
+        columns = np.concatenate(chunks) if chunks else np.empty((0, 4), dtype=np.int64)
+        user_ids, user = codes(columns[:, 0])
+        site_ids, site = codes(columns[:, 1])
+        elapsed = columns[:, 3].astype(np.float32)
+        elapsed[columns[:, 3] < 0] = np.nan
+        vocabulary = {word for target in names["targets"].values() for word in TOKEN.findall(target.lower())}
+        return cls(user, site, columns[:, 2], elapsed,
+                   [names["usernames"][row_id] for row_id in user_ids.tolist()],
+                   [names["sites"][row_id] for row_id in site_ids.tolist()], sorted(vocabulary))
+
+    def hit_rates(self):
+        """Return arrays (checked, hits, errors) per site code.
+
+        Errors and usernames illegal on a site are not counted as checked.
+        """
+        n_sites = len(self.sites)
+        errors = np.bincount(self.site[self.status == ERROR], minlength=n_sites)
+        hits = np.bincount(self.site[self.status == YES], minlength=n_sites)
+        illegal = np.bincount(self.site[self.status == ILLEGAL], minlength=n_sites)
+        checked = np.bincount(self.site, minlength=n_sites) - errors - illegal
+        return checked, hits, errors
+
+    def latencies(self, percentiles=PERCENTILES):
+        """Return array of response time percentiles (lower value) per site code.
+
+        Rows are sites, columns percentiles; NaN for sites without times.
+        """
+        known = ~np.isnan(self.elapsed)
+        site = self.site[known]
+        elapsed = self.elapsed[known]
+        # Sorted by site, then by time: every site is one sorted slice.
+        order = np.lexsort((elapsed, site))
+        site = site[order]
+        elapsed = elapsed[order]
+        sites = np.arange(len(self.sites))
+        start = np.searchsorted(site, sites, side="left")
+        count = np.searchsorted(site, sites, side="right") - start
+
+        result = np.full((len(self.sites), len(percentiles)), np.nan, dtype=np.float32)
+        has = count > 0
+        for column, percentile in enumerate(percentiles):
+            position = start[has] + (count[has] - 1) * percentile // 100
+            result[has, column] = elapsed[position]
+        return result
+
+    def found_pairs(self):
+        """Return arrays (user, site) of the distinct usernames found on sites."""
+        found = self.status == YES
+        pairs = np.unique(self.user[found].astype(np.int64) * len(self.sites) + self.site[found])
+        return (pairs // len(self.sites)).astype(np.int32), (pairs % len(self.sites)).astype(np.int32)
+
+    def tokens(self):
+        """Return (token names, checked, hits) of the tokens of the usernames.
+
+        A probe counts for every token of its username. Only the distinct
+        usernames are tokenized, the counting runs over the columns.
+        """
+        n_users = len(self.usernames)
+        checked = (self.status != ERROR) & (self.status != ILLEGAL)
+        checked_per_user = np.bincount(self.user[checked], minlength=n_users)
+        hits_per_user = np.bincount(self.user[self.status == YES], minlength=n_users)
+
+        names = {}
+        users = []
+        token_codes = []
+        for user_code, username in enumerate(self.usernames):
+            for token in tokenize(username, self.vocabulary):
+                users.append(user_code)
+                token_codes.append(names.setdefault(token, len(names)))
+        users = np.array(users, dtype=np.int64)
+        token_codes = np.array(token_codes, dtype=np.int64)
+        checked = np.bincount(token_codes, weights=checked_per_user[users], minlength=len(names))
+        hits = np.bincount(token_codes, weights=hits_per_user[users], minlength=len(names))
+        return list(names), checked.astype(np.int64), hits.astype(np.int64)
+
+    def co_occurrence(self):
+        """Return sites x sites array of usernames found on both sites.
+
+        The diagonal holds the usernames found on every site.
+        """
+        user, site = self.found_pairs()
+        n_sites = len(self.sites)
+        result = np.zeros((n_sites, n_sites), dtype=np.int64)
+        if not len(user):
+            return result
+        # Usernames found on each site, as 0/1 rows, a block at a time.
+        block = max(BLOCK_ELEMENTS // max(n_sites, 1), 1)
+        bounds = np.searchsorted(user, np.arange(0, user[-1] + block + 1, block))
+        for first, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+            if start == stop:
+                continue
+            matrix = np.zeros((block, n_sites), dtype=np.float32)
+            matrix[user[start:stop] - first * block, site[start:stop]] = 1
+            result += (matrix.T @ matrix).astype(np.int64)
+        return result
+
+    def summary(self, top=TOP):
+        """Return all aggregates as a dictionary ready for JSON."""
+        checked, hits, errors = self.hit_rates()
+        latencies = self.latencies()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rates = np.where(checked > 0, hits / np.maximum(checked, 1), 0.0)
+
+        sites = []
+        for code, social_network in enumerate(self.sites):
+            entry = {"site": social_network, "checked": int(checked[code]), "hits": int(hits[code]),
+                     "errors": int(errors[code]), "hit_rate": round(float(rates[code]), 4)}
+            for column, percentile in enumerate(PERCENTILES):
+                value = latencies[code, column]
+                entry[f"p{percentile}_ms"] = None if np.isnan(value) else int(value)
+            sites.append(entry)
+        sites.sort(key=lambda entry: (-entry["hit_rate"], entry["site"]))
+
+        token_names, token_checked, token_hits = self.tokens()
+        order = np.lexsort((-token_checked, -token_hits))[:top]
+        tokens = [{"token": token_names[code], "checked": int(token_checked[code]), "hits": int(token_hits[code]),
+                   "hit_rate": round(float(token_hits[code] / token_checked[code]), 4) if token_checked[code] else 0.0}
+                  for code in order.tolist()]
+
+        counts = self.co_occurrence()
+        first, second = np.triu_indices(len(self.sites), k=1)
+        both = counts[first, second]
+        either = counts[first, first] + counts[second, second] - both
+        order = np.argsort(-both, kind="stable")[:top]
+        pairs = [{"sites": [self.sites[first[i]], self.sites[second[i]]], "both": int(both[i]),
+                  "jaccard": round(float(both[i] / either[i]), 4)}
+                 for i in order.tolist() if both[i]]
+
+        return {"totals": {"rows": len(self), "usernames": len(self.usernames), "sites": len(self.sites),
+                           "hits": int(hits.sum()), "errors": int(errors.sum())},
+                "sites": sites, "tokens": tokens, "co_occurrence": pairs}
+
+
+def main(argv=None):
+    parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
+                            description="Summarize the results stored in the index.")
+    parser.add_argument("--index", "-i", metavar="INDEX_FILE",
+                        dest="index", default=DEFAULT_PATH,
+                        help="SQLite index to read.")
+    parser.add_argument("--run", type=int, default=None,
+                        help="Only look at this run.")
+    parser.add_argument("--json", "-j", metavar="JSON_FILE",
+                        dest="json_file", default=None,
+                        help="Write the summary into this file instead of printing it.")
+    parser.add_argument("--top", type=int, default=TOP,
+                        help="Tokens and site pairs listed.")
+    args = parser.parse_args(argv)
+
+    try:
+        results = Results.load(args.index, args.run)
+    except FileNotFoundError as err:
+        parser.error(str(err))
+    summary = results.summary(args.top)
+    text = json.dumps(summary, indent=1)
+    if args.json_file:
+        with open(args.json_file, "w", encoding="utf-8") as out:
+            out.write(text)
+        print(f"{summary['totals']['rows']} results summarized into {args.json_file}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""Sherlock: Response Archive
+
+Live runs can record every probe into an append-only archive: status,
+a few headers, requested and final URL, response time, the verdict of
+the run and a zlib compressed prefix of the body. Replaying an archive feeds the
+records through the same classification code as live runs, with the
+current site data, so changed errorMsg values or detection logic can be
+checked against past sweeps without any network traffic.
+
+    python -m looker.archive replay sweep.archive --json data.json
+
+File format: the 8 byte MAGIC, then records of RECORD (meta length,
+body length, HTTP status or 0 for failed requests, response time in ms,
+time of the probe), the meta data as JSON and the compressed body. A
+record cut short by a crash is cut off when the archive is opened for
+writing again.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from time import perf_counter, time
+
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+MAGIC = b"SHLKARC1"
+RECORD = struct.Struct("<IIHId")
+
+# Bytes of the body kept per probe.
+BODY_PREFIX = 65536
+
+# Headers kept per probe.
+KEPT_HEADERS = ("Content-Type", "Content-Length", "Content-Encoding", "Location",
+                "ETag", "Last-Modified", "Server")
+
+_archives = {}
+_lock = threading.Lock()
+
+
+def complete_length(data):
+    """Return length of the complete records of archive data (MAGIC included)."""
+    offset = len(MAGIC)
+    end = len(data)
+    while offset + RECORD.size <= end:
+        meta_length, body_length = RECORD.unpack_from(data, offset)[:2]
+        following = offset + RECORD.size + meta_length + body_length
+        if following > end:
+            break
+        offset = following
+    return offset
+
+
+class ArchiveWriter:
+    """Appends probes to an archive file, shared by threads."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "ab")
+        size = self.file.tell()
+        if size < len(MAGIC):
+            # New file, or a crash before the first record.
+            self.file.truncate(0)
+            self.file.write(MAGIC)
+        else:
+            with open(path, "rb") as raw, mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[:len(MAGIC)] != MAGIC:
+                    self.file.close()
+                    raise ValueError(f"{path} is not a Sherlock archive")
+                length = complete_length(data)
+            if length < size:
+                # Record torn by a crash, later records go where it started.
+                self.file.truncate(length)
+                self.file.seek(length)
+        self.records = 0
+
+    def record(self, social_network, username, r, method=None, exists=None, request_url=None):
+        """Append one probe.
+
+        Keyword Arguments:
+        social_network         -- Name of the site.
+        username               -- Username probed.
+        r                      -- requests.Response, or None if the request
+                                  failed.
+        method                 -- HTTP method of the probe (optional).
+        exists                 -- Verdict of the live run (optional).
+        request_url            -- URL the probe requested, before redirects
+                                  (optional, taken from r if not given).
+        """
+        if request_url is None and r is not None:
+            first = r.history[0] if r.history else r
+            request_url = getattr(first.request, "url", None)
+        meta = {"site": social_network, "username": username, "exists": exists, "method": method,
+                "request_url": request_url}
+        status = elapsed = 0
+        body = b""
+        if r is not None:
+            status = r.status_code
+            elapsed = r.elapsed if isinstance(r.elapsed, int) else 0
+            meta["url"] = r.url
+            meta["headers"] = {name: r.headers[name] for name in KEPT_HEADERS if name in r.headers}
+            if r.content:
+                body = zlib.compress(r.content[:BODY_PREFIX])
+            # Live runs stop reading at the prefix, a body this long may
+            # have gone on.
+            meta["truncated"] = len(r.content) >= BODY_PREFIX
+        meta = json.dumps(meta, separators=(",", ":")).encode()
+        data = RECORD.pack(len(meta), len(body), status, elapsed, time()) + meta + body
+        with self.lock:
+            self.file.write(data)
+            self.records += 1
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class ArchivedProbe:
+    """One record of an archive, body decompressed on first use."""
+
+    __slots__ = ("status", "elapsed", "checked", "meta", "compressed")
+
+    def __init__(self, status, elapsed, checked, meta, compressed):
+        self.status = status
+        self.elapsed = elapsed
+        self.checked = checked
+        self.meta = meta
+        self.compressed = compressed
+
+    @property
+    def site(self):
+        return self.meta["site"]
+
+    @property
+    def username(self):
+        return self.meta["username"]
+
+    @property
+    def request_url(self):
+        """URL the probe requested; the final URL for archives recorded without it."""
+        return self.meta.get("request_url") or self.meta.get("url")
+
+    @property
+    def failed(self):
+        return self.status == 0
+
+    def body(self):
+        return zlib.decompress(self.compressed) if self.compressed else b""
+
+    def response(self):
+        """Return requests.Response as the live run saw it, or None if it failed."""
+        if self.failed:
+            return None
+        r = Response()
+        r.status_code = self.status
+        r.headers = CaseInsensitiveDict(self.meta.get("headers", {}))
+        r.url = self.meta.get("url")
+        r.encoding = get_encoding_from_headers(r.headers)
+        r._content = self.body()
+        r._content_consumed = True
+        r.elapsed = self.elapsed
+        return r
+
+
+def read_archive(path):
+    """Yield the ArchivedProbe records of an archive.
+
+    The file is memory-mapped; a record cut short by a crash ends it.
+    """
+    with open(path, "rb") as raw:
+        if os.fstat(raw.fileno()).st_size <= len(MAGIC):
+            return
+        with mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} is not a Sherlock archive")
+            offset = len(MAGIC)
+            end = len(data)
+            while offset + RECORD.size <= end:
+                meta_length, body_length, status, elapsed, checked = RECORD.unpack_from(data, offset)
+                start = offset + RECORD.size
+                offset = start + meta_length + body_length
+                if offset > end:
+                    return
+                meta = json.loads(data[start:start + meta_length])
+                yield ArchivedProbe(status, elapsed, checked, meta, data[start + meta_length:offset])
+
+
+def replay(path, site_data, fingerprints=None):
+    """Classify the records of an archive with the current site data.
+
+    Keyword Arguments:
+    path                   -- Path of the archive.
+    site_data              -- Dictionary containing all of the site data.
+    fingerprints           -- Fingerprints for soft-404 detection
+                              (optional, see fingerprint.calibrate()).
+
+    Return Value:
+    Generator of (ArchivedProbe, verdict) for records of sites which are in
+    site_data.  Pages of "message" sites probed with HEAD (the site used
+    another detection method when recorded) give "error", and so do
+    truncated pages without a marker in the kept prefix: the marker may
+    have been after it.
+    """
+    from looker.fingerprint import Fingerprint
+    from looker.markers import site_markers
+    from looker.sherlock import detect
+
+    for probe in read_archive(path):
+        net_info = site_data.get(probe.site)
+        if net_info is None:
+            continue
+        error_type = net_info["errorType"]
+        r = probe.response()
+        if r is None or (error_type == "message" and probe.meta.get("method") == "HEAD"):
+            yield probe, "error"
+            continue
+        if (error_type == "message" and probe.meta.get("truncated")
+                and site_markers(net_info, r.encoding).search(r.content) is None):
+            yield probe, "error"
+            continue
+        exists = detect(error_type, net_info, r)
+        if exists == "yes" and fingerprints and probe.site in fingerprints:
+            if fingerprints[probe.site].matches(Fingerprint.from_response(r, probe.username)):
+                exists = "no"
+        yield probe, exists
+
+
+def get_archive(path):
+    """Return the process-wide ArchiveWriter of path."""
+    with _lock:
+        archive = _archives.get(path)
+        if archive is None:
+            archive = _archives[path] = ArchiveWriter(path)
+        return archive
+
+
+def main():
+    parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
+                            description="Re-classify archived probes without network.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    replay_parser = commands.add_parser("replay", help="Classify the probes of an archive again.")
+    replay_parser.add_argument("archive")
+    replay_parser.add_argument("--json", "-j", metavar="JSON_FILE", dest="json_file", default="data.json",
+                               help="Load site data from this JSON file.")
+    replay_parser.add_argument("--all", action="store_true", dest="all", default=False,
+                               help="Print every probe, not only the ones whose verdict changed.")
+    args = parser.parse_args()
+
+    with open(args.json_file, "r", encoding="utf-8") as raw:
+        site_data = json.load(raw)
+
+    start = perf_counter()
+    totals = {"probes": 0, "changed": 0}
+    for probe, exists in replay(args.archive, site_data):
+        totals["probes"] += 1
+        changed = probe.meta.get("exists") is not None and probe.meta["exists"] != exists
+        totals["changed"] += changed
+        if changed or args.all:
+            print(json.dumps({"site": probe.site, "username": probe.username,
+                              "recorded": probe.meta.get("exists"), "replayed": exists}))
+    elapsed = perf_counter() - start
+    totals["probes_per_sec"] = round(totals["probes"] / elapsed) if elapsed else None
+    print(json.dumps(totals), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
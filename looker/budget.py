@@ -0,0 +1,209 @@
+"""Sherlock: Request and Bandwidth Budget
+
+Caps what a run may spend: bytes transferred, requests per run and
+requests per site. A probe reserves its expected size when it starts
+(the size the site had earlier in the process with some margin,
+otherwise an estimate for its method) and is settled with the bytes it
+really transferred once answered, so only running probes hold
+reservations. Probes which do not fit are skipped; the run ends with the
+results it has, skipped sites have "exists" set to "skipped".
+
+The page of a "message" site is never classified when cut short: a
+marker after the cut would be missed and the username reported as found.
+It may take what is left of the budget; a page reaching that is
+abandoned and its site skipped. Pages of sites decided by the status
+code are only downloaded up to PREFIX_BYTES once less than
+SHRINK_FRACTION of the byte budget is left.
+"""
+import threading
+
+from looker.probe import CHUNK_BYTES
+
+# Below this share of the byte budget pages of sites decided by the status
+# code are cut short.
+SHRINK_FRACTION = 0.5
+
+# Bytes of such a page downloaded once the budget shrank.
+PREFIX_BYTES = 32768
+
+# Expected bytes of a probe of a site not answered before: headers of
+# both directions, and the page for GET.
+HEAD_ESTIMATE = 1024
+GET_ESTIMATE = 262144
+
+# Pages of a site vary in size, reservations leave this much room.
+SIZE_MARGIN = 1.25
+
+# (bytes transferred, body bytes after decompression) of the last whole
+# answer of every site, shared by the runs of the process.
+_sizes = {}
+
+
+class OverBudget(Exception):
+    """Probe skipped because it does not fit into the budget."""
+
+
+class Budget:
+    """Caps and usage of one run; shared by the threads of the run."""
+
+    def __init__(self, max_bytes=None, max_requests=None, max_site_requests=None):
+        """Create Budget.
+
+        Keyword Arguments:
+        max_bytes              -- Bytes transferred at most (optional).
+        max_requests           -- Requests sent at most (optional).
+        max_site_requests      -- Requests sent to one site at most, hedged
+                                  duplicates included (optional).
+        """
+        self.max_bytes = max_bytes
+        self.max_requests = max_requests
+        self.max_site_requests = max_site_requests
+        self.lock = threading.Lock()
+        self.used_bytes = 0
+        self.reserved_bytes = 0
+        self.requests = 0
+        self.site_requests = {}
+        self.skipped = {"bytes": 0, "requests": 0, "site_requests": 0}
+        self.strategies = {"full": 0, "prefix": 0, "head": 0}
+
+    def estimate(self, site, method, body_limit):
+        # Called with the lock held. Reservations are in bytes on the
+        # wire, body_limit counts decompressed bytes.
+        size = _sizes.get(site)
+        if size is None:
+            estimate = HEAD_ESTIMATE if method == "HEAD" else GET_ESTIMATE
+            if body_limit is not None:
+                estimate = min(estimate, body_limit + HEAD_ESTIMATE)
+            return estimate
+        transferred, decompressed = size
+        if body_limit is not None and decompressed > body_limit:
+            transferred = HEAD_ESTIMATE + (transferred - HEAD_ESTIMATE) * body_limit / decompressed
+        return max(round(transferred * SIZE_MARGIN), HEAD_ESTIMATE)
+
+    def plan(self, site, method, error_type, body_limit=None):
+        """Reserve a probe of site.
+
+        Keyword Arguments:
+        site                   -- Name of the site.
+        method                 -- HTTP method the probe would use.
+        error_type             -- errorType of the site.
+        body_limit             -- Bytes of the page the probe would download
+                                  at most, None for all of them.
+
+        Return Value:
+        Tuple of (body_limit to use, bytes reserved), or None if the probe
+        does not fit into the budget. For message sites body_limit is what
+        is left of the budget, see send().
+        """
+        with self.lock:
+            if self.max_requests is not None and self.requests >= self.max_requests:
+                self.skipped["requests"] += 1
+                return None
+            if self.max_site_requests is not None and self.site_requests.get(site, 0) >= self.max_site_requests:
+                self.skipped["site_requests"] += 1
+                return None
+
+            strategy = "head" if method == "HEAD" and body_limit is None else "full"
+            reserved = 0
+            if self.max_bytes is not None:
+                remaining = self.max_bytes - self.used_bytes - self.reserved_bytes
+                if (strategy == "full" and error_type != "message"
+                        and remaining < self.max_bytes * SHRINK_FRACTION):
+                    # The status code decides, the page is not needed.
+                    body_limit = min(body_limit or PREFIX_BYTES, PREFIX_BYTES)
+                    strategy = "prefix"
+                reserved = self.estimate(site, method, body_limit)
+                if reserved > remaining:
+                    self.skipped["bytes"] += 1
+                    return None
+                if error_type == "message" and method != "HEAD":
+                    # Not a cut, a page reaching this cannot be afforded. It
+                    # counts decompressed bytes, which are never fewer than
+                    # the bytes on the wire; reading stops a chunk late.
+                    body_limit = max(remaining - HEAD_ESTIMATE - CHUNK_BYTES, 0)
+
+            self.requests += 1
+            self.site_requests[site] = self.site_requests.get(site, 0) + 1
+            self.reserved_bytes += reserved
+            self.strategies[strategy] += 1
+            return body_limit, reserved
+
+    def settle(self, site, reserved, transferred, decompressed=None):
+        """Replace the reservation of a probe by the bytes it transferred.
+
+        decompressed (bytes of the body after decompression) is given for
+        whole answers only, their sizes are the estimates of later probes.
+        """
+        with self.lock:
+            self.reserved_bytes -= reserved
+            self.used_bytes += transferred
+            if decompressed is not None:
+                _sizes[site] = (transferred, decompressed)
+
+    def send(self, site, method, error_type, send, *args, body_limit=None, **kwargs):
+        """Reserve, send and settle one probe; meant to run in a worker.
+
+        Keyword Arguments:
+        site                   -- Name of the site.
+        method                 -- HTTP method of the probe.
+        error_type             -- errorType of the site.
+        send                   -- Function sending the probe, called with
+                                  *args, body_limit and **kwargs (e.g.
+                                  probe.send_probe).
+        body_limit             -- Bytes of the page to download at most,
+                                  None for all of them.
+
+        Return Value:
+        Response returned by send.  Raises OverBudget if the probe does not
+        fit into the budget, or if it is a message site whose page took what
+        was left of the budget.
+        """
+        planned = self.plan(site, method, error_type, body_limit)
+        if planned is None:
+            raise OverBudget(site)
+        body_limit, reserved = planned
+        r = None
+        try:
+            r = send(*args, body_limit=body_limit, **kwargs)
+        finally:
+            decompressed = getattr(r, "decompressed_bytes", None)
+            cut = decompressed is not None and body_limit is not None and decompressed >= body_limit
+            self.settle(site, reserved, transferred_bytes(r), None if cut else decompressed)
+        if cut and error_type == "message":
+            with self.lock:
+                self.skipped["bytes"] += 1
+            raise OverBudget(site)
+        return r
+
+    @property
+    def exhausted(self):
+        with self.lock:
+            return sum(self.skipped.values()) > 0
+
+    def report(self):
+        """Return caps, usage and what was given up to stay within them."""
+        with self.lock:
+            return {"max_bytes": self.max_bytes, "used_bytes": self.used_bytes,
+                    "max_requests": self.max_requests, "requests": self.requests,
+                    "max_site_requests": self.max_site_requests,
+                    "busiest_site_requests": max(self.site_requests.values(), default=0),
+                    "skipped": sum(self.skipped.values()),
+                    **{f"skipped_{reason}": count for reason, count in self.skipped.items()},
+                    **{f"strategy_{strategy}": count for strategy, count in self.strategies.items()}}
+
+
+def transferred_bytes(r):
+    """Return bytes a response took on the wire, headers estimated."""
+    if r is None:
+        return HEAD_ESTIMATE
+    return getattr(r, "compressed_bytes", 0) + HEAD_ESTIMATE
+
+
+def parse_size(text):
+    """Return bytes of a size like "500K", "20M" or "1.5G"."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper().rstrip("B")
+    factor = units.get(text[-1:], 1)
+    if factor != 1:
+        text = text[:-1]
+    return int(float(text) * factor)
@@ -0,0 +1,136 @@
+"""Sherlock: Soft-404 Fingerprints
+
+Many sites answer 200 with a generic page for users which do not exist,
+or change the wording of their error messages. This module fetches the
+page of every site's username_unclaimed once per process, keeps a
+compact fingerprint of it (length bucket, title and simhash of the
+beginning of the body) and tells whether a probe got the same page.
+"""
+import re
+import threading
+from hashlib import blake2b
+from time import time
+
+import requests
+
+from looker.latency import probe_settings
+from looker.pool import get_pool, get_session
+from looker.probe import HEADERS, PreparedUsername, prepare_headers, prepare_sites, send_probe
+
+# Bytes of the body used for fingerprints, the rest is not downloaded.
+PREFIX_BYTES = 16384
+
+# Fingerprints differing in at most this many of the 64 simhash bits are
+# considered the same page.
+MAX_DISTANCE = 6
+
+# Seconds after which the unclaimed pages are fetched again.
+CALIBRATION_TTL = 3600
+
+TITLE = re.compile(r"<title[^>]*>(.*?)</title>", re.IGNORECASE | re.DOTALL)
+TOKEN = re.compile(r"\w+")
+
+_calibrations = {}
+_lock = threading.Lock()
+
+
+def simhash(text):
+    """Return 64 bit simhash of the word 3-grams of text."""
+    tokens = TOKEN.findall(text)
+    shingles = {" ".join(tokens[i:i + 3]) for i in range(max(len(tokens) - 2, 1))}
+    weights = [0] * 64
+    for shingle in shingles:
+        value = int.from_bytes(blake2b(shingle.encode(), digest_size=8).digest(), "big")
+        for bit in range(64):
+            if value >> bit & 1:
+                weights[bit] += 1
+            else:
+                weights[bit] -= 1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+class Fingerprint:
+    """Compact description of a page."""
+
+    __slots__ = ("length_bucket", "title", "simhash")
+
+    def __init__(self, length_bucket, title, simhash):
+        self.length_bucket = length_bucket
+        self.title = title
+        self.simhash = simhash
+
+    @classmethod
+    def from_response(cls, r, username):
+        """Fingerprint response to the request for username.
+
+        The username is removed from the page, so pages of different
+        usernames can be compared.
+        """
+        body = r.content or b""
+        length = len(body)
+        if length >= PREFIX_BYTES:
+            # Only the prefix may have been downloaded.
+            content_length = r.headers.get("Content-Length", "")
+            length = int(content_length) if content_length.isdigit() else PREFIX_BYTES
+        text = body[:PREFIX_BYTES].decode(r.encoding or "utf-8", errors="replace").lower()
+        text = text.replace(username.lower(), "")
+        match = TITLE.search(text)
+        title = " ".join(match.group(1).split()) if match else ""
+        return cls(length.bit_length(), title, simhash(text))
+
+    def matches(self, other):
+        """Return True if other is most likely the same page."""
+        return (self.title == other.title and
+                abs(self.length_bucket - other.length_bucket) <= 1 and
+                bin(self.simhash ^ other.simhash).count("1") <= MAX_DISTANCE)
+
+
+def calibrate(site_data):
+    """Fingerprint the pages of the unclaimed usernames of all sites.
+
+    Pages are fetched concurrently, once per process (until
+    CALIBRATION_TTL runs out).
+
+    Keyword Arguments:
+    site_data              -- Dictionary containing all of the site data.
+
+    Return Value:
+    Dictionary of Fingerprint objects keyed by site, only for sites whose
+    page could be fetched.
+    """
+    now = time()
+    pool = get_pool()
+    session = get_session()
+    headers = prepare_headers(session, HEADERS)
+    prepared_sites = prepare_sites(site_data)
+
+    fingerprints = {}
+    futures = {}
+    for social_network, net_info in site_data.items():
+        username = net_info.get("username_unclaimed")
+        if username is None:
+            continue
+        key = (social_network, net_info["url"], username)
+        with _lock:
+            cached = _calibrations.get(key)
+        if cached is not None and cached[0] > now:
+            if cached[1] is not None:
+                fingerprints[social_network] = cached[1]
+            continue
+        site = prepared_sites[social_network]
+        futures[key] = pool.submit(send_probe, session, site, PreparedUsername(username),
+                                   headers, probe_settings(site, session), body_limit=PREFIX_BYTES,
+                                   host=site.host)
+
+    for key, future in futures.items():
+        social_network, _, username = key
+        try:
+            fingerprint = Fingerprint.from_response(future.result(), username)
+        except requests.exceptions.RequestException:
+            # Site is down, it is not calibrated in this run.
+            fingerprint = None
+        with _lock:
+            _calibrations[key] = (now + CALIBRATION_TTL, fingerprint)
+        if fingerprint is not None:
+            fingerprints[social_network] = fingerprint
+    return fingerprints
@@ -0,0 +1,205 @@
+"""Sherlock: HTTP/2 Transport
+
+This module contains an optional transport which multiplexes all probes
+to one host over a single HTTP/2 connection. It needs httpx with HTTP/2
+support (pip install httpx[http2]). Hosts which do not negotiate HTTP/2,
+requests through a proxy and protocol errors fall back to HTTP/1.1 with
+requests.
+
+Bodies are streamed like the ones of requests, so probes reading only
+the beginning of a page (see probe.read_body()) reset the stream instead
+of downloading the rest.
+"""
+import threading
+
+from requests.exceptions import ConnectionError, ConnectTimeout, ReadTimeout
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+try:
+    import h2  # noqa: F401 (httpx only needs it for HTTP/2)
+    import httpx
+except ImportError:
+    httpx = None
+
+# Number of probes sent at the same time over the connection to one host.
+MAX_STREAMS = 32
+
+_transport = None
+_lock = threading.Lock()
+
+
+class StreamedBody:
+    """Body of a streamed httpx response, read by requests like urllib3's.
+
+    read() returns decompressed bytes, tell() the bytes received so far.
+    The stream (and its slot of the host) is given back once the body was
+    read to the end or the response is closed.
+    """
+
+    def __init__(self, h2_response, streams):
+        self.response = h2_response
+        self.chunks = h2_response.iter_bytes()
+        self.streams = streams
+        self.buffer = b""
+        self.closed = False
+
+    def read(self, amt=None):
+        try:
+            while amt is None or len(self.buffer) < amt:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                self.buffer += chunk
+        except httpx.TimeoutException as err:
+            self.release_conn()
+            raise ReadTimeout(err)
+        except httpx.HTTPError as err:
+            self.release_conn()
+            raise ConnectionError(err)
+        if amt is None:
+            data, self.buffer = self.buffer, b""
+        else:
+            data, self.buffer = self.buffer[:amt], self.buffer[amt:]
+        if not data:
+            self.release_conn()
+        return data
+
+    def tell(self):
+        return self.response.num_bytes_downloaded
+
+    def release_conn(self):
+        if self.closed:
+            return
+        self.closed = True
+        # Resets the stream if the body was not read to the end.
+        self.response.close()
+        self.streams.release()
+
+    close = release_conn
+
+
+def probe_timeout(timeout):
+    """Return httpx.Timeout of the timeout setting of requests (seconds or (connect, read))."""
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return httpx.Timeout(read, connect=connect)
+    return httpx.Timeout(timeout)
+
+
+def to_response(h2_response, request, streams):
+    """Convert streamed httpx response to requests.Response for the detection code."""
+    r = Response()
+    r.status_code = h2_response.status_code
+    r.reason = h2_response.reason_phrase
+    r.headers = CaseInsensitiveDict(h2_response.headers.items())
+    r.url = str(h2_response.url)
+    # Same encoding requests would pick, so r.text stays the same.
+    r.encoding = get_encoding_from_headers(r.headers)
+    r.raw = StreamedBody(h2_response, streams)
+    r.request = request
+    return r
+
+
+class H2Transport:
+    """Sends probes over HTTP/2 to hosts which support it."""
+
+    def __init__(self, max_streams=MAX_STREAMS):
+        """Create HTTP/2 Transport.
+
+        Keyword Arguments:
+        max_streams            -- Number of concurrent streams per host.
+        """
+        self.max_streams = max_streams
+        self.client = httpx.Client(http2=True, timeout=None,
+                                   limits=httpx.Limits(max_connections=None,
+                                                       max_keepalive_connections=None))
+        self.lock = threading.Lock()
+        # host -> True (HTTP/2), False (HTTP/1.1 only), missing if unknown
+        self.support = {}
+        self.streams = {}
+        self.stats = {"http2": 0, "fallback": 0, "timeout": 0, "hosts_http2": 0, "hosts_http1": 0}
+
+    def host_streams(self, host):
+        with self.lock:
+            streams = self.streams.get(host)
+            if streams is None:
+                streams = self.streams[host] = threading.BoundedSemaphore(self.max_streams)
+            return streams
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def mark(self, host, supported):
+        with self.lock:
+            if host not in self.support:
+                self.stats["hosts_http2" if supported else "hosts_http1"] += 1
+            self.support[host] = supported
+
+    def send(self, host, request, settings):
+        """Send request over HTTP/2 if possible.
+
+        Keyword Arguments:
+        host                   -- Host name of the site.
+        request                -- requests.PreparedRequest to send.
+        settings               -- Keyword arguments meant for session.send(),
+                                  its timeout is the deadline of the probe.
+
+        Return Value:
+        requests.Response, or None if the request has to go over HTTP/1.1.
+        """
+        if (host is None or not request.url.startswith("https://")
+                or settings.get("proxies") or self.support.get(host) is False):
+            self.count("fallback")
+            return None
+
+        # The stream is held until its body was read, see StreamedBody.
+        streams = self.host_streams(host)
+        streams.acquire()
+        try:
+            h2_request = self.client.build_request(request.method, request.url, headers=dict(request.headers),
+                                                   timeout=probe_timeout(settings.get("timeout")))
+            h2_response = self.client.send(h2_request, stream=True,
+                                           follow_redirects=settings.get("allow_redirects", True))
+        except httpx.TimeoutException as err:
+            # The deadline of the site is spent, HTTP/1.1 would not do better.
+            streams.release()
+            self.count("timeout")
+            raise (ConnectTimeout if isinstance(err, httpx.ConnectTimeout) else ReadTimeout)(err)
+        except (httpx.RemoteProtocolError, httpx.LocalProtocolError, httpx.UnsupportedProtocol):
+            # Broken HTTP/2 support, use HTTP/1.1 from now on.
+            streams.release()
+            self.mark(host, False)
+            self.count("fallback")
+            return None
+        except httpx.HTTPError:
+            # Same error is reported by requests, which knows how to
+            # describe it for the output.
+            streams.release()
+            self.count("fallback")
+            return None
+
+        supported = h2_response.http_version == "HTTP/2"
+        self.mark(host, supported)
+        self.count("http2" if supported else "fallback")
+        return to_response(h2_response, request, streams)
+
+    def summary(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def close(self):
+        self.client.close()
+
+
+def get_http2_transport():
+    """Return the process-wide H2Transport, or None without httpx."""
+    global _transport
+    if httpx is None:
+        return None
+    with _lock:
+        if _transport is None:
+            _transport = H2Transport()
+        return _transport
@@ -0,0 +1,367 @@
+"""Sherlock: Result Index
+
+Stores the results of all runs in one SQLite file, indexed by site,
+username and run, so questions like "which usernames exist on both
+GitHub and Reddit" or "everything found for target X" are answered from
+the index instead of parsing the output files. Results are added while
+a run goes on and written in batches.
+
+    python -m looker.index found-on GitHub Reddit
+    python -m looker.index user mateusz
+    python -m looker.index target "Mateusz Kojro"
+    python -m looker.index import-output output
+
+Every result also stores a hash of the site definition it was probed
+with, so re-runs can skip (username, site) pairs whose site did not
+change since (see fresh_results()).
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from time import time
+
+DEFAULT_PATH = os.path.join("output", "results.sqlite")
+
+# Rows kept in memory before they are written in one transaction.
+FLUSH_ROWS = 500
+
+# Results older than this many seconds are probed again by incremental runs.
+MAX_AGE = 7 * 24 * 3600
+
+# Keys of site definitions which do not change how a site is probed.
+UNHASHED_KEYS = ("rank",)
+
+# Results are stored as small integers.
+STATUS_CODES = {"no": 0, "yes": 1, "illegal": 2, "error": 3}
+STATUS_NAMES = {code: status for status, code in STATUS_CODES.items()}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, started REAL NOT NULL, label TEXT);
+CREATE TABLE IF NOT EXISTS usernames (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS sites (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS targets (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS target_usernames (
+    target_id INTEGER NOT NULL,
+    username_id INTEGER NOT NULL,
+    PRIMARY KEY (target_id, username_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL,
+    username_id INTEGER NOT NULL,
+    site_id INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    http_status INTEGER,
+    response_time_ms INTEGER,
+    url TEXT,
+    site_hash TEXT,
+    checked REAL
+);
+CREATE INDEX IF NOT EXISTS results_site ON results (site_id, status, username_id);
+CREATE INDEX IF NOT EXISTS results_username ON results (username_id, site_id);
+CREATE INDEX IF NOT EXISTS results_run ON results (run_id);
+"""
+
+# Columns added after the first version of the schema.
+ADDED_COLUMNS = {"site_hash": "TEXT", "checked": "REAL"}
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def site_hash(net_info):
+    """Return hash of the parts of a site definition used for probing."""
+    # sherlock() keeps the state of its requests under request_* keys.
+    definition = {key: value for key, value in net_info.items()
+                  if key not in UNHASHED_KEYS and not key.startswith("request_")}
+    return hashlib.sha1(json.dumps(definition, sort_keys=True).encode()).hexdigest()
+
+
+def site_hashes(site_data):
+    """Return dictionary of site_hash() of every site."""
+    return {social_network: site_hash(net_info) for social_network, net_info in site_data.items()}
+
+
+def as_int(value):
+    return value if isinstance(value, int) else None
+
+
+class ResultIndex:
+    """SQLite store of results, shared by the threads of a process."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        """Create Result Index.
+
+        Keyword Arguments:
+        path                   -- Path of the SQLite file, created if missing.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(results)")}
+        for column, column_type in ADDED_COLUMNS.items():
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE results ADD COLUMN {column} {column_type}")
+        self.ids = {"usernames": {}, "sites": {}, "targets": {}}
+        self.pending = []
+        self.run_id = None
+
+    def id_of(self, table, name):
+        """Return id of name in table (usernames, sites or targets)."""
+        ids = self.ids[table]
+        row_id = ids.get(name)
+        if row_id is None:
+            self.db.execute(f"INSERT OR IGNORE INTO {table} (name) VALUES (?)", (name,))
+            row_id = ids[name] = self.db.execute(f"SELECT id FROM {table} WHERE name = ?", (name,)).fetchone()[0]
+        return row_id
+
+    def start_run(self, label=None):
+        """Start new run and return its id."""
+        with self.lock, self.db:
+            return self.db.execute("INSERT INTO runs (started, label) VALUES (?, ?)", (time(), label)).lastrowid
+
+    def current_run(self):
+        """Return id of the run of this process, started on first use."""
+        with self.lock:
+            if self.run_id is None:
+                self.run_id = self.start_run(" ".join(sys.argv) or None)
+            return self.run_id
+
+    def add(self, run_id, username, social_network, results_site, definition_hash=None):
+        """Add result of one site, as returned by sherlock().
+
+        Rows are written by flush(), automatically every FLUSH_ROWS rows.
+
+        Keyword Arguments:
+        definition_hash        -- site_hash() of the definition the site
+                                  was probed with (optional).
+        """
+        with self.lock:
+            self.pending.append((run_id, self.id_of("usernames", username), self.id_of("sites", social_network),
+                                 STATUS_CODES.get(results_site.get("exists"), STATUS_CODES["error"]),
+                                 as_int(results_site.get("http_status")),
+                                 as_int(results_site.get("response_time_ms")),
+                                 results_site.get("url_user") or None, definition_hash, time()))
+            if len(self.pending) >= FLUSH_ROWS:
+                self.flush()
+
+    def add_results(self, run_id, username, results, hashes=None):
+        """Add all results of one sherlock() run.
+
+        Keyword Arguments:
+        hashes                 -- Dictionary returned by site_hashes()
+                                  (optional).
+        """
+        hashes = hashes or {}
+        for social_network, results_site in results.items():
+            self.add(run_id, username, social_network, results_site, hashes.get(social_network))
+        self.flush()
+
+    def link_targets(self, username, targets):
+        """Record that username was generated for targets."""
+        with self.lock, self.db:
+            username_id = self.id_of("usernames", username)
+            self.db.executemany("INSERT OR IGNORE INTO target_usernames VALUES (?, ?)",
+                                [(self.id_of("targets", target), username_id) for target in targets])
+
+    def flush(self):
+        with self.lock, self.db:
+            self.db.executemany("INSERT INTO results (run_id, username_id, site_id, status, http_status, "
+                                "response_time_ms, url, site_hash, checked) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                self.pending)
+            self.pending = []
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.db.close()
+
+    def fresh_results(self, username, hashes, max_age=MAX_AGE):
+        """Return the stored results of username which are still valid.
+
+        A result is valid if it is the latest one of its site, was probed
+        with the current definition of the site, is not older than max_age
+        seconds and is not an error.
+
+        Keyword Arguments:
+        username               -- Username to look up.
+        hashes                 -- Dictionary returned by site_hashes() for
+                                  the current site data.
+        max_age                -- Age in seconds after which results expire.
+
+        Return Value:
+        Dictionary of results_site dictionaries (as returned by sherlock())
+        keyed by site.
+        """
+        oldest = time() - max_age
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT s.name, r.status, r.http_status, r.response_time_ms, r.url, r.site_hash, MAX(r.checked) "
+                "FROM results r JOIN sites s ON s.id = r.site_id "
+                "WHERE r.username_id = (SELECT id FROM usernames WHERE name = ?) "
+                "GROUP BY r.site_id", (username,)).fetchall()
+        fresh = {}
+        for social_network, status, http_status, response_time_ms, url, stored_hash, checked in rows:
+            if (stored_hash is None or hashes.get(social_network) != stored_hash or checked < oldest
+                    or status == STATUS_CODES["error"]):
+                continue
+            fresh[social_network] = {"exists": STATUS_NAMES[status], "url_user": url or "",
+                                     "http_status": http_status if http_status is not None else "",
+                                     "response_time_ms": response_time_ms if response_time_ms is not None else "",
+                                     "response_text": ""}
+        return fresh
+
+    def latencies(self, limit):
+        """Return the last limit response times in ms of every site, oldest first."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name, response_time_ms FROM ("
+                "SELECT s.name, r.response_time_ms, r.rowid AS position, "
+                "ROW_NUMBER() OVER (PARTITION BY r.site_id ORDER BY r.rowid DESC) AS age "
+                "FROM results r JOIN sites s ON s.id = r.site_id "
+                "WHERE r.response_time_ms IS NOT NULL AND r.status != ?) "
+                "WHERE age <= ? ORDER BY position", (STATUS_CODES["error"], limit)).fetchall()
+        latencies = {}
+        for social_network, response_time_ms in rows:
+            latencies.setdefault(social_network, []).append(response_time_ms)
+        return latencies
+
+    def found_on(self, sites, run_id=None):
+        """Return usernames found on all of the sites (in run_id, or any run)."""
+        sites = list(dict.fromkeys(sites))
+        marks = ", ".join("?" * len(sites))
+        query = (f"SELECT u.name FROM results r JOIN usernames u ON u.id = r.username_id "
+                 f"JOIN sites s ON s.id = r.site_id "
+                 f"WHERE s.name IN ({marks}) AND r.status = ?")
+        arguments = sites + [STATUS_CODES["yes"]]
+        if run_id is not None:
+            query += " AND r.run_id = ?"
+            arguments.append(run_id)
+        query += " GROUP BY r.username_id HAVING COUNT(DISTINCT r.site_id) = ? ORDER BY u.name"
+        arguments.append(len(sites))
+        with self.lock:
+            return [name for name, in self.db.execute(query, arguments)]
+
+    def accounts(self, username):
+        """Return list of (site, url, run id) where username was last found."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT s.name, r.url, MAX(r.run_id) FROM results r "
+                "JOIN sites s ON s.id = r.site_id "
+                "WHERE r.username_id = (SELECT id FROM usernames WHERE name = ?) AND r.status = ? "
+                "GROUP BY r.site_id ORDER BY s.name", (username, STATUS_CODES["yes"])).fetchall()
+
+    def target_accounts(self, target):
+        """Return list of (username, site, url) found for target."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT DISTINCT u.name, s.name, r.url FROM target_usernames t "
+                "JOIN results r ON r.username_id = t.username_id AND r.status = ? "
+                "JOIN usernames u ON u.id = t.username_id JOIN sites s ON s.id = r.site_id "
+                "WHERE t.target_id = (SELECT id FROM targets WHERE name = ?) "
+                "ORDER BY u.name, s.name", (STATUS_CODES["yes"], target)).fetchall()
+
+    def summary(self):
+        with self.lock:
+            counts = {table: self.db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                      for table in ("runs", "usernames", "sites", "targets", "results")}
+            counts["found"] = self.db.execute("SELECT COUNT(*) FROM results WHERE status = ?",
+                                              (STATUS_CODES["yes"],)).fetchone()[0]
+            return counts
+
+    def import_output(self, directory, site_data):
+        """Add the found accounts of the <username>.txt files of directory.
+
+        The files only hold URLs; they are matched against the URL every
+        site would have for the username.
+
+        Return Value:
+        Number of URLs which did not belong to any site.
+        """
+        from looker.probe import PreparedUsername, prepare_sites
+
+        prepared_sites = prepare_sites(site_data)
+        run_id = self.start_run(f"import {directory}")
+        unknown = 0
+        for file_name in sorted(os.listdir(directory)):
+            if not file_name.endswith(".txt"):
+                continue
+            username = file_name[:-len(".txt")]
+            prepared_username = PreparedUsername(username)
+            sites = {site.user_url(prepared_username): social_network
+                     for social_network, site in prepared_sites.items()}
+            with open(os.path.join(directory, file_name), "r", encoding="utf-8") as output:
+                for line in output:
+                    url = line.strip()
+                    if not url or url.startswith("Total Websites"):
+                        continue
+                    social_network = sites.get(url)
+                    if social_network is None:
+                        unknown += 1
+                        continue
+                    self.add(run_id, username, social_network, {"exists": "yes", "url_user": url})
+        self.flush()
+        return unknown
+
+
+def get_index(path=DEFAULT_PATH):
+    """Return the process-wide ResultIndex of path."""
+    with _lock:
+        index = _indexes.get(path)
+        if index is None:
+            index = _indexes[path] = ResultIndex(path)
+        return index
+
+
+def main():
+    parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
+                            description="Query the results of all runs.")
+    parser.add_argument("--index", "-i", metavar="INDEX_FILE",
+                        dest="index", default=DEFAULT_PATH,
+                        help="SQLite index to use.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    found_on = commands.add_parser("found-on", help="Usernames found on all of the sites.")
+    found_on.add_argument("sites", nargs="+", metavar="SITE_NAME")
+    found_on.add_argument("--run", type=int, default=None, help="Only look at this run.")
+    user = commands.add_parser("user", help="Sites the username was found on.")
+    user.add_argument("username")
+    target = commands.add_parser("target", help="Everything found for a target.")
+    target.add_argument("target")
+    commands.add_parser("stats", help="Size of the index.")
+    import_output = commands.add_parser("import-output", help="Add the results of an output folder.")
+    import_output.add_argument("directory")
+    import_output.add_argument("--json", "-j", metavar="JSON_FILE", dest="json_file", default="data.json",
+                               help="Site data used to tell the sites of the URLs.")
+    args = parser.parse_args()
+
+    index = ResultIndex(args.index)
+    if args.command == "found-on":
+        for username in index.found_on(args.sites, args.run):
+            print(username)
+    elif args.command == "user":
+        for social_network, url, run_id in index.accounts(args.username):
+            print(f"{social_network}\t{url}\t{run_id}")
+    elif args.command == "target":
+        for username, social_network, url in index.target_accounts(args.target):
+            print(f"{username}\t{social_network}\t{url}")
+    elif args.command == "stats":
+        print(json.dumps(index.summary()))
+    else:
+        with open(args.json_file, "r", encoding="utf-8") as raw:
+            site_data = json.load(raw)
+        unknown = index.import_output(args.directory, site_data)
+        print(f"Imported {args.directory}, {unknown} URLs of unknown sites", file=sys.stderr)
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
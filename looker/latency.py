@@ -0,0 +1,148 @@
+"""Sherlock: Latency History and Hedged Probes
+
+Keeps the recent response times of every site. They give each site a
+deadline (the timeout of its requests) and the point after which a
+probe counts as slow (its p95): a slow probe gets a duplicate sent over
+a fresh connection, and whichever answers first is used.
+"""
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from time import time
+
+# Response times kept per site.
+WINDOW = 64
+
+# Sites with fewer response times are not hedged.
+MIN_SAMPLES = 8
+
+# Probes slower than this share of the earlier ones of the site are hedged.
+HEDGE_QUANTILE = 0.95
+
+# Seconds between checks whether a queued probe started.
+QUEUE_POLL = 0.05
+
+# Deadline of a site is its p95 times DEADLINE_FACTOR, within these bounds.
+DEADLINE_FACTOR = 4
+MIN_DEADLINE_SEC = 2.0
+MAX_DEADLINE_SEC = 30.0
+
+_history = None
+_lock = threading.Lock()
+
+
+class LatencyHistory:
+    """Recent response times (ms) of every site."""
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.times = {}
+        self.seeded = False
+
+    def record(self, site, elapsed_ms):
+        with self.lock:
+            times = self.times.get(site)
+            if times is None:
+                times = self.times[site] = deque(maxlen=self.window)
+            times.append(elapsed_ms)
+
+    def seed(self, latencies):
+        """Add response times of earlier runs, oldest first per site."""
+        for site, times in latencies.items():
+            for elapsed_ms in times:
+                self.record(site, elapsed_ms)
+        self.seeded = True
+
+    def quantile(self, site, q):
+        """Return q quantile of the response times of site in ms, or None."""
+        with self.lock:
+            times = sorted(self.times.get(site, ()))
+        if len(times) < MIN_SAMPLES:
+            return None
+        return times[min(int(q * len(times)), len(times) - 1)]
+
+    def hedge_after(self, site):
+        """Return seconds after which a probe of site is hedged, or None."""
+        p95 = self.quantile(site, HEDGE_QUANTILE)
+        return None if p95 is None else p95 / 1000
+
+    def deadline(self, site):
+        """Return timeout in seconds for the requests of site."""
+        p95 = self.quantile(site, HEDGE_QUANTILE)
+        if p95 is None:
+            return MAX_DEADLINE_SEC
+        return min(max(p95 / 1000 * DEADLINE_FACTOR, MIN_DEADLINE_SEC), MAX_DEADLINE_SEC)
+
+    def summary(self):
+        with self.lock:
+            return {"sites": len(self.times),
+                    "hedgeable": sum(len(times) >= MIN_SAMPLES for times in self.times.values())}
+
+
+def first_answer(future, hedge_after, resubmit):
+    """Wait for a probe, hedging it once it is slow.
+
+    A probe is slow once it has been running for hedge_after seconds; the
+    time it waited in the queue of the pool does not count, so probes are
+    not duplicated just because the workers are busy.
+
+    Keyword Arguments:
+    future                 -- Future of the probe, submitted to a
+                              ProbePool (its start time is future.started).
+    hedge_after            -- Seconds after which a duplicate is sent, or
+                              None to never hedge.
+    resubmit               -- Function sending the duplicate, returning its
+                              future, or None if no duplicate may be sent.
+
+    Return Value:
+    Tuple of (future of the first successful answer, or of the original
+    probe if none succeeded; True if a duplicate was sent).  The slower
+    probe is cancelled if it did not start yet, otherwise its answer is
+    dropped.
+    """
+    if hedge_after is None:
+        return future, False
+    started = getattr(future, "started", None)
+    while started is None:
+        done, _ = wait([future], timeout=QUEUE_POLL)
+        if done:
+            return future, False
+        started = getattr(future, "started", None)
+    done, _ = wait([future], timeout=max(started + hedge_after - time(), 0))
+    if done:
+        return future, False
+
+    duplicate = resubmit()
+    if duplicate is None:
+        wait([future])
+        return future, False
+    pending = {future, duplicate}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for finished in done:
+            if finished.exception() is None:
+                for other in pending:
+                    other.cancel()
+                return finished, True
+    # Both failed, report the error of the original probe.
+    return future, True
+
+
+def probe_settings(site, session, proxy=None):
+    """Return keyword arguments for sending a probe of site.
+
+    The send settings of the site (see PreparedSite.send_settings()) with
+    the deadline of the site as timeout, so a stalled host does not hold
+    a worker. Every sender of probes takes its settings from here.
+    """
+    return dict(site.send_settings(session, proxy), timeout=get_latency_history().deadline(site.name))
+
+
+def get_latency_history():
+    """Return the process-wide LatencyHistory."""
+    global _history
+    with _lock:
+        if _history is None:
+            _history = LatencyHistory()
+        return _history
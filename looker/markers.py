@@ -0,0 +1,129 @@
+"""Sherlock: Page Markers
+
+Sites using the "message" detection method describe their pages in
+data.json with markers:
+
+    errorMsg               -- Text (or list of texts) shown when the user
+                              does not exist.
+    presenceMsg            -- Text (or list of texts) shown only when the
+                              user exists (optional).
+
+All markers of a site are compiled into one automaton (an alternation
+of the encoded markers, run by the regular expression engine) which
+scans the raw body in a single pass, chunk by chunk, and stops at the
+first decisive marker. Adding markers therefore does not add passes
+over the page.
+"""
+import codecs
+import re
+import threading
+
+_markers = {}
+_lock = threading.Lock()
+
+
+def marker_list(value):
+    """Return markers from data.json (string, list or missing) as tuple."""
+    if value is None:
+        return ()
+    if isinstance(value, str):
+        return (value,)
+    return tuple(value)
+
+
+class Markers:
+    """Compiled markers of one site for one page encoding."""
+
+    def __init__(self, negative, positive, encoding=None):
+        """Create Markers.
+
+        Keyword Arguments:
+        negative               -- Tuple of texts meaning "user not found".
+        positive               -- Tuple of texts meaning "user exists".
+        encoding               -- Encoding of the page.  Markers are looked
+                                  for in UTF-8 and in this encoding.
+        """
+        encodings = ["utf-8"]
+        if encoding:
+            try:
+                if codecs.lookup(encoding).name != "utf-8":
+                    encodings.append(encoding)
+            except LookupError:
+                pass
+
+        # Encoded marker -> verdict. "Not found" wins if both contain it.
+        self.verdicts = {}
+        for texts, verdict in ((positive, "yes"), (negative, "no")):
+            for text in texts:
+                for name in encodings:
+                    try:
+                        self.verdicts[text.encode(name)] = verdict
+                    except UnicodeError:
+                        pass
+        self.verdicts.pop(b"", None)
+
+        # Longest first, so a marker containing another one wins.
+        markers = sorted(self.verdicts, key=len, reverse=True)
+        self.pattern = re.compile(b"|".join(re.escape(marker) for marker in markers)) if markers else None
+        self.overlap = max((len(marker) for marker in markers), default=1) - 1
+        # Without a decisive marker, sites with positive markers did not
+        # show the user.
+        self.default = "no" if positive else "yes"
+
+    def search(self, data):
+        """Return verdict of the first marker in data, or None."""
+        if self.pattern is None:
+            return None
+        match = self.pattern.search(data)
+        if match is None:
+            return None
+        return self.verdicts[match.group()]
+
+    def verdict(self, data):
+        """Return "yes" or "no" for a whole page."""
+        return self.search(data) or self.default
+
+    def scanner(self):
+        return MarkerScanner(self)
+
+
+class MarkerScanner:
+    """Scans a page chunk by chunk, markers may cross chunk boundaries."""
+
+    def __init__(self, markers):
+        self.markers = markers
+        self.tail = b""
+        self.result = None
+
+    def feed(self, chunk):
+        """Scan next chunk of the page.
+
+        Return Value:
+        "yes" or "no" once a decisive marker was found, None until then.
+        """
+        data = self.tail + chunk
+        self.result = self.markers.search(data)
+        if self.result is None and self.markers.overlap:
+            self.tail = data[-self.markers.overlap:]
+        return self.result
+
+    def finish(self):
+        """Return verdict after the whole page was scanned."""
+        return self.result or self.markers.default
+
+
+def site_markers(net_info, encoding=None):
+    """Return compiled Markers of a site for pages in encoding."""
+    return compile_markers(marker_list(net_info.get("errorMsg")),
+                           marker_list(net_info.get("presenceMsg")),
+                           encoding)
+
+
+def compile_markers(negative, positive, encoding=None):
+    """Return compiled Markers, cached per markers and encoding."""
+    key = (negative, positive, encoding)
+    with _lock:
+        markers = _markers.get(key)
+        if markers is None:
+            markers = _markers[key] = Markers(negative, positive, encoding)
+        return markers
@@ -1,13 +1,47 @@
-import sherlock
-from sherlock import main
-from multiprocessing import Pool
+"""Sherlock: Parallel Runs
 
-tab = ["abc","abcd","abcd","abcdd"]
-"""
-for usr in tab:
-    main(usr)
+Checks many usernames in worker processes. Where the platform supports
+it, workers are forked from a fork server which imported looker.sherlock
+(requests, colorama, ...) once, so every worker starts without paying
+for the imports again. Workers share the per-host budgets with each
+other and with other runs on the machine (see looker.scheduler).
 """
+import multiprocessing
+import sys
+from functools import partial
+
+# Modules imported by the fork server before it forks the workers.
+PRELOAD = ["looker.sherlock"]
+
+
+def check(username, argv=None):
+    from looker.sherlock import main
+    return main(username, argv)
+
+
+def make_pool(processes=8, preload=True):
+    """Return process pool for check().
+
+    Keyword Arguments:
+    processes              -- Number of worker processes.
+    preload                -- Boolean indicating whether workers should be
+                              forked from a fork server with PRELOAD
+                              imported.
+    """
+    if preload and "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(PRELOAD)
+    else:
+        context = multiprocessing.get_context()
+    return context.Pool(processes)
+
 
-with Pool(8) as p:
-    print(p.map(sherlock.main,tab))
+if __name__ == "__main__":
+    from looker.sherlock import get_parser
 
+    # Bad options (and --help) end this script, not the workers.
+    get_parser().parse_args()
+    tab = ["abc","abcd","abcd","abcdd"]
+    with make_pool(8) as p:
+        # Workers get the options given to this script.
+        print(p.map(partial(check, argv=sys.argv[1:]), tab))
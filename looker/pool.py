@@ -0,0 +1,223 @@
+"""Sherlock: Worker Pool
+
+This module holds the process-wide pool of worker threads and the HTTP
+session used for all probes, so calling sherlock() in a loop does not
+create new threads and connection pools for every username.
+"""
+import atexit
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import requests
+
+from looker.resolver import ResolvingAdapter, get_resolver
+from looker.scheduler import FairScheduler, Job, get_host_slots
+
+# Number of probes allowed to be submitted and not finished yet. Submitting
+# more blocks the caller until some of them finish.
+TARGET_INFLIGHT = 64
+
+# Probes spend nearly all of their time waiting on the network.
+THREADS_PER_CPU = 16
+
+# Number of hosts whose connection pools are kept alive between runs.
+POOL_CONNECTIONS = 256
+
+_pool = None
+_session = None
+_hedge_session = None
+_lock = threading.Lock()
+
+
+class RunStats:
+    """Accounting of the probes submitted during one run."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.inflight = 0
+        self.peak_inflight = 0
+        self.blocked_sec = 0.0
+        # site -> [compressed bytes, decompressed bytes] of its bodies
+        self.transfers = {}
+
+    def on_submit(self, blocked_sec):
+        with self.lock:
+            self.submitted += 1
+            self.inflight += 1
+            self.peak_inflight = max(self.peak_inflight, self.inflight)
+            self.blocked_sec += blocked_sec
+
+    def on_done(self, failed):
+        with self.lock:
+            self.inflight -= 1
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def on_transfer(self, site, compressed, decompressed):
+        with self.lock:
+            transfer = self.transfers.setdefault(site, [0, 0])
+            transfer[0] += compressed
+            transfer[1] += decompressed
+
+    def transfer_summary(self):
+        """Return dictionary of the body bytes received from every site."""
+        with self.lock:
+            return {site: {"compressed_bytes": compressed, "decompressed_bytes": decompressed}
+                    for site, (compressed, decompressed) in self.transfers.items()}
+
+    def summary(self):
+        """Return dictionary with the accounting of this run."""
+        with self.lock:
+            compressed = sum(transfer[0] for transfer in self.transfers.values())
+            decompressed = sum(transfer[1] for transfer in self.transfers.values())
+            return {
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "peak_inflight": self.peak_inflight,
+                "blocked_sec": round(self.blocked_sec, 3),
+                "elapsed_sec": round(time() - self.started, 3),
+                "compressed_bytes": compressed,
+                "decompressed_bytes": decompressed,
+            }
+
+
+class ProbePool:
+    """Bounded pool of worker threads shared fairly by jobs.
+
+    The pool never grows beyond max_workers threads and at most
+    max_inflight probes of a job are queued or running at the same time.
+    Probes start in the order of looker.scheduler.FairScheduler.
+    """
+
+    def __init__(self, max_workers=None, max_inflight=None):
+        """Create Probe Pool.
+
+        Keyword Arguments:
+        max_workers            -- Number of worker threads.  Derived from the
+                                  CPU count if not given.
+        max_inflight           -- Number of probes of a job which may be
+                                  queued or running before submit() blocks.
+        """
+        self.max_inflight = max_inflight or TARGET_INFLIGHT
+        if max_workers is None:
+            max_workers = min(self.max_inflight, (os.cpu_count() or 1) * THREADS_PER_CPU)
+        self.max_workers = max_workers
+        self.max_inflight = max(self.max_inflight, max_workers)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="sherlock")
+        self.scheduler = FairScheduler(self.executor, max_workers, slots=get_host_slots())
+        self.default_job = self.job("default")
+
+    def job(self, name, weight=1.0, priority=0, max_running=None):
+        """Return a new Job sharing the workers, see scheduler.Job."""
+        return Job(name, weight=weight, priority=priority, max_running=max_running,
+                   max_pending=self.max_inflight)
+
+    def submit(self, fn, *args, stats=None, job=None, host=None, **kwargs):
+        """Schedule fn(*args, **kwargs), blocking while the job is full.
+
+        Keyword Arguments:
+        fn                     -- Callable to run in a worker thread.
+        stats                  -- Optional RunStats to account the call in.
+        job                    -- Job the call belongs to (optional).
+        host                   -- Host the call talks to, counted against the
+                                  per-host budget (optional).
+
+        Return Value:
+        concurrent.futures.Future of the call.
+        """
+        start = time()
+        future = self.scheduler.submit(job or self.default_job, host, fn, args, kwargs)
+        if stats is not None:
+            stats.on_submit(time() - start)
+
+            def done(future):
+                stats.on_done(future.cancelled() or future.exception() is not None)
+
+            future.add_done_callback(done)
+        return future
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def get_pool():
+    """Return the process-wide ProbePool, creating it on first use."""
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProbePool()
+        return _pool
+
+
+def new_session(pool):
+    """Return session sized to pool, using the cached DNS results."""
+    session = requests.session()
+    for prefix in ("http://", "https://"):
+        session.mount(prefix, ResolvingAdapter(get_resolver(),
+                                               pool_connections=POOL_CONNECTIONS,
+                                               pool_maxsize=pool.max_workers))
+    return session
+
+
+def get_session():
+    """Return the process-wide session, sized to the pool.
+
+    Direct connections of the session use the cached DNS results of the
+    process-wide Resolver.
+    """
+    global _session
+    pool = get_pool()
+    with _lock:
+        if _session is None:
+            _session = new_session(pool)
+        return _session
+
+
+def get_hedge_session():
+    """Return the process-wide session for duplicates of slow probes.
+
+    It has connection pools of its own, so duplicates do not wait behind a
+    stalled connection of the main session.
+    """
+    global _hedge_session
+    pool = get_pool()
+    with _lock:
+        if _hedge_session is None:
+            _hedge_session = new_session(pool)
+        return _hedge_session
+
+
+@atexit.register
+def shutdown():
+    """Stop the worker threads and close all connections."""
+    global _pool, _session, _hedge_session
+    with _lock:
+        pool, sessions = _pool, (_session, _hedge_session)
+        _pool = _session = _hedge_session = None
+    if pool is not None:
+        pool.shutdown(wait=False)
+    for session in sessions:
+        if session is not None:
+            session.close()
+
+
+def _forget():
+    # Threads and sockets are not inherited by forked processes (Pool
+    # workers), they create their own on first use.
+    global _pool, _session, _hedge_session, _lock
+    _pool = _session = _hedge_session = None
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget)
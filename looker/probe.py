@@ -0,0 +1,378 @@
+"""Sherlock: Prepared Probes
+
+This module pre-parses the URL templates of all sites once, so checking
+a username only needs a few string concatenations instead of formatting
+the templates and sending every URL through the full requests
+Request/PreparedRequest machinery.
+"""
+import re
+import zlib
+from time import perf_counter, time
+from urllib.parse import urlsplit
+
+import requests
+from requests.cookies import RequestsCookieJar
+from requests.exceptions import ChunkedEncodingError, ContentDecodingError
+from requests.exceptions import SSLError as RequestsSSLError
+from requests.models import PreparedRequest
+from requests.sessions import merge_setting
+from requests.structures import CaseInsensitiveDict
+from requests.utils import requote_uri
+from urllib3.exceptions import ProtocolError, ReadTimeoutError, SSLError
+from urllib3.util.request import ACCEPT_ENCODING as DECODABLE_ENCODINGS
+
+try:
+    from urllib3.response import _get_decoder
+except ImportError:
+    _get_decoder = None
+try:
+    from urllib3.response import DECODER_ERROR_CLASSES
+except ImportError:
+    DECODER_ERROR_CLASSES = (OSError, zlib.error)
+
+from looker.markers import compile_markers, marker_list
+
+# Prepared sites, shared between all calls of sherlock() in this process.
+_prepared_sites = {}
+
+# Size of the chunks in which bodies are read.
+CHUNK_BYTES = 8192
+
+# Every content coding urllib3 can decode incrementally here: gzip and
+# deflate, br with brotli installed and zstd with zstandard installed.
+ACCEPT_ENCODING = DECODABLE_ENCODINGS.replace(",", ", ")
+
+# A user agent is needed because some sites don't return the correct
+# information since they think that we are bots.
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.12; rv:55.0) Gecko/20100101 Firefox/55.0'
+}
+
+HOST_SAFE = re.compile(r"[A-Za-z0-9._-]+")
+
+
+class PreparedUsername:
+    """Username encoded once for all of the sites."""
+
+    __slots__ = ("raw", "path", "host")
+
+    def __init__(self, username):
+        self.raw = username
+        # Exactly what requests would do to the whole URL.
+        self.path = requote_uri(username)
+        # Host names are case insensitive; anything else (IDNA encoding,
+        # invalid characters) is left to requests.
+        self.host = username.lower() if HOST_SAFE.fullmatch(username) else None
+
+
+def split_template(template):
+    """Split URL template into the parts before and after the username.
+
+    Keyword Arguments:
+    template               -- String with URL template, e.g.
+                              "https://twitter.com/{}".
+
+    Return Value:
+    Tuple of (prefix, suffix, host_templated).
+    """
+    prefix, suffix = template.split("{}", 1)
+    parts = urlsplit(template)
+    host_templated = "{}" in parts.netloc
+    if not parts.path:
+        # requests always sends at least "/" as path
+        suffix = suffix + "/"
+    return prefix, suffix, host_templated
+
+
+class PreparedSite:
+    """Site with its URL templates and request options parsed once."""
+
+    def __init__(self, social_network, net_info):
+        self.name = social_network
+        url = net_info["url"]
+        self.url_prefix, self.url_suffix, _ = split_template(url)
+        # Probe URL is normal one seen by people out on the web, unless
+        # there is a special URL for probing existence.
+        self.probe_prefix, self.probe_suffix, self.host_templated = \
+            split_template(net_info.get("urlProbe") or url)
+        self.host = urlsplit(self.probe_prefix).hostname
+
+        error_type = net_info["errorType"]
+        self.method = "GET"
+        if social_network != "GitHub" and error_type == "status_code":
+            # If only the status_code is needed don't download the body
+            self.method = "HEAD"
+
+        # Site forwards request to a different URL if username not found.
+        # Disallow the redirect so we can capture the http status from the
+        # original URL request.
+        self.allow_redirects = error_type != "response_url"
+
+        # Markers looked for in the page of "message" sites.
+        self.negative = marker_list(net_info.get("errorMsg"))
+        self.positive = marker_list(net_info.get("presenceMsg"))
+        self.scan_markers = error_type == "message"
+
+        # Environment settings (proxies, certificates) per proxy URL.
+        self.settings = {}
+
+    def user_url(self, username):
+        """URL of user on site, as shown to people."""
+        return self.url_prefix + username.raw + self.url_suffix
+
+    def probe_url(self, username):
+        """Encoded URL which is requested to check the username."""
+        if self.host_templated:
+            if username.host is None:
+                return None
+            return self.probe_prefix + username.host + self.probe_suffix
+        return self.probe_prefix + username.path + self.probe_suffix
+
+    def send_settings(self, session, proxy=None):
+        """Keyword arguments for session.send(), computed once per proxy."""
+        settings = self.settings.get(proxy)
+        if settings is None:
+            proxies = {"http": proxy, "https": proxy} if proxy is not None else {}
+            settings = session.merge_environment_settings(
+                self.probe_prefix, proxies, None, None, None)
+            settings["allow_redirects"] = self.allow_redirects
+            self.settings[proxy] = settings
+        return settings
+
+    def request(self, username, headers, method=None):
+        """Build request for username without re-parsing the URL.
+
+        Keyword Arguments:
+        username               -- PreparedUsername to check.
+        headers                -- Headers returned by prepare_headers().
+        method                 -- HTTP method to use instead of the one of
+                                  the site (optional).
+
+        Return Value:
+        requests.PreparedRequest ready to be sent with session.send().
+        """
+        url = self.probe_url(username)
+        if url is None:
+            # Unusual host name, let requests encode (or reject) it.
+            request = PreparedRequest()
+            request.prepare(method=method or self.method,
+                            url=self.probe_prefix + username.raw + self.probe_suffix,
+                            headers=headers)
+            return request
+
+        request = PreparedRequest()
+        request.method = method or self.method
+        request.url = url
+        request.headers = headers.copy()
+        # Fresh jar, so cookies of redirects do not leak between requests.
+        request._cookies = RequestsCookieJar()
+        request.body = None
+        request.hooks = {"response": []}
+        return request
+
+
+def prepare_sites(site_data):
+    """Return PreparedSite for every site in site_data.
+
+    Sites are prepared only once per process, unless their definition
+    changes.
+    """
+    prepared = {}
+    for social_network, net_info in site_data.items():
+        key = (social_network, net_info["url"], net_info.get("urlProbe"),
+               net_info["errorType"], marker_list(net_info.get("errorMsg")),
+               marker_list(net_info.get("presenceMsg")))
+        site = _prepared_sites.get(key)
+        if site is None:
+            site = PreparedSite(social_network, net_info)
+            _prepared_sites[key] = site
+        prepared[social_network] = site
+    return prepared
+
+
+def prepare_headers(session, headers):
+    """Merge headers with the session defaults once for a whole run.
+
+    Compressed bodies are asked for explicitly, with every coding which can
+    be decompressed while reading, unless headers say otherwise.
+    """
+    merged = merge_setting(headers, session.headers, dict_class=CaseInsensitiveDict)
+    if headers is None or "Accept-Encoding" not in CaseInsensitiveDict(headers):
+        merged["Accept-Encoding"] = ACCEPT_ENCODING
+    return merged
+
+
+def wire_content(r, chunk_bytes, counted):
+    """Yield the decompressed body of a urllib3 response, counting wire bytes.
+
+    urllib3 does not count the bytes of chunked bodies (r.raw.tell() stays
+    0), so the body is read undecoded and decompressed here, like urllib3
+    would. counted[0] is the number of body bytes read so far. Errors are
+    raised as by Response.iter_content().
+    """
+    raw = r.raw
+    encoding = r.headers.get("Content-Encoding", "").lower()
+    decoder = None
+    if encoding in raw.CONTENT_DECODERS or any(part.strip() in raw.CONTENT_DECODERS
+                                              for part in encoding.split(",")):
+        decoder = _get_decoder(encoding)
+    try:
+        for data in raw.stream(chunk_bytes, decode_content=False):
+            counted[0] += len(data)
+            if decoder is not None:
+                data = decoder.decompress(data)
+            if data:
+                yield data
+        if decoder is not None:
+            data = decoder.flush()
+            if data:
+                yield data
+    except DECODER_ERROR_CLASSES as e:
+        raise ContentDecodingError(e)
+    except ProtocolError as e:
+        raise ChunkedEncodingError(e)
+    except ReadTimeoutError as e:
+        raise requests.ConnectionError(e)
+    except SSLError as e:
+        raise RequestsSSLError(e)
+
+
+def read_body(r, limit=None, markers=None, keep=None):
+    """Download a streamed response body only as far as needed.
+
+    The body is decompressed chunk by chunk while it is read. Reading stops
+    after limit decompressed bytes, or at the first decisive marker. What
+    was read is kept as the content of the response, so r.text and
+    r.content keep working; the verdict of the markers is stored as
+    r.marker_verdict, the bytes received and the bytes they decompressed
+    to as r.compressed_bytes and r.decompressed_bytes.
+
+    Keyword Arguments:
+    r                      -- requests.Response sent with stream=True.
+    limit                  -- Number of bytes to read at most (optional).
+    markers                -- Markers to scan the body for (optional).
+    keep                   -- Number of bytes to read even after a
+                              decisive marker (optional).
+    """
+    scanner = markers.scanner() if markers is not None else None
+    decided = False
+    chunks = []
+    size = 0
+    counted = None
+    content = None
+    if (_get_decoder is not None and not r._content_consumed
+            and hasattr(r.raw, "stream") and hasattr(r.raw, "CONTENT_DECODERS")):
+        counted = [0]
+        content = wire_content(r, CHUNK_BYTES, counted)
+    for chunk in content or r.iter_content(CHUNK_BYTES):
+        chunks.append(chunk)
+        size += len(chunk)
+        if scanner is not None and not decided:
+            decided = scanner.feed(chunk) is not None
+        if decided and (keep is None or size >= keep):
+            break
+        if limit is not None and size >= limit:
+            break
+    if content is not None:
+        content.close()
+    r._content = b"".join(chunks)
+    r._content_consumed = True
+    # Bytes read from the connection, before decompression; the
+    # decompressed size where they are not known.
+    if counted is not None:
+        r.compressed_bytes = counted[0]
+    elif r.raw is not None:
+        r.compressed_bytes = r.raw.tell()
+    else:
+        r.compressed_bytes = getattr(r, "compressed_bytes", 0)
+    r.compressed_bytes = r.compressed_bytes or size
+    r.decompressed_bytes = size
+    # Releases the connection, or closes it if the body was cut short.
+    r.close()
+    if scanner is not None:
+        r.marker_verdict = scanner.finish()
+    return r
+
+
+def send_probe(session, site, username, headers, settings, http2=None, body_limit=None, keep_bytes=None):
+    """Build and send request for username.
+
+    Requests go over the HTTP/2 transport when one is given and the site
+    supports it. Response time in ms is stored as r.elapsed.
+
+    Bodies are always streamed, see read_body(). Pages of "message" sites
+    are scanned for their markers while they are downloaded. With
+    body_limit the page is requested even for sites which need only the
+    status code, but only its first body_limit bytes are downloaded. With
+    keep_bytes at least that much of the page is downloaded, even when a
+    marker decided early (for the archive).
+    """
+    start = time()
+    method = "GET" if body_limit is not None else None
+    request = site.request(username, headers, method=method)
+    settings = dict(settings, stream=True)
+    r = None
+    if http2 is not None:
+        r = http2.send(site.host, request, settings)
+    if r is None:
+        r = session.send(request, **settings)
+    markers = None
+    if site.scan_markers and request.method != "HEAD":
+        markers = compile_markers(site.negative, site.positive, r.encoding)
+    read_body(r, body_limit, markers, keep_bytes)
+    r.elapsed = round((time() - start) * 1000)
+    return r
+
+
+def benchmark(site_data, username="noonewouldeverusethis7", rounds=50):
+    """Measure CPU cost of building the requests for one username.
+
+    Compares the way sherlock() used to build requests (format the
+    templates, build headers and go through Session.request preparation)
+    with the prepared probes. Nothing is sent over the network.
+
+    Return Value:
+    Tuple of (legacy, prepared) microseconds spent per probe.
+    """
+    session = requests.session()
+    headers = HEADERS
+
+    start = perf_counter()
+    for _ in range(rounds):
+        for social_network, net_info in site_data.items():
+            url = net_info["url"].format(username)
+            url_probe = net_info.get("urlProbe")
+            if url_probe is not None:
+                url_probe = url_probe.format(username)
+            else:
+                url_probe = url
+            request = requests.Request("GET", url_probe, headers=dict(headers))
+            prepared = session.prepare_request(request)
+            session.merge_environment_settings(prepared.url, {}, None, None, None)
+    legacy = perf_counter() - start
+
+    sites = prepare_sites(site_data)
+    start = perf_counter()
+    for _ in range(rounds):
+        prepared_username = PreparedUsername(username)
+        prepared_headers = prepare_headers(session, headers)
+        for site in sites.values():
+            site.user_url(prepared_username)
+            site.request(prepared_username, prepared_headers)
+            site.send_settings(session)
+    prepared = perf_counter() - start
+
+    probes = rounds * len(site_data)
+    return legacy / probes * 1e6, prepared / probes * 1e6
+
+
+if __name__ == "__main__":
+    import json
+    import os
+
+    data_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data.json")
+    with open(data_file_path, "r", encoding="utf-8") as raw:
+        site_data_all = json.load(raw)
+    legacy, prepared = benchmark(site_data_all)
+    print(f"legacy:   {legacy:8.2f} us per probe")
+    print(f"prepared: {prepared:8.2f} us per probe ({legacy / prepared:.1f}x faster)")
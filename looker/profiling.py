@@ -0,0 +1,242 @@
+"""Sherlock: Profiling
+
+Named spans around the stages of a run (candidate generation, loading
+the site data, submitting probes, waiting on the network, decoding,
+classification, output) and an optional sampling profiler. While
+profiling is off span() returns a shared no-op context manager, so the
+spans cost next to nothing.
+
+    with span("classify"):
+        exists = detect(error_type, net_info, r)
+
+When enabled, every span accounts wall time, CPU time of its thread and,
+with allocations, the bytes it allocated (net, from tracemalloc). write()
+stores a breakdown per stage as JSON and the span stacks in the folded
+format of flamegraph.pl and speedscope ("run;wait 1234" per line, in
+microseconds). The sampling profiler looks at the stacks of all threads
+every interval and folds them below the spans they ran in.
+
+Profiling is enabled by sherlock --profile DIR or, for any entry point,
+the SHERLOCK_PROFILE=DIR environment variable (SHERLOCK_PROFILE_SAMPLE_MS
+turns on sampling).
+"""
+import os
+import sys
+import threading
+from time import perf_counter, thread_time
+
+# Seconds between two samples of the sampling profiler.
+SAMPLE_INTERVAL = 0.005
+
+# Frames kept per sampled stack, innermost ones.
+MAX_DEPTH = 64
+
+_profiler = None
+
+
+class NullSpan:
+    """Span used while profiling is off."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    __slots__ = ("profiler", "name", "stack", "wall", "cpu", "memory", "children")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.stack = self.profiler.stack()
+        self.stack.append(self)
+        self.children = 0.0
+        self.memory = self.profiler.traced() if self.profiler.allocations else 0
+        self.cpu = thread_time()
+        self.wall = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = perf_counter() - self.wall
+        cpu = thread_time() - self.cpu
+        memory = self.profiler.traced() - self.memory if self.profiler.allocations else 0
+        path = ";".join(span.name for span in self.stack)
+        self.stack.pop()
+        if self.stack:
+            self.stack[-1].children += wall
+        self.profiler.account(path, self.name, wall, wall - self.children, cpu, memory)
+        return False
+
+
+class Profiler:
+    """Accounting of the spans and samples of a process."""
+
+    def __init__(self, sample_interval=None, allocations=False):
+        """Create Profiler.
+
+        Keyword Arguments:
+        sample_interval        -- Seconds between samples of the sampling
+                                  profiler, or None not to sample.
+        allocations            -- Boolean indicating whether to account the
+                                  bytes allocated in spans (slow, uses
+                                  tracemalloc).
+        """
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.allocations = allocations
+        self.stacks = {}
+        self.reset()
+        if allocations:
+            import tracemalloc
+            tracemalloc.start()
+            self.traced = lambda: tracemalloc.get_traced_memory()[0]
+        self.sample_interval = sample_interval
+        self.stopped = threading.Event()
+        self.sampler = None
+        if sample_interval:
+            self.sampler = threading.Thread(target=self.sample, name="sherlock-profiler", daemon=True)
+            self.sampler.start()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.folded = {}
+            self.samples = {}
+            self.sample_count = 0
+
+    def stack(self):
+        """Return the stack of open spans of the calling thread."""
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+            self.stacks[threading.get_ident()] = stack
+        return stack
+
+    def account(self, path, name, wall, own_wall, cpu, memory):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {"count": 0, "wall_sec": 0.0, "cpu_sec": 0.0, "alloc_bytes": 0}
+            stage["count"] += 1
+            stage["wall_sec"] += wall
+            stage["cpu_sec"] += cpu
+            stage["alloc_bytes"] += memory
+            self.folded[path] = self.folded.get(path, 0) + own_wall
+
+    def sample(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.sample_interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames = sys._current_frames()
+            folded = []
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                calls = []
+                while frame is not None and len(calls) < MAX_DEPTH:
+                    code = frame.f_code
+                    calls.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                spans = [span.name for span in list(self.stacks.get(ident, ()))]
+                folded.append(";".join([names.get(ident, "thread")] + spans + calls[::-1]))
+            del frames
+            with self.lock:
+                self.sample_count += 1
+                for path in folded:
+                    self.samples[path] = self.samples.get(path, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        if self.allocations:
+            import tracemalloc
+            tracemalloc.stop()
+
+    def summary(self):
+        """Return breakdown of the time per stage."""
+        with self.lock:
+            stages = {name: dict(stage, wall_sec=round(stage["wall_sec"], 6), cpu_sec=round(stage["cpu_sec"], 6))
+                      for name, stage in self.stages.items()}
+            return {"stages": stages, "samples": self.sample_count,
+                    "sample_interval_sec": self.sample_interval}
+
+    def write(self, prefix):
+        """Write prefix.json, prefix.folded and, when sampling, prefix.samples.folded.
+
+        Return Value:
+        List of the paths written.
+        """
+        import json
+
+        directory = os.path.dirname(prefix)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            folded = dict(self.folded)
+            samples = dict(self.samples)
+        paths = [prefix + ".json", prefix + ".folded"]
+        with open(paths[0], "w", encoding="utf-8") as out:
+            json.dump(self.summary(), out, indent=1)
+        with open(paths[1], "w", encoding="utf-8") as out:
+            for path, seconds in sorted(folded.items()):
+                out.write(f"{path} {round(seconds * 1e6)}\n")
+        if self.sampler is not None:
+            paths.append(prefix + ".samples.folded")
+            with open(paths[2], "w", encoding="utf-8") as out:
+                for path, count in sorted(samples.items()):
+                    out.write(f"{path} {count}\n")
+        return paths
+
+
+def span(name):
+    """Return context manager accounting its block to stage name."""
+    if _profiler is None:
+        return NULL_SPAN
+    return Span(_profiler, name)
+
+
+def enable(sample_interval=None, allocations=False):
+    """Start profiling the process; return the Profiler (the running one if any)."""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(sample_interval, allocations)
+    return _profiler
+
+
+def disable():
+    """Stop profiling, return the stopped Profiler or None."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None:
+        profiler.stop()
+    return profiler
+
+
+def get_profiler():
+    """Return the running Profiler, or None while profiling is off."""
+    return _profiler
+
+
+def enable_from_environment():
+    """Enable profiling if SHERLOCK_PROFILE is set.
+
+    Return Value:
+    Directory to write the profile to, or None.
+    """
+    directory = os.environ.get("SHERLOCK_PROFILE")
+    if not directory:
+        return None
+    sample_ms = os.environ.get("SHERLOCK_PROFILE_SAMPLE_MS")
+    enable(float(sample_ms) / 1000 if sample_ms else None,
+           allocations=bool(os.environ.get("SHERLOCK_PROFILE_ALLOCATIONS")))
+    return directory
@@ -0,0 +1,254 @@
+"""Sherlock: DNS Resolver
+
+This module resolves the host names of all sites up front, concurrently,
+and caches the addresses so new connections do not have to wait for
+getaddrinfo. The cache can also be kept on disk, so it is shared by
+several processes (e.g. Pool workers) and runs.
+"""
+import json
+import os
+import socket
+import threading
+from time import perf_counter, time
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+# Seconds for which resolved addresses are used.
+DEFAULT_TTL = 300
+
+# Number of host names resolved at the same time.
+CONCURRENCY = 32
+
+_resolver = None
+_lock = threading.Lock()
+
+
+class Resolver:
+    """Cache of resolved host names with statistics."""
+
+    def __init__(self, ttl=DEFAULT_TTL, cache_path=None):
+        """Create Resolver.
+
+        Keyword Arguments:
+        ttl                    -- Seconds for which addresses are cached.
+        cache_path             -- Path of JSON file to share the cache with
+                                  other processes (optional).
+        """
+        self.ttl = ttl
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        # host -> [expires, addresses, seconds the resolution took]
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.resolve_sec = 0.0
+        self.saved_sec = 0.0
+        if cache_path is not None:
+            self.load()
+
+    def lookup(self, host):
+        """Return cached addresses of host, or None if it is not known.
+
+        Like getaddrinfo, all addresses are returned in order, so connecting
+        can fall back to the next one when an address is down.
+        """
+        now = time()
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry is None or entry[0] < now or not entry[1]:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.saved_sec += entry[2]
+            return list(entry[1])
+
+    def forget(self, host):
+        """Drop cached addresses of host, e.g. when connecting failed."""
+        with self.lock:
+            self.entries.pop(host, None)
+
+    def missing(self, hosts):
+        """Return hosts without valid cache entry."""
+        now = time()
+        with self.lock:
+            return [host for host in hosts
+                    if host not in self.entries or self.entries[host][0] < now]
+
+    async def resolve_host(self, loop, semaphore, host):
+        async with semaphore:
+            start = perf_counter()
+            try:
+                infos = await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+            except (socket.gaierror, UnicodeError):
+                return host, [], perf_counter() - start
+            addresses = []
+            for info in infos:
+                if info[4][0] not in addresses:
+                    addresses.append(info[4][0])
+            return host, addresses, perf_counter() - start
+
+    async def resolve_hosts(self, hosts):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(CONCURRENCY)
+        return await asyncio.gather(*[self.resolve_host(loop, semaphore, host) for host in hosts])
+
+    def prefetch(self, hosts):
+        """Resolve all hosts which are not cached yet.
+
+        Keyword Arguments:
+        hosts                  -- Iterable of host names.
+
+        Return Value:
+        Number of host names which were resolved.
+        """
+        if self.cache_path is not None:
+            # Pick up what other processes resolved in the meantime.
+            self.load()
+        missing = self.missing(set(hosts))
+        if not missing:
+            return 0
+
+        # asyncio is only imported once there is something to resolve.
+        import asyncio
+
+        results = asyncio.run(self.resolve_hosts(missing))
+        now = time()
+        with self.lock:
+            for host, addresses, cost in results:
+                self.resolve_sec += cost
+                # Hosts which do not resolve are remembered too, so they are
+                # not tried again in every run.
+                self.entries[host] = [now + self.ttl, addresses, cost]
+        if self.cache_path is not None:
+            self.save()
+        return len(missing)
+
+    def load(self):
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as cache_file:
+                entries = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+        now = time()
+        with self.lock:
+            for host, entry in entries.items():
+                current = self.entries.get(host)
+                if entry[0] > now and (current is None or current[0] < entry[0]):
+                    self.entries[host] = entry
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries)
+        # Write whole file at once, other processes may read it right now.
+        temp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as cache_file:
+            cache_file.write(data)
+        os.replace(temp_path, self.cache_path)
+
+    def summary(self):
+        """Return dictionary with statistics of the resolver."""
+        with self.lock:
+            return {
+                "hosts": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "resolve_ms": round(self.resolve_sec * 1000),
+                "saved_ms": round(self.saved_sec * 1000),
+            }
+
+
+class ResolvingConnectionMixin:
+    """Connects to the cached addresses instead of resolving the host again.
+
+    Only the address used for the socket changes, TLS still verifies the
+    certificate against the real host name.
+    """
+
+    resolver = None
+
+    def _new_conn(self):
+        host = self._dns_host
+        addresses = self.resolver.lookup(host)
+        if addresses is None:
+            return super()._new_conn()
+        try:
+            for address in addresses:
+                self._dns_host = address
+                try:
+                    return super()._new_conn()
+                except (NewConnectionError, ConnectTimeoutError):
+                    continue
+        finally:
+            self._dns_host = host
+        # All addresses may be stale, try again the usual way.
+        self.resolver.forget(host)
+        return super()._new_conn()
+
+
+def connection_pool_classes(resolver):
+    """Return urllib3 pool classes using resolver, by scheme."""
+    http_connection = type("ResolvingHTTPConnection",
+                           (ResolvingConnectionMixin, HTTPConnection),
+                           {"resolver": resolver})
+    https_connection = type("ResolvingHTTPSConnection",
+                            (ResolvingConnectionMixin, HTTPSConnection),
+                            {"resolver": resolver})
+    return {
+        "http": type("ResolvingHTTPConnectionPool", (HTTPConnectionPool,),
+                     {"ConnectionCls": http_connection}),
+        "https": type("ResolvingHTTPSConnectionPool", (HTTPSConnectionPool,),
+                      {"ConnectionCls": https_connection}),
+    }
+
+
+class ResolvingAdapter(HTTPAdapter):
+    """HTTPAdapter whose direct connections use Resolver."""
+
+    def __init__(self, resolver, **kwargs):
+        self.resolver = resolver
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = connection_pool_classes(self.resolver)
+
+
+def site_hosts(prepared_sites):
+    """Return host names of the sites which do not depend on the username."""
+    return {site.host for site in prepared_sites.values()
+            if site.host and not site.host_templated}
+
+
+def get_resolver(cache_path=None):
+    """Return the process-wide Resolver, creating it on first use.
+
+    Keyword Arguments:
+    cache_path             -- Path of JSON file to share the cache with
+                              other processes.  Takes effect when given for
+                              the first time.
+    """
+    global _resolver
+    with _lock:
+        if _resolver is None:
+            _resolver = Resolver(cache_path=cache_path)
+        elif cache_path is not None and _resolver.cache_path is None:
+            _resolver.cache_path = cache_path
+            _resolver.load()
+        return _resolver
+
+
+def _after_fork():
+    # Locks may have been held by threads which do not exist in the child.
+    global _lock
+    _lock = threading.Lock()
+    if _resolver is not None:
+        _resolver.lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
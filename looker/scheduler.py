@@ -0,0 +1,333 @@
+"""Sherlock: Fair Scheduler
+
+Shares the worker threads of a process between jobs (investigations of
+the resident service, or all runs of a plain process). Jobs with a
+higher priority always go first; jobs of the same priority get workers
+in proportion to their weight (weighted fair queuing), so a small lookup
+is not stuck behind a large sweep. Jobs can be capped to a number of
+running probes, and no host gets more than a budget of probes at the
+same time, whichever jobs they belong to.
+
+Host budgets are shared by all processes of the user (run.py,
+pararel.py workers, the resident service) through HostSlots: every host
+has a lock file with one byte per slot, and a running probe holds a lock
+on its byte. The kernel releases the locks of a process which dies, so a
+crashed run never keeps a slot. The lock files are private to the user,
+so other users can not hold slots and stall the scans. Without fcntl
+(Windows) budgets are per process.
+"""
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import Future
+from time import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Probes running at the same time against one host, over all jobs.
+HOST_BUDGET = 8
+
+# Lock files of the host budgets shared between the processes of the user.
+SLOTS_DIRECTORY = os.environ.get("SHERLOCK_HOST_SLOTS") or os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or os.environ.get("XDG_CACHE_HOME")
+    or os.path.join(os.path.expanduser("~"), ".cache"), "sherlock-hosts")
+
+# Seconds after which probes waiting for hosts busy in other processes are
+# tried again.
+RETRY_SEC = 0.05
+
+HOST_FILE = re.compile(r"[^A-Za-z0-9.-]")
+
+_slots = None
+_lock = threading.Lock()
+
+# Queued probes of a job looked at to find one whose host has budget left.
+SCAN = 32
+
+
+class Task:
+    __slots__ = ("future", "host", "fn", "args", "kwargs", "slot")
+
+    def __init__(self, future, host, fn, args, kwargs):
+        self.future = future
+        self.host = host
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.slot = None
+
+
+class HostSlots:
+    """Per-host budgets shared by the processes of the machine.
+
+    POSIX locks belong to a process, not to a thread or an open file, so
+    there must be only one HostSlots per directory in a process (see
+    get_host_slots()); it tells the threads of the process apart itself.
+    """
+
+    def __init__(self, directory=None):
+        """Create Host Slots.
+
+        Keyword Arguments:
+        directory              -- Directory of the lock files, created
+                                  private to the user (SLOTS_DIRECTORY if
+                                  not given).
+        """
+        directory = directory or SLOTS_DIRECTORY
+        self.directory = directory
+        self.lock = threading.Lock()
+        # host -> file descriptor, kept open: closing any descriptor of a
+        # file drops all locks of the process on it
+        self.files = {}
+        # host -> slots held by this process
+        self.held = {}
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def file(self, host):
+        # Called with the lock held.
+        fd = self.files.get(host)
+        if fd is None:
+            path = os.path.join(self.directory, HOST_FILE.sub("_", host))
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            except OSError:
+                # Not usable (e.g. no space for the file), the host is
+                # budgeted per process.
+                fd = -1
+            self.files[host] = fd
+        return fd
+
+    def acquire(self, host, budget):
+        """Take a free slot of host.
+
+        Return Value:
+        Number of the slot, -1 if the host can not be shared, or None if
+        all budget slots are taken.
+        """
+        with self.lock:
+            fd = self.file(host)
+            if fd < 0:
+                return -1
+            held = self.held.setdefault(host, set())
+            for slot in range(budget):
+                if slot in held:
+                    continue
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+                except OSError:
+                    # Taken by another process.
+                    continue
+                held.add(slot)
+                return slot
+        return None
+
+    def release(self, host, slot):
+        if slot < 0:
+            return
+        with self.lock:
+            fcntl.lockf(self.files[host], fcntl.LOCK_UN, 1, slot)
+            self.held[host].discard(slot)
+
+
+class Job:
+    """Probes belonging to one investigation."""
+
+    def __init__(self, name, weight=1.0, priority=0, max_running=None, max_pending=64):
+        """Create Job.
+
+        Keyword Arguments:
+        name                   -- Name of the job, for summaries.
+        weight                 -- Share of the workers relative to other
+                                  jobs of the same priority.
+        priority               -- Jobs with higher priority go first.
+        max_running            -- Number of probes of the job running at the
+                                  same time at most (optional).
+        max_pending            -- Number of probes queued or running before
+                                  submitting more blocks.
+        """
+        self.name = name
+        self.weight = weight
+        self.priority = priority
+        self.max_running = max_running
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.queue = deque()
+        self.running = 0
+        self.completed = 0
+        # Virtual time of weighted fair queuing, advanced by 1 / weight for
+        # every probe started.
+        self.vtime = 0.0
+
+    def summary(self):
+        return {"name": self.name, "queued": len(self.queue), "running": self.running,
+                "completed": self.completed}
+
+
+class FairScheduler:
+    """Starts the probes of all jobs on an executor, in fair order."""
+
+    def __init__(self, executor, max_running, host_budget=HOST_BUDGET, slots=None):
+        """Create Fair Scheduler.
+
+        Keyword Arguments:
+        executor               -- concurrent.futures.Executor running probes.
+        max_running            -- Number of probes running at the same time,
+                                  the number of workers of executor.
+        host_budget            -- Number of probes running against one host
+                                  at the same time.
+        slots                  -- HostSlots sharing the host budgets with
+                                  other processes (optional, otherwise they
+                                  are per scheduler).
+        """
+        self.executor = executor
+        self.max_running = max_running
+        self.host_budget = host_budget
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.hosts = {}
+        self.running = 0
+        self.vclock = 0.0
+        # Probes wait for hosts busy in other processes
+        self.blocked = False
+        self.retry = None
+
+    def submit(self, job, host, fn, args=(), kwargs=None):
+        """Queue fn(*args, **kwargs) for job, blocking while job is full.
+
+        Return Value:
+        concurrent.futures.Future of the call.
+        """
+        job.pending.acquire()
+        future = Future()
+        with self.lock:
+            if not job.queue and not job.running:
+                # A job becoming active starts at the current virtual time,
+                # it gets no credit for the time it was idle.
+                job.vtime = max(job.vtime, self.vclock)
+            if job not in self.jobs:
+                self.jobs.append(job)
+            job.queue.append(Task(future, host, fn, args, kwargs or {}))
+        self.dispatch()
+        return future
+
+    def pick(self):
+        # Called with the lock held.
+        ready = [job for job in self.jobs
+                 if job.queue and (job.max_running is None or job.running < job.max_running)]
+        ready.sort(key=lambda job: (-job.priority, job.vtime))
+        for job in ready:
+            for position, task in enumerate(job.queue):
+                if position >= SCAN:
+                    break
+                if task.host is not None:
+                    if self.hosts.get(task.host, 0) >= self.host_budget:
+                        continue
+                    if self.slots is not None:
+                        task.slot = self.slots.acquire(task.host, self.host_budget)
+                        if task.slot is None:
+                            self.blocked = True
+                            continue
+                del job.queue[position]
+                return job, task
+        return None
+
+    def dispatch(self):
+        """Start queued probes while workers are free."""
+        started = []
+        with self.lock:
+            self.blocked = False
+            while self.running < self.max_running:
+                picked = self.pick()
+                if picked is None:
+                    break
+                job, task = picked
+                self.running += 1
+                job.running += 1
+                if task.host is not None:
+                    self.hosts[task.host] = self.hosts.get(task.host, 0) + 1
+                self.vclock = job.vtime
+                job.vtime += 1 / job.weight
+                started.append((job, task))
+            if self.blocked and self.retry is None:
+                # Nothing here tells when other processes free their slots.
+                self.retry = threading.Timer(RETRY_SEC, self.retry_dispatch)
+                self.retry.daemon = True
+                self.retry.start()
+        for job, task in started:
+            self.executor.submit(self.run, job, task)
+
+    def retry_dispatch(self):
+        with self.lock:
+            self.retry = None
+        try:
+            self.dispatch()
+        except RuntimeError:
+            # Executor shut down.
+            pass
+
+    def run(self, job, task):
+        if not task.future.set_running_or_notify_cancel():
+            # Cancelled while it was queued.
+            self.finish(job, task)
+            return
+        # Time spent queued does not count, see latency.first_answer().
+        task.future.started = time()
+        try:
+            result = task.fn(*task.args, **task.kwargs)
+        except BaseException as err:
+            self.finish(job, task)
+            task.future.set_exception(err)
+        else:
+            self.finish(job, task)
+            task.future.set_result(result)
+
+    def finish(self, job, task):
+        with self.lock:
+            self.running -= 1
+            job.running -= 1
+            job.completed += 1
+            if task.host is not None:
+                self.hosts[task.host] -= 1
+                if not self.hosts[task.host]:
+                    del self.hosts[task.host]
+                if task.slot is not None:
+                    self.slots.release(task.host, task.slot)
+            if not job.queue and not job.running:
+                self.jobs.remove(job)
+        job.pending.release()
+        self.dispatch()
+
+    def summary(self):
+        with self.lock:
+            return {"running": self.running, "hosts": len(self.hosts),
+                    "jobs": [job.summary() for job in self.jobs]}
+
+
+def get_host_slots():
+    """Return the process-wide HostSlots, or None without fcntl."""
+    global _slots
+    if fcntl is None:
+        return None
+    with _lock:
+        if _slots is None:
+            try:
+                _slots = HostSlots()
+            except OSError:
+                # Lock directory not usable, budgets stay per process.
+                return None
+        return _slots
+
+
+def _forget():
+    # Locks are not inherited by forked processes.
+    global _slots, _lock
+    _slots = None
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget)
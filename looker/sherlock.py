@@ -7,51 +7,30 @@ This module contains the main logic to search for usernames at social
 networks.
 """
 
-import csv
 import json
 import os
-import platform
 import re
 import sys
 import random
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
-from concurrent.futures import ThreadPoolExecutor
-from time import time
+from functools import partial
 
 import requests
 from colorama import Fore, Style, init
 
-from requests_futures.sessions import FuturesSession
+from looker.latency import WINDOW, first_answer, get_latency_history, probe_settings
+from looker.markers import site_markers
+from looker.pool import RunStats, get_hedge_session, get_pool, get_session
+from looker.profiling import SAMPLE_INTERVAL, enable, get_profiler, span
+from looker.probe import HEADERS, PreparedUsername, prepare_headers, prepare_sites, send_probe
+from looker.resolver import get_resolver, site_hosts
 
 module_name = "Sherlock: Find Usernames Across Social Networks"
 __version__ = "0.7.8"
 amount = 0
 
-
-class ElapsedFuturesSession(FuturesSession):
-    """
-    Extends FutureSession to add a response time metric to each request.
-
-    This is taken (almost) directly from here: https://github.com/ross/requests-futures#working-in-the-background
-    """
-
-    def request(self, method, url, hooks={}, *args, **kwargs):
-        start = time()
-
-        def timing(r, *args, **kwargs):
-            elapsed_sec = time() - start
-            r.elapsed = round(elapsed_sec * 1000)
-
-        try:
-            if isinstance(hooks['response'], (list, tuple)):
-                # needs to be first so we don't time other hooks execution
-                hooks['response'].insert(0, timing)
-            else:
-                hooks['response'] = [timing, hooks['response']]
-        except KeyError:
-            hooks['response'] = timing
-
-        return super(ElapsedFuturesSession, self).request(method, url, hooks=hooks, *args, **kwargs)
+_parser = None
+_site_data = {}
 
 
 def print_info(title, info):
@@ -61,6 +40,12 @@ def print_info(title, info):
           Fore.WHITE + f" {info}" +
           Fore.GREEN + " on:")
 
+def print_summary(title, summary):
+    print(Style.BRIGHT + Fore.GREEN + "[" +
+          Fore.YELLOW + "*" +
+          Fore.GREEN + f"] {title}:" +
+          Fore.WHITE + " " + ", ".join(f"{key}={value}" for key, value in summary.items()))
+
 def print_error(err, errstr, var, verbose=False):
     print(Style.BRIGHT + Fore.WHITE + "[" +
           Fore.RED + "-" +
@@ -128,7 +113,49 @@ def get_response(request_future, error_type, social_network, verbose=False, retr
     return None, "", -1
 
 
-def sherlock(username, site_data, verbose=False, tor=False, unique_tor=False, proxy=None, print_found_only=False):
+def detect(error_type, net_info, r):
+    """Detect Username Existence.
+
+    Keyword Arguments:
+    error_type             -- String with detection method of the site, or
+                              "" if the request failed.
+    net_info               -- Dictionary with data of the site.
+    r                      -- Response of the site.
+
+    Return Value:
+    String "yes" if the username exists, "no" if it does not, "error" if
+    it could not be checked.
+    """
+    if error_type == "message":
+        # Checks which markers (errorMsg, presenceMsg) are in the HTML. The
+        # probe usually scanned the page while downloading it already.
+        verdict = getattr(r, "marker_verdict", None)
+        if verdict is None:
+            verdict = site_markers(net_info, r.encoding).verdict(r.content)
+        return verdict
+
+    elif error_type == "status_code":
+        # Checks if the status code of the response is 2XX
+        if not r.status_code >= 300 or r.status_code < 200:
+            return "yes"
+        return "no"
+
+    elif error_type == "response_url":
+        # For this detection method, we have turned off the redirect.
+        # So, there is no need to check the response URL: it will always
+        # match the request.  Instead, we will ensure that the response
+        # code indicates that the request was successful (i.e. no 404, or
+        # forward to some odd redirect).
+        if 200 <= r.status_code < 300:
+            return "yes"
+        return "no"
+
+    return "error"
+
+
+def sherlock(username, site_data, verbose=False, tor=False, unique_tor=False, proxy=None, print_found_only=False,
+             stats=None, http2=False, circuit_pool=None, fingerprints=None, on_result=None, cached=None,
+             archive=None, job=None, budget=None, transport=None):
     """Run Sherlock Analysis.
 
     Checks for existence of username on various social media sites.
@@ -141,6 +168,40 @@ def sherlock(username, site_data, verbose=False, tor=False, unique_tor=False, pr
     tor                    -- Boolean indicating whether to use a tor circuit for the requests.
     unique_tor             -- Boolean indicating whether to use a new tor circuit for each request.
     proxy                  -- String indicating the proxy URL
+    print_found_only       -- Boolean indicating whether to skip printing
+                              sites where the username was not found.
+    stats                  -- RunStats object to account the probes of
+                              this run in (optional).
+    http2                  -- Boolean indicating whether to multiplex the
+                              requests over HTTP/2 where sites support it
+                              (needs httpx[http2]).
+    circuit_pool           -- CircuitPool to send the requests over
+                              (optional).  Created automatically for tor
+                              and unique_tor.
+    fingerprints           -- Dictionary of Fingerprint objects of the
+                              pages of unclaimed usernames, keyed by site
+                              (see fingerprint.calibrate()).  Pages looking
+                              the same are reported as not found.
+    on_result              -- Function called with (social_network,
+                              results_site) as soon as the result of a
+                              site is known (optional).
+    cached                 -- Dictionary of still valid results of earlier
+                              runs, keyed by site (see
+                              ResultIndex.fresh_results()).  These sites
+                              are not probed again; their results have
+                              "cached" set.
+    archive                -- ArchiveWriter every probe is recorded in
+                              (optional).  Pages of "message" sites are
+                              then downloaded up to archive.BODY_PREFIX.
+    job                    -- Job of the worker pool the probes belong to
+                              (optional, see ProbePool.job()).
+    budget                 -- Budget capping bytes and requests of the run
+                              (optional).  Sites which do not fit have
+                              "exists" set to "skipped".
+    transport              -- Object answering the probes instead of the
+                              network, with send(host, request, settings)
+                              as looker.http2.H2Transport (optional,
+                              see looker.tests.offline).
 
     Return Value:
     Dictionary containing results from report.  Key of dictionary is the name
@@ -161,96 +222,144 @@ def sherlock(username, site_data, verbose=False, tor=False, unique_tor=False, pr
     # A user agent is needed because some sites don't
     # return the correct information since they think that
     # we are bots
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.12; rv:55.0) Gecko/20100101 Firefox/55.0'
-    }
+    headers = HEADERS
 
-    # Allow 1 thread for each external service, so `len(site_data)` threads total
-    executor = ThreadPoolExecutor(max_workers=len(site_data))
+    # Worker threads and connections are shared by all runs in the process
+    pool = get_pool()
+    if stats is None:
+        stats = RunStats()
 
     # Create session based on request methodology
-    underlying_session = requests.session()
-    underlying_request = requests.Request()
-    if tor or unique_tor:
-        underlying_request = TorRequest()
-        underlying_session = underlying_request.session
-
-    # Create multi-threaded session for all requests. Use our custom FuturesSession that exposes response time
-    session = ElapsedFuturesSession(
-        executor=executor, session=underlying_session)
+    underlying_session = get_session()
+    # Duplicates of slow probes go over connections of their own
+    hedge_session = get_hedge_session()
+    if circuit_pool is None and (tor or unique_tor):
+        from looker.tor import get_circuit_pool
+
+        # Tor builds an isolated circuit for every set of SOCKS credentials,
+        # so unique_tor goes round-robin over pre-built circuits instead of
+        # resetting the identity after every request.
+        circuit_pool = get_circuit_pool(pool, underlying_session, unique=unique_tor)
+    if circuit_pool is not None:
+        # Hedged duplicates go through the circuits too.
+        circuit_pool.attach(underlying_session)
+        circuit_pool.attach(hedge_session)
+
+    # Optional subsystems are only imported by the runs which use them.
+    if fingerprints:
+        from looker.fingerprint import PREFIX_BYTES, Fingerprint
+    if archive is not None:
+        from looker.archive import BODY_PREFIX
+    if budget is not None:
+        from looker.budget import OverBudget
+
+    # Site URL templates are parsed once per process, the username is
+    # encoded and the headers are merged once per run.
+    with span("prepare"):
+        prepared_sites = prepare_sites(site_data)
+        prepared_username = PreparedUsername(username)
+        prepared_headers = prepare_headers(underlying_session, headers)
+
+        # Resolve all site hosts at once, connections then use cached addresses.
+        # Over a proxy the proxy resolves the hosts instead.
+        resolver = get_resolver()
+        if proxy is None and circuit_pool is None and transport is None:
+            resolver.prefetch(site_hosts({social_network: site for social_network, site in prepared_sites.items()
+                                          if not cached or social_network not in cached}))
+
+    http2_transport = transport
+    if transport is None and http2 and proxy is None and circuit_pool is None:
+        # httpx is only imported when HTTP/2 is asked for.
+        from looker.http2 import get_http2_transport
+        http2_transport = get_http2_transport()
+        if http2_transport is None:
+            print_error("httpx[http2] is not installed", "HTTP/2 unavailable:", "using HTTP/1.1", verbose)
 
     # Results from analysis of all sites
     results_total = {}
+    soft404 = 0
 
-    # First create futures for all requests. This allows for the requests to run in parallel
-    for social_network, net_info in site_data.items():
+    # Deadlines and hedging of slow probes come from the response times of
+    # earlier runs
+    latency = get_latency_history()
+    hedges = {"sent": 0, "won": 0}
 
-        # Results from analysis of this specific site
-        results_site = {}
-
-        # Record URL of main site
-        results_site['url_main'] = net_info.get("urlMain")
-
-        # Don't make request if username is invalid for the site
-        regex_check = net_info.get("regexCheck")
-        if regex_check and re.search(regex_check, username) is None:
-            # No need to do the check at the site: this user name is not allowed.
-            print_invalid(social_network, "Illegal Username Format For This Site!")
-            results_site["exists"] = "illegal"
-            results_site["url_user"] = ""
-            results_site['http_status'] = ""
-            results_site['response_text'] = ""
-            results_site['response_time_ms'] = ""
-        else:
-            # URL of user on site (if it exists)
-            url = net_info["url"].format(username)
-            results_site["url_user"] = url
-            url_probe = net_info.get("urlProbe")
-            if url_probe is None:
-                #Probe URL is normal one seen by people out on the web.
-                url_probe = url
-            else:
-                #There is a special URL for probing existence separate
-                #from where the user profile normally can be found.
-                url_probe = url_probe.format(username)
-
-            request_method = session.get
-            if social_network != "GitHub":
-                # If only the status_code is needed don't download the body
-                if net_info["errorType"] == 'status_code':
-                    request_method = session.head
-
-            if net_info["errorType"] == "response_url":
-                # Site forwards request to a different URL if username not
-                # found.  Disallow the redirect so we can capture the
-                # http status from the original URL request.
-                allow_redirects = False
-            else:
-                # Allow whatever redirect that the site wants to do.
-                # The final result of the request will be what is available.
-                allow_redirects = True
-
-            # This future starts running the request in a new thread, doesn't block the main thread
-            if proxy != None:
-                proxies = {"http": proxy, "https": proxy}
-                future = request_method(url=url_probe, headers=headers,
-                                        proxies=proxies,
-                                        allow_redirects=allow_redirects
-                                        )
+    # First create futures for all requests. This allows for the requests to run in parallel
+    with span("submit"):
+        for social_network, net_info in site_data.items():
+
+            # Results from analysis of this specific site
+            results_site = {}
+
+            # Record URL of main site
+            results_site['url_main'] = net_info.get("urlMain")
+
+            # Don't make request if username is invalid for the site
+            regex_check = net_info.get("regexCheck")
+            if regex_check and re.search(regex_check, username) is None:
+                # No need to do the check at the site: this user name is not allowed.
+                print_invalid(social_network, "Illegal Username Format For This Site!")
+                results_site["exists"] = "illegal"
+                results_site["url_user"] = ""
+                results_site['http_status'] = ""
+                results_site['response_text'] = ""
+                results_site['response_time_ms'] = ""
+            elif cached and social_network in cached:
+                # Result of an earlier run with the same site definition.
+                results_site.update(cached[social_network], cached=True)
+                if results_site["exists"] == "yes":
+                    print_found(social_network, results_site["url_user"], results_site["response_time_ms"], verbose)
+                    amount = amount+1
             else:
-                future = request_method(url=url_probe, headers=headers,
-                                        allow_redirects=allow_redirects
-                                        )
-
-            # Store future in data for access later
-            net_info["request_future"] = future
-
-            # Reset identify for tor (if needed)
-            if unique_tor:
-                underlying_request.reset_identity()
-
-        # Add this site's results into final dictionary with all of the other results.
-        results_total[social_network] = results_site
+                site = prepared_sites[social_network]
+
+                # URL of user on site (if it exists)
+                results_site["url_user"] = site.user_url(prepared_username)
+
+                settings = probe_settings(site, underlying_session, proxy)
+                if circuit_pool is not None:
+                    tor_proxy = circuit_pool.proxy_for(site.host)
+                    settings = dict(settings, proxies={"http": tor_proxy, "https": tor_proxy})
+
+                # With a fingerprint of the "not found" page only the beginning of
+                # the page is needed, message sites need the whole page anyway.
+                body_limit = None
+                if fingerprints and social_network in fingerprints and net_info["errorType"] != "message":
+                    body_limit = PREFIX_BYTES
+
+                keep_bytes = BODY_PREFIX if archive is not None else None
+
+                # With a budget the probe is reserved when a worker starts it,
+                # probes which do not fit raise OverBudget.
+                send = send_probe
+                if budget is not None:
+                    send = partial(budget.send, social_network,
+                                   "GET" if body_limit is not None else site.method,
+                                   net_info["errorType"], send_probe)
+
+                # This future starts running the request in a new thread, doesn't block the main thread
+                future = pool.submit(send, underlying_session, site,
+                                     prepared_username, prepared_headers, settings,
+                                     http2=http2_transport, body_limit=body_limit, keep_bytes=keep_bytes,
+                                     stats=stats, job=job, host=site.host)
+
+                def hedge(site=site, send=send, settings=settings, body_limit=body_limit,
+                          keep_bytes=keep_bytes):
+                    # Over a fresh connection, and over Tor a fresh circuit
+                    if circuit_pool is not None:
+                        tor_proxy = circuit_pool.proxy_for()
+                        settings = dict(settings, proxies={"http": tor_proxy, "https": tor_proxy})
+                    return pool.submit(send, hedge_session, site,
+                                       prepared_username, prepared_headers, settings, http2=transport,
+                                       body_limit=body_limit, keep_bytes=keep_bytes, stats=stats,
+                                       job=job, host=site.host)
+
+                # Store future in data for access later
+                net_info["request_future"] = future
+                net_info["request_hedge"] = hedge
+
+            # Add this site's results into final dictionary with all of the other results.
+            results_total[social_network] = results_site
 
     # Open the file containing account links
     # Core logic: If tor requests, make them here. If multi-threaded requests, wait for responses
@@ -264,6 +373,8 @@ def sherlock(username, site_data, verbose=False, tor=False, unique_tor=False, pr
         exists = results_site.get("exists")
         if exists is not None:
             # We have already determined the user doesn't exist here
+            if on_result is not None and exists != "skipped":
+                on_result(social_network, results_site)
             continue
 
         # Get the expected error type
@@ -273,67 +384,67 @@ def sherlock(username, site_data, verbose=False, tor=False, unique_tor=False, pr
         http_status = "?"
         response_text = ""
 
-        # Retrieve future and ensure it has finished
-        future = net_info["request_future"]
-        r, error_type, response_time = get_response(request_future=future,
-                                                    error_type=error_type,
-                                                    social_network=social_network,
-                                                    verbose=verbose,
-                                                    retry_no=3)
-
-        # Attempt to get request information
-        try:
-            http_status = r.status_code
-        except:
-            pass
-        try:
-            response_text = r.text.encode(r.encoding)
-        except:
-            pass
-
-        if error_type == "message":
-            error = net_info.get("errorMsg")
-            # Checks if the error message is in the HTML
-            if not error in r.text:
-                print_found(social_network, url, response_time, verbose)
-                exists = "yes"
-                amount = amount+1
-            else:
+        # Retrieve future and ensure it has finished, sending a duplicate
+        # request if it takes longer than usual for this site
+        with span("wait"):
+            future, hedged = first_answer(net_info["request_future"], latency.hedge_after(social_network),
+                                          net_info["request_hedge"])
+            if hedged:
+                hedges["sent"] += 1
+                if future is not net_info["request_future"]:
+                    hedges["won"] += 1
+            if budget is not None and isinstance(future.exception(), OverBudget):
+                # Over budget, the run goes on with the sites it can afford
+                results_site.update(exists="skipped", http_status="", response_text="",
+                                    response_time_ms="")
                 if not print_found_only:
-                    print_not_found(social_network, response_time, verbose)
-                exists = "no"
+                    print_invalid(social_network, "Skipped, over budget")
+                continue
+            r, error_type, response_time = get_response(request_future=future,
+                                                        error_type=error_type,
+                                                        social_network=social_network,
+                                                        verbose=verbose,
+                                                        retry_no=3)
+
+        if r is not None:
+            latency.record(social_network, response_time)
 
-        elif error_type == "status_code":
-            # Checks if the status code of the response is 2XX
-            if not r.status_code >= 300 or r.status_code < 200:
+        # Attempt to get request information
+        with span("decode"):
+            try:
+                http_status = r.status_code
+            except:
+                pass
+            try:
+                response_text = r.text.encode(r.encoding)
+            except:
+                pass
+
+        if r is not None:
+            stats.on_transfer(social_network, getattr(r, "compressed_bytes", 0),
+                              getattr(r, "decompressed_bytes", 0))
+
+        with span("classify"):
+            exists = detect(error_type, net_info, r)
+            if exists == "yes" and fingerprints and social_network in fingerprints:
+                # Generic page which the site shows for unknown users (soft 404)
+                if fingerprints[social_network].matches(Fingerprint.from_response(r, username)):
+                    exists = "no"
+                    soft404 += 1
+        with span("output"):
+            if archive is not None:
+                archive.record(social_network, username, r,
+                               method=r.request.method if r is not None else None, exists=exists,
+                               request_url=prepared_sites[social_network].probe_url(prepared_username))
+            if exists == "yes":
                 print_found(social_network, url, response_time, verbose)
-                exists = "yes"
                 amount = amount+1
-            else:
+            elif exists == "no":
                 if not print_found_only:
                     print_not_found(social_network, response_time, verbose)
-                exists = "no"
-
-        elif error_type == "response_url":
-            # For this detection method, we have turned off the redirect.
-            # So, there is no need to check the response URL: it will always
-            # match the request.  Instead, we will ensure that the response
-            # code indicates that the request was successful (i.e. no 404, or
-            # forward to some odd redirect).
-            if 200 <= r.status_code < 300:
-                #
-                print_found(social_network, url, response_time, verbose)
-                exists = "yes"
-                amount = amount+1
             else:
                 if not print_found_only:
-                    print_not_found(social_network, response_time, verbose)
-                exists = "no"
-
-        elif error_type == "":
-            if not print_found_only:
-                print_invalid(social_network, "Error!")
-            exists = "error"
+                    print_invalid(social_network, "Error!")
 
         # Save exists flag
         results_site['exists'] = exists
@@ -345,12 +456,38 @@ def sherlock(username, site_data, verbose=False, tor=False, unique_tor=False, pr
 
         # Add this site's results into final dictionary with all of the other results.
         results_total[social_network] = results_site
+        if on_result is not None:
+            on_result(social_network, results_site)
+
+    if archive is not None:
+        archive.flush()
+
+    if budget is not None and (verbose or budget.exhausted):
+        print_summary("Budget", budget.report())
+
+    if verbose:
+        print_summary("Run summary", stats.summary())
+        transfers = stats.transfer_summary()
+        largest = sorted(transfers, key=lambda site: transfers[site]["compressed_bytes"], reverse=True)[:5]
+        for social_network in largest:
+            print_summary(f"Transfer {social_network}", transfers[social_network])
+        print_summary("DNS", resolver.summary())
+        if http2_transport is not None:
+            print_summary("HTTP/2" if transport is None else "Transport", http2_transport.summary())
+        if circuit_pool is not None:
+            print_summary("Tor", circuit_pool.summary())
+        print_summary("Hedging", dict(hedges, **latency.summary()))
+        if fingerprints:
+            print_summary("Soft 404", {"calibrated": len(fingerprints), "detected": soft404})
     return results_total
 
 
-def main(k_user):
-    # Colorama module's initialization.
-    init(autoreset=True)
+def build_parser():
+    # Only needed for --version.
+    import platform
+
+    from looker.budget import parse_size
+    from looker.warmup import RATE
 
     version_string = f"%(prog)s {__version__}\n" +  \
                      f"{requests.__description__}:  {requests.__version__}\n" + \
@@ -369,7 +506,7 @@ def main(k_user):
                         )
     parser.add_argument("--rank", "-r",
                         action="store_true", dest="rank", default=False,
-                        help="Present websites ordered by their Alexa.com global rank in popularity.")
+                        help="Present websites ordered by their global rank in popularity; popular sites are also probed first.")
     parser.add_argument("--folderoutput", "-fo", dest="folderoutput",
                         help="If using multiple usernames, the output of the results will be saved at this folder."
                         )
@@ -381,7 +518,7 @@ def main(k_user):
                         help="Make requests over Tor; increases runtime; requires Tor to be installed and in system path.")
     parser.add_argument("--unique-tor", "-u",
                         action="store_true", dest="unique_tor", default=False,
-                        help="Make requests over Tor with new Tor circuit after each request; increases runtime; requires Tor to be installed and in system path.")
+                        help="Make requests over Tor with a different, regularly replaced Tor circuit for each request; requires Tor to be installed and in system path.")
     parser.add_argument("--csv",
                         action="store_true",  dest="csv", default=False,
                         help="Create Comma-Separated Values (CSV) File."
@@ -408,27 +545,152 @@ def main(k_user):
                              "The script will check if the proxies supplied in the .csv file are working and anonymous."
                              "Put 0 for no limit on successfully checked proxies, or another number to institute a limit."
                         )
+    parser.add_argument("--dns-cache", metavar="DNS_CACHE_FILE",
+                        action="store", dest="dns_cache", default=None,
+                        help="Share resolved site addresses with other processes through this file."
+                        )
+    parser.add_argument("--http2",
+                        action="store_true", dest="http2", default=False,
+                        help="Multiplex requests over HTTP/2 on sites which support it; requires httpx[http2]."
+                        )
+    parser.add_argument("--soft404",
+                        action="store_true", dest="soft404", default=False,
+                        help="Compare pages with the page of a username which does not exist, to detect sites showing a generic page instead of an error."
+                        )
     parser.add_argument("--print-found",
                         action="store_true", dest="print_found_only", default=False,
                         help="Do not output sites where the username was not found."
                         )
-    args = parser.parse_args()
+    parser.add_argument("--index", metavar="INDEX_FILE",
+                        action="store", dest="index", default=None,
+                        help="Store results in this SQLite index; results.sqlite in the output folder by default."
+                        )
+    parser.add_argument("--incremental",
+                        action="store_true", dest="incremental", default=False,
+                        help="Only probe sites whose definition changed, or whose result in the index is missing or expired."
+                        )
+    parser.add_argument("--max-age", metavar="DAYS", type=float,
+                        action="store", dest="max_age", default=7,
+                        help="Days after which results in the index expire for --incremental."
+                        )
+    parser.add_argument("--archive", metavar="ARCHIVE_FILE",
+                        action="store", dest="archive", default=None,
+                        help="Record every response into this archive, for replaying it later with python -m looker.archive."
+                        )
+    parser.add_argument("--target", metavar="TARGET_NAME",
+                        action="append", dest="targets", default=None,
+                        help="Name of the person the username was generated for, stored in the index.  Add multiple options to specify more than one target."
+                        )
+    parser.add_argument("--max-bytes", metavar="SIZE", type=parse_size,
+                        action="store", dest="max_bytes", default=None,
+                        help="Transfer at most this many bytes per run (suffixes K, M, G); pages of sites decided by the status code are cut short as the budget shrinks, sites which do not fit are skipped."
+                        )
+    parser.add_argument("--max-requests", metavar="REQUESTS", type=int,
+                        action="store", dest="max_requests", default=None,
+                        help="Send at most this many requests per run."
+                        )
+    parser.add_argument("--max-site-requests", metavar="REQUESTS", type=int,
+                        action="store", dest="max_site_requests", default=None,
+                        help="Send at most this many requests to one site per run, duplicates of slow probes included."
+                        )
+    parser.add_argument("--warm", metavar="CONNECTIONS", type=int,
+                        action="store", dest="warm", default=0,
+                        help="Open this many connections to every site host before probing starts and keep them open during the sweep."
+                        )
+    parser.add_argument("--warm-rate", metavar="PER_SECOND", type=float,
+                        action="store", dest="warm_rate", default=RATE,
+                        help="Connections opened per second at most by --warm."
+                        )
+    parser.add_argument("--profile", metavar="PROFILE_FOLDER",
+                        action="store", dest="profile", default=None,
+                        help="Write the time spent per stage of every run into this folder, as JSON and as folded stacks for flamegraphs."
+                        )
+    parser.add_argument("--profile-sample",
+                        action="store_true", dest="profile_sample", default=False,
+                        help="With --profile, also sample the stacks of all threads."
+                        )
+    parser.add_argument("--profile-allocations",
+                        action="store_true", dest="profile_allocations", default=False,
+                        help="With --profile, also account the memory allocated per stage; slow."
+                        )
+    return parser
+
+
+def get_parser():
+    """Return the command line parser, built once per process."""
+    global _parser
+    if _parser is None:
+        _parser = build_parser()
+    return _parser
+
+
+def load_site_data(data_file_path):
+    """Return the site data of a JSON file, loaded once per process."""
+    site_data = _site_data.get(data_file_path)
+    if site_data is None:
+        with open(data_file_path, "r", encoding="utf-8") as raw:
+            site_data = _site_data[data_file_path] = json.load(raw)
+    return site_data
+
+
+def main(k_user, argv=None, transport=None):
+    # Colorama module's initialization.
+    init(autoreset=True)
+
+    args = get_parser().parse_args(argv)
     print("tutaj")
     args.username = [k_user]
 
+    if args.dns_cache:
+        get_resolver(cache_path=args.dns_cache)
+
+    if args.profile:
+        enable(SAMPLE_INTERVAL if args.profile_sample else None, allocations=args.profile_allocations)
+
     data_file_path = "data.json"
 
-    raw = open(data_file_path, "r", encoding="utf-8")
-    site_data_all = json.load(raw)
+    with span("load"):
+        site_data_all = load_site_data(data_file_path)
 
     site_data = site_data_all
+    if args.rank:
+        from looker.site_list import rank_order
+
+        # Probes start in the order of the site data.
+        site_data = rank_order(site_data_all)
+
+    # Connections to all hosts are opened once per process, at a limited
+    # rate, and re-opened in the background when servers close them.
+    warmer = None
+    if args.warm and args.proxy is None and not (args.tor or args.unique_tor):
+        from looker.warmup import get_warmer
+
+        warmer = get_warmer(args.warm, args.warm_rate)
+        with span("warmup"):
+            warmer.warm_up(prepare_sites(site_data))
+        warmer.start()
+
+    # Pages of unclaimed usernames are fetched once per process.
+    fingerprints = None
+    if args.soft404:
+        from looker.fingerprint import calibrate
+
+        fingerprints = calibrate(site_data)
+
+    from looker.index import get_index, site_hashes
+
+    archive = None
+    if args.archive:
+        from looker.archive import get_archive
+
+        archive = get_archive(args.archive)
 
     # Run report on all specified users.
     for username in args.username:
         print()
 
 
-        args.folderoutput = "./output"
+        args.folderoutput = args.folderoutput or "./output"
         if not os.path.isdir(args.folderoutput):
             os.mkdir(args.folderoutput)
         file = open(os.path.join(args.folderoutput,username + ".txt"), "w", encoding="utf-8")
@@ -441,17 +703,60 @@ def main(k_user):
         except (NameError, IndexError):
             proxy = args.proxy
 
+        # Results go into the index while they come in.
+        index = get_index(args.index or os.path.join(args.folderoutput, "results.sqlite"))
+        run_id = index.current_run()
+        latency = get_latency_history()
+        if not latency.seeded:
+            latency.seed(index.latencies(WINDOW))
+
+        hashes = site_hashes(site_data)
+        cached = None
+        if args.incremental:
+            cached = index.fresh_results(username, hashes, max_age=args.max_age * 24 * 3600)
+
+        def on_result(social_network, results_site):
+            if not results_site.get("cached"):
+                index.add(run_id, username, social_network, results_site, hashes[social_network])
+
+        budget = None
+        if args.max_bytes is not None or args.max_requests is not None or args.max_site_requests is not None:
+            from looker.budget import Budget
+
+            budget = Budget(args.max_bytes, args.max_requests, args.max_site_requests)
+
         results = {}
-        results = sherlock(username, site_data, verbose=args.verbose,
-                           tor=args.tor, unique_tor=args.unique_tor, proxy=args.proxy, print_found_only=args.print_found_only)
+        with span("run"):
+            results = sherlock(username, site_data, verbose=args.verbose,
+                               tor=args.tor, unique_tor=args.unique_tor, proxy=args.proxy, print_found_only=args.print_found_only,
+                               http2=args.http2, fingerprints=fingerprints, on_result=on_result, cached=cached,
+                               archive=archive, budget=budget,
+                               transport=transport)
+        with span("index"):
+            index.flush()
+            if args.targets:
+                index.link_targets(username, args.targets)
         exists_counter = 0
-        for website_name in results:
-            dictionary = results[website_name]
-            if dictionary.get("exists") == "yes":
-                exists_counter += 1
-                file.write(dictionary["url_user"] + "\n")
-        file.write("Total Websites : {}".format(exists_counter))
-        file.close()
+        with span("output"):
+            for website_name in results:
+                dictionary = results[website_name]
+                if dictionary.get("exists") == "yes":
+                    exists_counter += 1
+                    file.write(dictionary["url_user"] + "\n")
+            file.write("Total Websites : {}".format(exists_counter))
+            file.close()
+
+        if warmer is not None and args.verbose:
+            print_summary("Warm-up", warmer.summary())
+
+        if args.profile:
+            # One breakdown per run
+            profiler = get_profiler()
+            profiler.write(os.path.join(args.profile, username))
+            if args.verbose:
+                for stage, summary in profiler.summary()["stages"].items():
+                    print_summary(f"Stage {stage}", summary)
+            profiler.reset()
         if (exists_counter < 1):
             status = 0
         else:
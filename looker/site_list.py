@@ -1,74 +1,285 @@
 """Sherlock: Supported Site Listing
 This module generates the listing of supported sites.
+
+    python site_list.py                        sites.md from data.json
+    python site_list.py --rank                 also update the ranks
+    python site_list.py --rank --rank-file top-1m.csv
+                                               ranks from a local list
+
+Ranks come from a RankProvider: the Alexa.com API or a local list of
+"rank,domain" lines (Alexa and Tranco top-1m files), for offline use.
+Ranks are cached in a JSON file and only fetched again once expired;
+a site whose rank cannot be fetched keeps the rank it had.
+data.json and sites.md are only written when their content changed.
 """
 import json
+import os
+from abc import ABC, abstractmethod
 import sys
-import requests
 import threading
 import xml.etree.ElementTree as ET
-from datetime import datetime
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import time
+from urllib.parse import urlsplit
 
-pool = list()
+DEFAULT_CACHE = os.path.join("output", "ranks.json")
 
-def get_rank(domain_to_query, dest):
-    result = -1
+# Days after which cached ranks are fetched again.
+MAX_AGE_DAYS = 30
 
-    #Retrieve ranking data via alexa API
-    url = f"http://data.alexa.com/data?cli=10&url={domain_to_query}"
-    xml_data = requests.get(url).text
-    root = ET.fromstring(xml_data)
-    try:
-        #Get ranking for this site.
-        dest['rank'] = int(root.find(".//REACH").attrib["RANK"])
-    except:
-        #We did not find the rank for some reason.
-        print(f"Error retrieving rank information for '{domain_to_query}'")
-        print(f"     Returned XML is |{xml_data}|")
-
-    return
-
-parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter
-                        )
-parser.add_argument("--rank","-r",
-                    action="store_true",  dest="rank", default=False,
-                    help="Update all website ranks (not recommended)."
-                    )
-args = parser.parse_args()
-
-with open("data.json", "r", encoding="utf-8") as data_file:
-    data = json.load(data_file)
-
-with open("sites.md", "w") as site_file:
-    data_length = len(data)
-    site_file.write(f'## List Of Supported Sites ({data_length} Sites In Total!)\n')
-
-    for social_network in data:
-        url_main = data.get(social_network).get("urlMain")
-        data.get(social_network)["rank"] = 0
-        if args.rank:
-            th = threading.Thread(target=get_rank, args=(url_main, data.get(social_network)))
+# Rank lookups running at the same time.
+WORKERS = 8
+
+# Seconds to wait for the rank API, and times a failed lookup is retried.
+TIMEOUT = 10
+RETRIES = 3
+
+
+def site_domain(url_main):
+    """Return domain of a site, without "www."."""
+    host = urlsplit(url_main).hostname or ""
+    return host[4:] if host.startswith("www.") else host
+
+
+class RankProvider(ABC):
+    """Source of the global popularity rank of domains."""
+
+    # Host the provider talks to, None for local providers.
+    host = None
+
+    # Name shown in sites.md.
+    name = "Unknown"
+
+    @abstractmethod
+    def rank(self, domain):
+        """Return rank of domain, or None if it has none."""
+
+
+class AlexaProvider(RankProvider):
+    """Ranks of the Alexa.com API."""
+
+    host = "data.alexa.com"
+    name = "Alexa.com"
+
+    def __init__(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.session = requests.session()
+        self.session.mount("http://", HTTPAdapter(max_retries=Retry(total=RETRIES, backoff_factor=0.5,
+                                                                    status_forcelist=(429, 500, 502, 503, 504))))
+
+    def rank(self, domain):
+        url = f"http://{self.host}/data?cli=10&url={domain}"
+        xml_data = self.session.get(url, timeout=TIMEOUT).text
+        reach = ET.fromstring(xml_data).find(".//REACH")
+        if reach is None:
+            return None
+        return int(reach.attrib["RANK"])
+
+
+class FileProvider(RankProvider):
+    """Ranks of a local list with "rank,domain" lines, or a JSON {domain: rank}."""
+
+    name = "Local list"
+
+    def __init__(self, path):
+        self.name = os.path.basename(path)
+        self.ranks = {}
+        with open(path, "r", encoding="utf-8-sig") as raw:
+            if path.endswith(".json"):
+                self.ranks = {domain: int(rank) for domain, rank in json.load(raw).items()}
+                return
+            for line in raw:
+                rank, _, domain = line.strip().partition(",")
+                if rank.isdigit() and domain:
+                    # First (best) rank of a domain wins.
+                    self.ranks.setdefault(domain.lower(), int(rank))
+
+    def rank(self, domain):
+        return self.ranks.get(domain) or self.ranks.get("www." + domain)
+
+
+class RankCache:
+    """Ranks fetched earlier, with the time they were fetched."""
+
+    def __init__(self, path=DEFAULT_CACHE, max_age=MAX_AGE_DAYS * 24 * 3600):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.changed = False
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as raw:
+                self.entries = json.load(raw)
+
+    def get(self, key, now=None):
+        """Return (rank,) if key has a fresh entry, otherwise None."""
+        now = time() if now is None else now
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or now - entry[1] > self.max_age:
+            return None
+        return (entry[0],)
+
+    def last(self, key):
+        """Return (rank,) if key has an entry, fresh or not, otherwise None."""
+        with self.lock:
+            entry = self.entries.get(key)
+        return None if entry is None else (entry[0],)
+
+    def put(self, key, rank, now=None):
+        with self.lock:
+            self.entries[key] = [rank, time() if now is None else now]
+            self.changed = True
+
+    def fetched(self, keys):
+        """Return time the newest entry of keys was fetched at, or None."""
+        with self.lock:
+            times = [self.entries[key][1] for key in keys if key in self.entries]
+        return max(times, default=None)
+
+    def save(self):
+        if not self.path or not self.changed:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            write_if_changed(self.path, json.dumps(self.entries, indent=1, sort_keys=True))
+            self.changed = False
+
+
+def fetch_ranks(domains, provider, cache, workers=WORKERS):
+    """Return {domain: rank or None}, fetching expired ranks in a bounded pool.
+
+    A domain whose rank cannot be fetched gets its expired rank from the
+    cache, or is left out if it has none.
+
+    Keyword Arguments:
+    domains                -- Domains to rank.
+    provider               -- RankProvider to ask for expired ranks.
+    cache                  -- RankCache with the earlier ranks.
+    workers                -- Lookups running at the same time at most.
+    """
+    ranks = {}
+    missing = []
+    for domain in set(domains):
+        key = f"{provider.name}:{domain}"
+        cached = cache.get(key)
+        if cached is not None:
+            ranks[domain] = cached[0]
         else:
-            th = None
-        pool.append((social_network, url_main, th))
-        if args.rank:
-            th.start()
-
-    index = 1
-    for social_network, url_main, th in pool:
-        if args.rank:
-            th.join()
-        site_file.write(f'{index}. [{social_network}]({url_main})\n')
-        sys.stdout.write("\r{0}".format(f"Updated {index} out of {data_length} entries"))
+            missing.append(domain)
+    if not missing:
+        return ranks
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = {domain: pool.submit(provider.rank, domain) for domain in missing}
+    for done, (domain, future) in enumerate(futures.items(), 1):
+        try:
+            rank = future.result()
+        except Exception as err:
+            # Not cached, asked again next time.
+            print(f"\nError retrieving rank information for '{domain}': {err}")
+            previous = cache.last(f"{provider.name}:{domain}")
+            if previous is not None:
+                ranks[domain] = previous[0]
+            continue
+        ranks[domain] = rank
+        cache.put(f"{provider.name}:{domain}", rank)
+        sys.stdout.write(f"\rRanked {done} out of {len(futures)} domains")
         sys.stdout.flush()
-        index = index + 1
+    pool.shutdown()
+    return ranks
 
+
+def rank_order(site_data):
+    """Return site_data ordered by rank, most popular first; unranked sites last."""
+    return dict(sorted(site_data.items(),
+                       key=lambda item: (not item[1].get("rank"), item[1].get("rank") or 0)))
+
+
+def write_if_changed(path, text):
+    """Write text into path unless it already holds it; return True if written."""
+    try:
+        with open(path, "r", encoding="utf-8") as raw:
+            if raw.read() == text:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, "w", encoding="utf-8") as out:
+        out.write(text)
+    return True
+
+
+def site_listing(data, provider=None, fetched=None):
+    """Return content of sites.md."""
+    lines = [f"## List Of Supported Sites ({len(data)} Sites In Total!)"]
+    # Same order as data.json is written in.
+    for index, (social_network, net_info) in enumerate(sorted(data.items()), 1):
+        lines.append(f"{index}. [{social_network}]({net_info.get('urlMain')})")
+    if provider is not None and fetched is not None:
+        stamp = datetime.fromtimestamp(fetched, timezone.utc).replace(tzinfo=None)
+        lines.append(f"\n{provider.name} rank data fetched at ({stamp} UTC)")
+    return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
+                            description="Generate the listing of supported sites.")
+    parser.add_argument("--rank", "-r",
+                        action="store_true", dest="rank", default=False,
+                        help="Update all website ranks.")
+    parser.add_argument("--rank-file", metavar="RANK_FILE",
+                        dest="rank_file", default=None,
+                        help="Take ranks from this local list (\"rank,domain\" lines or JSON) instead of Alexa.com.")
+    parser.add_argument("--cache", metavar="CACHE_FILE",
+                        dest="cache", default=DEFAULT_CACHE,
+                        help="Keep fetched ranks in this file.")
+    parser.add_argument("--max-age", metavar="DAYS", type=float,
+                        dest="max_age", default=MAX_AGE_DAYS,
+                        help="Days after which cached ranks are fetched again.")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="Rank lookups running at the same time.")
+    parser.add_argument("--json", "-j", metavar="JSON_FILE",
+                        dest="json_file", default="data.json",
+                        help="Site data to list and rank.")
+    parser.add_argument("--output", "-o", metavar="MARKDOWN_FILE",
+                        dest="output", default="sites.md",
+                        help="File to write the listing into.")
+    args = parser.parse_args(argv)
+
+    with open(args.json_file, "r", encoding="utf-8") as data_file:
+        data = json.load(data_file)
+    original = json.loads(json.dumps(data))
+
+    provider = fetched = None
     if args.rank:
-        site_file.write(f'\nAlexa.com rank data fetched at ({datetime.utcnow()} UTC)\n')
+        provider = FileProvider(args.rank_file) if args.rank_file else AlexaProvider()
+        cache = RankCache(args.cache, max_age=args.max_age * 24 * 3600)
+        domains = {social_network: site_domain(net_info.get("urlMain", ""))
+                   for social_network, net_info in data.items()}
+        ranks = fetch_ranks(domains.values(), provider, cache, args.workers)
+        for social_network, domain in domains.items():
+            if domain in ranks:
+                data[social_network]["rank"] = ranks[domain] or 0
+        cache.save()
+        fetched = cache.fetched(f"{provider.name}:{domain}" for domain in domains.values())
+
+    written = []
+    if data != original:
+        with open(args.json_file, "w") as data_file:
+            data_file.write(json.dumps(data, indent=2, sort_keys=True))
+        written.append(args.json_file)
+    if write_if_changed(args.output, site_listing(data, provider, fetched)):
+        written.append(args.output)
 
-sorted_json_data = json.dumps(data, indent=2, sort_keys=True)
+    print(f"\nFinished updating supported site listing! Changed: {', '.join(written) or 'nothing'}")
 
-with open("data.json", "w") as data_file:
-    data_file.write(sorted_json_data)
 
-print("\nFinished updating supported site listing!")
+if __name__ == "__main__":
+    main()
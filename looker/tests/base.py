@@ -6,9 +6,11 @@ import json
 import os
 import os.path
 import unittest
-import sherlock
 import warnings
 
+from looker import sherlock
+from looker import validate
+
 
 class SherlockBaseTest(unittest.TestCase):
     def setUp(self):
@@ -84,6 +86,31 @@ class SherlockBaseTest(unittest.TestCase):
         #Filter all site data down to just what is needed for this test.
         site_data = self.site_data_filter(site_list)
 
+        self.pairs_check([(site, username)
+                          for username in username_list
+                          for site in site_data],
+                         exist_check=exist_check
+                        )
+
+        return
+
+    def pairs_check(self, pairs, exist_check=True):
+        """Username Exist Check For Many Sites At Once.
+
+        Keyword Arguments:
+        self                   -- This object.
+        pairs                  -- List of (site, username) tuples which are
+                                  all checked in one concurrent batch.
+        exist_check            -- Boolean which indicates if this should be
+                                  a check for Username existence,
+                                  or non-existence.
+
+        Return Value:
+        N/A.
+        Will trigger an assert if Username does not have the expected
+        existence state.
+        """
+
         if exist_check:
             check_type_text = "exists"
             exist_result_desired = "yes"
@@ -91,18 +118,12 @@ class SherlockBaseTest(unittest.TestCase):
             check_type_text = "does not exist"
             exist_result_desired = "no"
 
-        for username in username_list:
-            results = sherlock.sherlock(username,
-                                        site_data,
-                                        verbose=self.verbose,
-                                        tor=self.tor,
-                                        unique_tor=self.unique_tor
-                                       )
-            for site, result in results.items():
-                with self.subTest(f"Checking Username '{username}' "
-                                  f"{check_type_text} on Site '{site}'"
-                                 ):
-                    self.assertEqual(result['exists'], exist_result_desired)
+        results = validate.probe_pairs(self.site_data_all, pairs)
+        for (site, username), result in results.items():
+            with self.subTest(f"Checking Username '{username}' "
+                              f"{check_type_text} on Site '{site}'"
+                             ):
+                self.assertEqual(result['exists'], exist_result_desired)
 
         return
 
@@ -128,9 +149,9 @@ class SherlockBaseTest(unittest.TestCase):
         existence state.
         """
 
-        #Dictionary of sites that should be tested for having a username.
-        #This will allow us to test sites with a common username in parallel.
-        sites_by_username = {}
+        #List of (site, username) pairs that should be tested.
+        #All of them are checked in parallel in one batch.
+        pairs = []
 
         for site, site_data in self.site_data_all.items():
             if (
@@ -151,19 +172,10 @@ class SherlockBaseTest(unittest.TestCase):
                 else:
                      username = site_data.get("username_unclaimed")
 
-                # Add this site to the list of sites corresponding to this
-                # username.
-                if username in sites_by_username:
-                    sites_by_username[username].append(site)
-                else:
-                    sites_by_username[username] = [site]
+                pairs.append((site, username))
 
         # Check on the username availability against all of the sites.
-        for username, site_list in sites_by_username.items():
-            self.username_check([username],
-                                site_list,
-                                exist_check=exist_check
-                               )
+        self.pairs_check(pairs, exist_check=exist_check)
 
         return
 
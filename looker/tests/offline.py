@@ -0,0 +1,222 @@
+"""Sherlock Offline Tests
+
+Drives sherlock() through a transport which answers the probes itself,
+so the detection logic of every site can be checked without network:
+SyntheticTransport makes up the pages a site shows for its claimed and
+unclaimed usernames from its errorType, RecordedTransport answers from
+an archive of a live run (see looker.archive). Site-level cases run in
+parallel worker processes.
+
+    python -m looker.tests.offline
+"""
+import json
+import os
+import sys
+import threading
+from time import perf_counter
+
+from requests.exceptions import ConnectionError
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+from looker.archive import read_archive
+from looker.markers import marker_list
+from looker.probe import PreparedUsername, prepare_sites
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "data.json")
+
+# Sites checked per task of a worker process.
+CHUNK_SITES = 16
+
+_site_data = {}
+
+
+def make_response(request, status, body=b"", headers=None):
+    """Return requests.Response as a site would send it for request."""
+    r = Response()
+    r.status_code = status
+    r.headers = CaseInsensitiveDict({"Content-Type": "text/html; charset=utf-8",
+                                     "Content-Length": str(len(body))})
+    r.headers.update(headers or {})
+    r.encoding = "utf-8"
+    r.url = request.url
+    r.request = request
+    r._content = body if request.method != "HEAD" else b""
+    r._content_consumed = True
+    return r
+
+
+class SyntheticTransport:
+    """Answers probes with pages made up from the site data.
+
+    Usernames claimed on a site get the page of an existing account, all
+    others the answer of the site for unknown users: 404 for status_code
+    sites, the errorMsg page for message sites and a redirect for
+    response_url sites.
+    """
+
+    def __init__(self, site_data, claimed=()):
+        """Create Synthetic Transport.
+
+        Keyword Arguments:
+        site_data              -- Dictionary containing all of the site data.
+        claimed                -- Usernames claimed on every site, besides
+                                  the username_claimed of each site.
+        """
+        self.lock = threading.Lock()
+        self.sent = 0
+        # Probe URL -> (site, username claimed or not)
+        self.urls = {}
+        self.site_data = site_data
+        for social_network, site in prepare_sites(site_data).items():
+            net_info = site_data[social_network]
+            usernames = {username: True for username in claimed}
+            usernames[net_info.get("username_claimed")] = True
+            usernames[net_info.get("username_unclaimed")] = False
+            for username, exists in usernames.items():
+                if not username:
+                    continue
+                url = site.probe_url(PreparedUsername(username))
+                if url is not None:
+                    self.urls[url] = (social_network, exists)
+
+    def send(self, host, request, settings):
+        with self.lock:
+            self.sent += 1
+        social_network, exists = self.urls.get(request.url, (None, False))
+        net_info = self.site_data.get(social_network, {})
+        error_type = net_info.get("errorType", "status_code")
+
+        if error_type == "message":
+            if exists:
+                body = "<html><h1>Profile</h1>" + "".join(marker_list(net_info.get("presenceMsg"))) + "</html>"
+            else:
+                body = "<html>" + marker_list(net_info.get("errorMsg"))[0] + "</html>"
+            return make_response(request, 200, body.encode("utf-8"))
+        if error_type == "response_url" and not exists:
+            location = net_info.get("errorUrl") or net_info.get("urlMain") or "/"
+            return make_response(request, 302, headers={"Location": location})
+        if exists:
+            return make_response(request, 200, b"<html><h1>Profile</h1></html>")
+        return make_response(request, 404, b"<html>Not Found</html>")
+
+    def summary(self):
+        with self.lock:
+            return {"sent": self.sent, "urls": len(self.urls)}
+
+
+class RecordedTransport:
+    """Answers probes with the responses recorded in an archive.
+
+    Probes are looked up by the URL they were sent to, not the one they
+    were redirected to. Probes which were not recorded fail like an
+    unreachable site, they never go to the network.
+    """
+
+    def __init__(self, path):
+        self.responses = {}
+        for probe in read_archive(path):
+            if probe.request_url and probe.response() is not None:
+                self.responses[probe.request_url] = probe
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.missing = 0
+
+    def send(self, host, request, settings):
+        probe = self.responses.get(request.url)
+        with self.lock:
+            self.sent += 1
+            self.missing += probe is None
+        if probe is None:
+            raise ConnectionError(f"{request.url} was not recorded")
+        r = probe.response()
+        r.request = request
+        return r
+
+    def summary(self):
+        with self.lock:
+            return {"sent": self.sent, "missing": self.missing, "recorded": len(self.responses)}
+
+
+def load_site_data(path=DATA_PATH):
+    site_data = _site_data.get(path)
+    if site_data is None:
+        with open(path, "r", encoding="utf-8") as raw:
+            site_data = _site_data[path] = json.load(raw)
+    return site_data
+
+
+def check_sites(site_names, path=DATA_PATH):
+    """Check detection of claimed and unclaimed usernames on site_names.
+
+    Return Value:
+    List of (site, username, expected, result) of the wrong results.
+    """
+    from looker.sherlock import sherlock
+
+    site_data = load_site_data(path)
+    transport = SyntheticTransport(site_data)
+    cases = {}
+    for social_network in site_names:
+        net_info = site_data[social_network]
+        for key, expected in (("username_claimed", "yes"), ("username_unclaimed", "no")):
+            username = net_info.get(key)
+            if username:
+                cases.setdefault(username, []).append((social_network, expected))
+
+    failures = []
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            for username, expectations in cases.items():
+                # sherlock() keeps the futures of a run in the site data.
+                run_data = {social_network: dict(site_data[social_network]) for social_network, _ in expectations}
+                results = sherlock(username, run_data, transport=transport)
+                for social_network, expected in expectations:
+                    result = results[social_network]["exists"]
+                    if result != expected:
+                        failures.append((social_network, username, expected, result))
+        finally:
+            sys.stdout = stdout
+    return failures
+
+
+def check_all_sites(path=DATA_PATH, processes=None):
+    """Check all sites of path in worker processes; return the wrong results."""
+    from looker.pararel import make_pool
+
+    names = list(load_site_data(path))
+    chunks = [names[start:start + CHUNK_SITES] for start in range(0, len(names), CHUNK_SITES)]
+    with make_pool(processes or min(os.cpu_count() or 1, len(chunks))) as pool:
+        return [failure for failures in pool.starmap(check_sites, [(chunk, path) for chunk in chunks])
+                for failure in failures]
+
+
+def throughput(site_data, usernames):
+    """Return probes per second of sherlock() over SyntheticTransport.
+
+    Only the engine is measured: submission, scheduling, classification
+    and output, no network.
+    """
+    from looker.sherlock import sherlock
+
+    transport = SyntheticTransport(site_data, claimed=usernames[:1])
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            start = perf_counter()
+            for username in usernames:
+                sherlock(username, {social_network: dict(net_info) for social_network, net_info in site_data.items()},
+                         transport=transport)
+            elapsed = perf_counter() - start
+        finally:
+            sys.stdout = stdout
+    return transport.summary()["sent"] / elapsed
+
+
+if __name__ == "__main__":
+    failures = check_all_sites()
+    for failure in failures:
+        print("{}: {} should be {}, got {}".format(*failure))
+    print(f"{len(load_site_data())} sites, {len(failures)} wrong results")
+    sys.exit(1 if failures else 0)
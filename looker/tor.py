@@ -0,0 +1,180 @@
+"""Sherlock: Tor Circuit Pool
+
+Tor builds a separate circuit for every set of SOCKS credentials it is
+given (IsolateSOCKSAuth, enabled by default). This module keeps a pool
+of such credentials, so probes can use many isolated circuits at the
+same time instead of resetting the identity after every request, and
+replaces circuits in the background.
+"""
+import itertools
+import threading
+import uuid
+import zlib
+from time import time
+
+TOR_SOCKS_HOST = "127.0.0.1"
+TOR_SOCKS_PORT = 9050
+
+# Number of circuits used at the same time.
+CIRCUITS = 8
+
+# Seconds after which every circuit of --unique-tor is replaced.
+ROTATE_SEC = 300
+
+# Requested through every circuit so Tor builds it before probing starts.
+TOR_CHECK_URL = "https://check.torproject.org/"
+
+_circuit_pools = {}
+_lock = threading.Lock()
+
+
+class Circuit:
+    """One isolated circuit, identified by its SOCKS credentials."""
+
+    def __init__(self, number, socks_host, socks_port):
+        self.number = number
+        self.socks_host = socks_host
+        self.socks_port = socks_port
+        self.requests = 0
+        self.renew()
+
+    def renew(self):
+        # New credentials make Tor use a new circuit.
+        self.token = uuid.uuid4().hex
+        self.created = time()
+        self.proxy = (f"socks5h://sherlock{self.number}:{self.token}"
+                      f"@{self.socks_host}:{self.socks_port}")
+
+
+class CircuitPool:
+    """Pool of isolated Tor circuits."""
+
+    def __init__(self, size=CIRCUITS, socks_host=TOR_SOCKS_HOST, socks_ports=(TOR_SOCKS_PORT,),
+                 per_host=False, rotate_sec=None, session=None):
+        """Create Circuit Pool.
+
+        Keyword Arguments:
+        size                   -- Number of circuits.
+        socks_host             -- Host of the Tor SOCKS port(s).
+        socks_ports            -- Tor SOCKS ports; circuits are spread over
+                                  all of them.
+        per_host               -- Boolean indicating whether every host
+                                  should always use the same circuit,
+                                  instead of going round-robin.
+        rotate_sec             -- Seconds after which every circuit is
+                                  replaced in the background (optional).
+        session                -- requests.Session the proxies are used with;
+                                  connections of replaced circuits are closed
+                                  (optional, more are added with attach()).
+        """
+        self.circuits = [Circuit(number, socks_host, socks_ports[number % len(socks_ports)])
+                         for number in range(size)]
+        self.per_host = per_host
+        self.rotate_sec = rotate_sec
+        self.sessions = [session] if session is not None else []
+        self.lock = threading.Lock()
+        self.next = itertools.cycle(self.circuits)
+        self.rotations = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def proxy_for(self, host=None):
+        """Return proxy URL of the circuit to use for a request to host."""
+        with self.lock:
+            if self.per_host and host is not None:
+                circuit = self.circuits[zlib.crc32(host.encode()) % len(self.circuits)]
+            else:
+                circuit = next(self.next)
+            circuit.requests += 1
+            return circuit.proxy
+
+    def attach(self, session):
+        """Close connections of replaced circuits in session too."""
+        with self.lock:
+            if all(attached is not session for attached in self.sessions):
+                self.sessions.append(session)
+
+    def rotate(self, circuit):
+        """Replace circuit with a new one."""
+        with self.lock:
+            old_proxy = circuit.proxy
+            circuit.renew()
+            self.rotations += 1
+            sessions = list(self.sessions)
+        # Connections over the old circuit are not needed anymore, in none
+        # of the sessions which sent requests over it.
+        for session in sessions:
+            for adapter in session.adapters.values():
+                manager = getattr(adapter, "proxy_manager", {}).pop(old_proxy, None)
+                if manager is not None:
+                    manager.clear()
+
+    def rotate_oldest(self):
+        with self.lock:
+            circuit = min(self.circuits, key=lambda circuit: circuit.created)
+        self.rotate(circuit)
+
+    def run(self):
+        # Replace circuits one by one, so they are not all rebuilt at once.
+        interval = self.rotate_sec / len(self.circuits)
+        while not self.stopped.wait(interval):
+            self.rotate_oldest()
+
+    def start(self):
+        """Start replacing circuits in the background."""
+        if self.rotate_sec and self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="sherlock-tor", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def prebuild(self, pool, session, url=TOR_CHECK_URL):
+        """Make Tor build all circuits, without waiting for it.
+
+        Keyword Arguments:
+        pool                   -- ProbePool to send the requests with.
+        session                -- requests.Session to send the requests with.
+        url                    -- URL requested through every circuit.
+
+        Return Value:
+        List of futures of the requests.
+        """
+        futures = []
+        for circuit in self.circuits:
+            proxies = {"http": circuit.proxy, "https": circuit.proxy}
+            futures.append(pool.submit(session.head, url, proxies=proxies, timeout=60))
+        return futures
+
+    def summary(self):
+        """Return dictionary with statistics of the circuits."""
+        with self.lock:
+            return {
+                "circuits": len(self.circuits),
+                "rotations": self.rotations,
+                "requests": sum(circuit.requests for circuit in self.circuits),
+            }
+
+
+def get_circuit_pool(pool, session, unique=False):
+    """Return the process-wide CircuitPool for --tor or --unique-tor.
+
+    Keyword Arguments:
+    pool                   -- ProbePool used to prebuild the circuits.
+    session                -- requests.Session the proxies are used with.
+    unique                 -- Boolean indicating whether every request
+                              should use another, regularly replaced,
+                              circuit (--unique-tor).  Otherwise every
+                              host keeps its circuit.
+    """
+    with _lock:
+        circuit_pool = _circuit_pools.get(unique)
+        if circuit_pool is None:
+            if unique:
+                circuit_pool = CircuitPool(rotate_sec=ROTATE_SEC, session=session)
+            else:
+                circuit_pool = CircuitPool(per_host=True, session=session)
+            circuit_pool.prebuild(pool, session)
+            circuit_pool.start()
+            _circuit_pools[unique] = circuit_pool
+        return circuit_pool
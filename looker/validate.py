@@ -0,0 +1,201 @@
+"""Sherlock: Site Validation
+
+This module checks all sites against their username_claimed and
+username_unclaimed in one concurrent batch, reports the sites whose
+detection method does not work anymore and can write a data file
+without them.
+"""
+import json
+import sys
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from datetime import datetime
+
+import requests
+
+from looker.latency import probe_settings
+from looker.pool import get_pool, get_session
+from looker.probe import HEADERS, PreparedUsername, prepare_headers, prepare_sites, send_probe
+from looker.sherlock import detect
+
+
+def probe_pairs(site_data, pairs):
+    """Probe many (site, username) pairs at once.
+
+    Keyword Arguments:
+    site_data              -- Dictionary containing all of the site data.
+    pairs                  -- Iterable of (social_network, username) tuples.
+
+    Return Value:
+    Dictionary keyed by (social_network, username) with dictionaries
+    containing exists, http_status, errorMsg_found and error.
+    """
+    pool = get_pool()
+    session = get_session()
+    headers = prepare_headers(session, HEADERS)
+    prepared_sites = prepare_sites(site_data)
+
+    futures = {}
+    for social_network, username in pairs:
+        site = prepared_sites[social_network]
+        futures[(social_network, username)] = pool.submit(
+            send_probe, session, site, PreparedUsername(username), headers,
+            probe_settings(site, session), host=site.host)
+
+    results = {}
+    for (social_network, username), future in futures.items():
+        net_info = site_data[social_network]
+        result = {"exists": "error", "http_status": None, "errorMsg_found": None, "error": None}
+        try:
+            r = future.result()
+        except requests.exceptions.RequestException as err:
+            result["error"] = str(err)
+        else:
+            result["exists"] = detect(net_info["errorType"], net_info, r)
+            result["http_status"] = r.status_code
+            if net_info["errorType"] == "message":
+                result["errorMsg_found"] = detect("message", net_info, r) == "no"
+        results[(social_network, username)] = result
+    return results
+
+
+def drift_reason(net_info, claimed, unclaimed):
+    """Describe why the detection of a site does not work anymore.
+
+    Return Value:
+    Tuple of (reason, suggested errorType or None).
+    """
+    error_type = net_info["errorType"]
+    suggestion = None
+    statuses_differ = (claimed["http_status"] is not None and
+                       200 <= claimed["http_status"] < 300 and
+                       claimed["http_status"] != unclaimed["http_status"])
+
+    if error_type == "message":
+        if not unclaimed["errorMsg_found"]:
+            reason = "errorMsg not found on page of unclaimed username"
+        else:
+            reason = "errorMsg found on page of claimed username"
+        if statuses_differ:
+            suggestion = "status_code"
+    elif error_type == "status_code":
+        reason = (f"same HTTP status for claimed and unclaimed username "
+                  f"({claimed['http_status']}, {unclaimed['http_status']})")
+    else:
+        reason = (f"claimed username gives HTTP status {claimed['http_status']}, "
+                  f"unclaimed {unclaimed['http_status']}")
+        if statuses_differ:
+            suggestion = "status_code"
+    return reason, suggestion
+
+
+def validate(site_data):
+    """Validate detection of all sites which have test usernames.
+
+    Keyword Arguments:
+    site_data              -- Dictionary containing all of the site data.
+
+    Return Value:
+    Dictionary with the report, see module documentation.  Every site has
+    status "ok", "drift", "error" (request failed) or "untested" (no test
+    usernames).
+    """
+    pairs = []
+    for social_network, net_info in site_data.items():
+        claimed = net_info.get("username_claimed")
+        unclaimed = net_info.get("username_unclaimed")
+        if claimed is not None and unclaimed is not None:
+            pairs.append((social_network, claimed))
+            pairs.append((social_network, unclaimed))
+    results = probe_pairs(site_data, pairs)
+
+    sites = {}
+    for social_network, net_info in site_data.items():
+        claimed_name = net_info.get("username_claimed")
+        unclaimed_name = net_info.get("username_unclaimed")
+        if claimed_name is None or unclaimed_name is None:
+            sites[social_network] = {"status": "untested"}
+            continue
+
+        claimed = results[(social_network, claimed_name)]
+        unclaimed = results[(social_network, unclaimed_name)]
+        report = {
+            "errorType": net_info["errorType"],
+            "claimed": dict(claimed, username=claimed_name),
+            "unclaimed": dict(unclaimed, username=unclaimed_name),
+        }
+        if claimed["exists"] == "error" or unclaimed["exists"] == "error":
+            report["status"] = "error"
+        elif claimed["exists"] == "yes" and unclaimed["exists"] == "no":
+            report["status"] = "ok"
+        else:
+            report["status"] = "drift"
+            report["reason"], report["suggested_errorType"] = \
+                drift_reason(net_info, claimed, unclaimed)
+        sites[social_network] = report
+
+    summary = {}
+    for report in sites.values():
+        summary[report["status"]] = summary.get(report["status"], 0) + 1
+    return {
+        "checked_at": datetime.utcnow().isoformat() + "Z",
+        "summary": summary,
+        "sites": sites,
+    }
+
+
+def prune(site_data, report, statuses=("drift",)):
+    """Return copy of site_data without sites having one of statuses.
+
+    Sites which are not in the report are kept.
+    """
+    return {social_network: net_info for social_network, net_info in site_data.items()
+            if report["sites"].get(social_network, {}).get("status") not in statuses}
+
+
+def main(argv=None):
+    parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
+                            description="Check detection of all sites against their test usernames."
+                            )
+    parser.add_argument("--json", "-j", metavar="JSON_FILE",
+                        dest="json_file", default="data.json",
+                        help="Load site data from this JSON file.")
+    parser.add_argument("--site",
+                        action="append", metavar="SITE_NAME",
+                        dest="site_list", default=None,
+                        help="Limit validation to just the listed sites.")
+    parser.add_argument("--report", "-r", metavar="REPORT_FILE",
+                        dest="report", default=None,
+                        help="Write the report to this file instead of standard output.")
+    parser.add_argument("--prune", "-p", metavar="PRUNED_JSON_FILE",
+                        dest="prune", default=None,
+                        help="Write site data without the sites whose detection drifted to this file.")
+    parser.add_argument("--prune-errors",
+                        action="store_true", dest="prune_errors", default=False,
+                        help="Also remove sites which could not be reached when pruning.")
+    args = parser.parse_args(argv)
+
+    with open(args.json_file, "r", encoding="utf-8") as raw:
+        site_data = json.load(raw)
+    # Only the listed sites are validated, pruning keeps all the others.
+    checked = site_data
+    if args.site_list:
+        checked = {site: site_data[site] for site in args.site_list}
+
+    report = validate(checked)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.prune:
+        statuses = ("drift", "error") if args.prune_errors else ("drift",)
+        with open(args.prune, "w", encoding="utf-8") as data_file:
+            data_file.write(json.dumps(prune(site_data, report, statuses), indent=2, sort_keys=True))
+
+    print(f"Validated {len(checked)} sites: {report['summary']}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""Sherlock: Connection Warm-up
+
+Opens connections to the site hosts before probing begins, so the first
+username does not pay DNS, TCP and TLS for every site at the same moment.
+Connections are opened at a limited rate and put into the connection
+pools of the session, where the probes pick them up. During long sweeps
+the pools are checked every REWARM_INTERVAL seconds and connections
+which the servers closed while idle are opened again.
+
+Warm-up is accounted apart from the runs (see Warmer.summary()), its
+handshakes do not count against the response times of the probes.
+Connecting gives up after CONNECT_TIMEOUT seconds, and probing does not
+wait more than WARMUP_TIMEOUT seconds for the warm-up: hosts which are
+still connecting by then are warmed in the background.
+"""
+import threading
+from concurrent.futures import wait
+from time import perf_counter, sleep
+from urllib.parse import urlsplit
+
+from requests.models import PreparedRequest
+from urllib3.util.connection import is_connection_dropped
+
+from looker.pool import get_pool, get_session
+
+# Connections opened per host.
+CONNECTIONS = 1
+
+# Connections opened per second at most.
+RATE = 50.0
+
+# Seconds between checks of the pools for closed connections.
+REWARM_INTERVAL = 30.0
+
+# Seconds a connection may take to open.
+CONNECT_TIMEOUT = 5.0
+
+# Seconds warm_up() waits for the hosts at most.
+WARMUP_TIMEOUT = 10.0
+
+_warmer = None
+_lock = threading.Lock()
+
+
+class RateLimiter:
+    """Spaces calls of wait() at least 1 / rate seconds apart."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.lock = threading.Lock()
+        self.next = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = perf_counter()
+            start = max(now, self.next)
+            self.next = start + self.interval
+        if start > now:
+            sleep(start - now)
+
+
+def is_connected(connection):
+    """Return True if the urllib3 connection has an open socket."""
+    connected = getattr(connection, "is_connected", None)
+    if connected is not None:
+        return connected
+    # urllib3 1.x
+    return connection.sock is not None and not is_connection_dropped(connection)
+
+
+class Warmer:
+    """Keeps connections to the site hosts open in the pools of a session."""
+
+    def __init__(self, session, pool, connections=CONNECTIONS, rate=RATE):
+        """Create Warmer.
+
+        Keyword Arguments:
+        session                -- requests.Session whose pools are warmed.
+        pool                   -- ProbePool opening the connections.
+        connections            -- Connections kept open per host.
+        rate                   -- Connections opened per second at most.
+        """
+        self.session = session
+        self.pool = pool
+        self.connections = connections
+        self.limiter = RateLimiter(rate)
+        self.lock = threading.Lock()
+        # Origin (scheme://host:port) -> (prepared request, settings)
+        self.origins = {}
+        self.counts = {"hosts": 0, "opened": 0, "reused": 0, "failed": 0, "rewarmed": 0, "late": 0,
+                       "handshake_sec": 0.0, "max_handshake_sec": 0.0, "warmup_sec": 0.0}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add(self, prepared_sites):
+        """Register the hosts of prepared_sites; return the new origins."""
+        added = []
+        with self.lock:
+            for site in prepared_sites.values():
+                if not site.host or site.host_templated:
+                    continue
+                parts = urlsplit(site.probe_prefix)
+                origin = f"{parts.scheme}://{parts.netloc}/"
+                if origin in self.origins:
+                    continue
+                settings = site.send_settings(self.session)
+                if settings.get("proxies"):
+                    # The proxy is connected to, not the site.
+                    continue
+                request = PreparedRequest()
+                request.prepare(method="GET", url=origin)
+                self.origins[origin] = (request, settings)
+                added.append(origin)
+            self.counts["hosts"] = len(self.origins)
+        return added
+
+    def connection_pool(self, origin):
+        # Same pool as requests picks for the probes of the origin.
+        request, settings = self.origins[origin]
+        adapter = self.session.get_adapter(origin)
+        if hasattr(adapter, "get_connection_with_tls_context"):
+            return adapter.get_connection_with_tls_context(request, settings["verify"], cert=settings.get("cert"))
+        # requests < 2.32
+        return adapter.get_connection(origin)
+
+    def idle(self, origin):
+        """Return number of open idle connections to origin."""
+        connection_pool = self.connection_pool(origin)
+        return sum(connection is not None and is_connected(connection)
+                   for connection in list(connection_pool.pool.queue))
+
+    def warm(self, origin):
+        """Open connections to origin until CONNECTIONS of them are open.
+
+        Return Value:
+        Number of connections opened.
+        """
+        connection_pool = self.connection_pool(origin)
+        taken = []
+        opened = 0
+        try:
+            for _ in range(self.connections):
+                # Idle connections come first, closed ones are reset by
+                # urllib3, new slots give an unconnected connection.
+                connection = connection_pool._get_conn()
+                taken.append(connection)
+                if is_connected(connection):
+                    with self.lock:
+                        self.counts["reused"] += 1
+                    continue
+                self.limiter.wait()
+                start = perf_counter()
+                try:
+                    # Probes set their own timeouts on the connection.
+                    connection.timeout = CONNECT_TIMEOUT
+                    connection.connect()
+                except Exception:
+                    connection.close()
+                    with self.lock:
+                        self.counts["failed"] += 1
+                    break
+                handshake = perf_counter() - start
+                opened += 1
+                with self.lock:
+                    self.counts["opened"] += 1
+                    self.counts["handshake_sec"] += handshake
+                    self.counts["max_handshake_sec"] = max(self.counts["max_handshake_sec"], handshake)
+        finally:
+            for connection in taken:
+                connection_pool._put_conn(connection)
+        return opened
+
+    def warm_up(self, prepared_sites, timeout=WARMUP_TIMEOUT):
+        """Warm the hosts of prepared_sites.
+
+        Waits until all hosts are done, or timeout seconds; slower hosts
+        go on warming in the background (counted as "late").
+
+        Return Value:
+        Number of connections opened within timeout.
+        """
+        start = perf_counter()
+        futures = [self.pool.submit(self.warm, origin, host=urlsplit(origin).hostname)
+                   for origin in self.add(prepared_sites)]
+        done, late = wait(futures, timeout=timeout)
+        opened = sum(future.result() for future in done)
+        with self.lock:
+            self.counts["warmup_sec"] += perf_counter() - start
+            self.counts["late"] += len(late)
+        return opened
+
+    def rewarm(self):
+        """Open again connections the servers closed; return number opened."""
+        with self.lock:
+            origins = list(self.origins)
+        futures = [self.pool.submit(self.warm, origin, host=urlsplit(origin).hostname)
+                   for origin in origins if self.idle(origin) < self.connections]
+        opened = sum(future.result() for future in futures)
+        with self.lock:
+            self.counts["rewarmed"] += opened
+        return opened
+
+    def start(self, interval=REWARM_INTERVAL):
+        """Re-warm the pools every interval seconds in a background thread."""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.keep_warm, args=(interval,),
+                                           name="sherlock-warmup", daemon=True)
+        self.thread.start()
+
+    def keep_warm(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.rewarm()
+            except RuntimeError:
+                # Pool shut down at exit.
+                return
+
+    def stop(self):
+        self.stopped.set()
+
+    def summary(self):
+        with self.lock:
+            counts = dict(self.counts)
+        for key in ("handshake_sec", "max_handshake_sec", "warmup_sec"):
+            counts[key] = round(counts[key], 3)
+        return counts
+
+
+def get_warmer(connections=None, rate=None):
+    """Return the process-wide Warmer of the process-wide session.
+
+    connections and rate take effect when given for the first time.
+    """
+    global _warmer
+    session = get_session()
+    with _lock:
+        if _warmer is None or _warmer.session is not session:
+            _warmer = Warmer(session, get_pool(), connections or CONNECTIONS, rate or RATE)
+        return _warmer
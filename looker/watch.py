@@ -0,0 +1,271 @@
+"""Sherlock: Watch Mode
+
+Monitors known usernames over time. Every (username, site) pair keeps
+the validators of its last answer (ETag, Last-Modified, hash of the
+body), which are sent back as If-None-Match/If-Modified-Since, so pages
+which did not change cost a 304 instead of a download. Pairs are checked
+again when they are due: the interval grows while nothing changes, less
+so on sites whose accounts change often, and drops back to the minimum
+after a change. Only changes are reported.
+
+    python -m looker.watch add mateusz kojro --site GitHub
+    python -m looker.watch run --loop
+
+Events are JSON lines {"event": "created" or "deleted", "username",
+"site", "url", "checked"}.
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from hashlib import blake2b
+from time import sleep, time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from looker.latency import probe_settings
+from looker.pool import get_pool, get_session
+from looker.probe import HEADERS, PreparedUsername, prepare_headers, prepare_sites, send_probe
+
+DEFAULT_PATH = os.path.join("output", "watch.sqlite")
+
+# Seconds between checks of a pair, see next_interval().
+MIN_INTERVAL = 3600
+MAX_INTERVAL = 30 * 24 * 3600
+BACKOFF = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS watch (
+    username TEXT NOT NULL,
+    site TEXT NOT NULL,
+    exists_ TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    content_hash TEXT,
+    checked REAL,
+    next_check REAL NOT NULL,
+    interval REAL NOT NULL,
+    PRIMARY KEY (username, site)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS watch_due ON watch (next_check);
+CREATE TABLE IF NOT EXISTS site_changes (
+    site TEXT PRIMARY KEY,
+    checks INTEGER NOT NULL,
+    changes INTEGER NOT NULL
+);
+"""
+
+COLUMNS = ("username", "site", "exists_", "etag", "last_modified", "content_hash",
+           "checked", "next_check", "interval")
+
+
+def content_hash(r):
+    return blake2b(r.content, digest_size=16).hexdigest() if r.content else None
+
+
+def next_interval(interval, changed, change_rate):
+    """Return seconds until the next check of a pair.
+
+    Keyword Arguments:
+    interval               -- Seconds since the previous check was planned.
+    changed                -- Boolean indicating whether the pair changed.
+    change_rate            -- Share of the checks of the site which found a
+                              change.
+    """
+    if changed:
+        return MIN_INTERVAL
+    # Sites whose accounts change often are not left alone for long.
+    ceiling = max(MAX_INTERVAL * (1 - change_rate), MIN_INTERVAL)
+    return min(max(interval * BACKOFF, MIN_INTERVAL), ceiling)
+
+
+def conditional_headers(headers, pair):
+    """Return headers asking for the page only if it changed since pair was checked."""
+    if not pair["etag"] and not pair["last_modified"]:
+        return headers
+    headers = CaseInsensitiveDict(headers)
+    if pair["etag"]:
+        headers["If-None-Match"] = pair["etag"]
+    if pair["last_modified"]:
+        headers["If-Modified-Since"] = pair["last_modified"]
+    return headers
+
+
+class WatchStore:
+    """SQLite store of the watched pairs."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def add(self, username, sites):
+        """Start watching username on sites; due immediately."""
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO watch (username, site, next_check, interval) "
+                                "VALUES (?, ?, 0, ?)", [(username, site, MIN_INTERVAL) for site in sites])
+
+    def remove(self, username):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM watch WHERE username = ?", (username,))
+
+    def due(self, now, limit=None):
+        """Return pairs whose next check is due, as dictionaries."""
+        query = f"SELECT {', '.join(COLUMNS)} FROM watch WHERE next_check <= ? ORDER BY next_check"
+        arguments = [now]
+        if limit is not None:
+            query += " LIMIT ?"
+            arguments.append(limit)
+        with self.lock:
+            return [dict(zip(COLUMNS, row)) for row in self.db.execute(query, arguments)]
+
+    def change_rate(self, site):
+        with self.lock:
+            row = self.db.execute("SELECT checks, changes FROM site_changes WHERE site = ?", (site,)).fetchone()
+        checks, changes = row or (0, 0)
+        # Smoothed, so a few checks do not decide alone.
+        return (changes + 1) / (checks + 2)
+
+    def update(self, pair, changed):
+        """Store pair after it was checked and account the check to its site."""
+        with self.lock, self.db:
+            self.db.execute(f"UPDATE watch SET {', '.join(f'{column} = ?' for column in COLUMNS[2:])} "
+                            "WHERE username = ? AND site = ?",
+                            [pair[column] for column in COLUMNS[2:]] + [pair["username"], pair["site"]])
+            self.db.execute("INSERT INTO site_changes VALUES (?, 1, ?) ON CONFLICT (site) DO UPDATE "
+                            "SET checks = checks + 1, changes = changes + excluded.changes",
+                            (pair["site"], int(changed)))
+
+    def summary(self):
+        with self.lock:
+            pairs, usernames = self.db.execute("SELECT COUNT(*), COUNT(DISTINCT username) FROM watch").fetchone()
+        return {"pairs": pairs, "usernames": usernames}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def watch_once(store, site_data, now=None, limit=None):
+    """Check all due pairs once.
+
+    Keyword Arguments:
+    store                  -- WatchStore with the pairs.
+    site_data              -- Dictionary containing all of the site data.
+    now                    -- time() to check the due pairs at (optional).
+    limit                  -- Number of pairs to check at most (optional).
+
+    Return Value:
+    Tuple of (list of events, dictionary with counts of the checks).
+    """
+    from looker.sherlock import detect
+
+    now = time() if now is None else now
+    pool = get_pool()
+    session = get_session()
+    headers = prepare_headers(session, HEADERS)
+    prepared_sites = prepare_sites(site_data)
+
+    futures = []
+    for pair in store.due(now, limit):
+        site = prepared_sites.get(pair["site"])
+        if site is None:
+            continue
+        future = pool.submit(send_probe, session, site, PreparedUsername(pair["username"]),
+                             conditional_headers(headers, pair), probe_settings(site, session),
+                             host=site.host)
+        futures.append((pair, site, future))
+
+    events = []
+    counts = {"checked": 0, "not_modified": 0, "same_content": 0, "changed": 0, "errors": 0}
+    for pair, site, future in futures:
+        counts["checked"] += 1
+        net_info = site_data[pair["site"]]
+        try:
+            r = future.result()
+        except requests.exceptions.RequestException:
+            r = None
+
+        if r is None:
+            exists = "error"
+        elif r.status_code == 304:
+            counts["not_modified"] += 1
+            exists = pair["exists_"]
+        elif pair["content_hash"] is not None and content_hash(r) == pair["content_hash"]:
+            counts["same_content"] += 1
+            exists = pair["exists_"]
+        else:
+            exists = detect(net_info["errorType"], net_info, r)
+
+        if exists == "error":
+            # Try again soon, keep everything else.
+            counts["errors"] += 1
+            store.update(dict(pair, next_check=now + MIN_INTERVAL), False)
+            continue
+
+        changed = pair["exists_"] is not None and exists != pair["exists_"]
+        if changed:
+            counts["changed"] += 1
+            events.append({"event": "created" if exists == "yes" else "deleted",
+                           "username": pair["username"], "site": pair["site"],
+                           "url": site.user_url(PreparedUsername(pair["username"])), "checked": now})
+        interval = next_interval(pair["interval"], changed, store.change_rate(pair["site"]))
+        updated = dict(pair, exists_=exists, checked=now, next_check=now + interval, interval=interval)
+        if r.status_code != 304:
+            updated.update(etag=r.headers.get("ETag"), last_modified=r.headers.get("Last-Modified"),
+                           content_hash=content_hash(r))
+        store.update(updated, changed)
+    return events, counts
+
+
+def main():
+    parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
+                            description="Watch known usernames and report when accounts appear or disappear.")
+    parser.add_argument("--db", metavar="WATCH_FILE", dest="db", default=DEFAULT_PATH,
+                        help="SQLite file with the watched usernames.")
+    parser.add_argument("--json", "-j", metavar="JSON_FILE", dest="json_file", default="data.json",
+                        help="Load site data from this JSON file.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="Watch usernames.")
+    add.add_argument("usernames", nargs="+", metavar="USERNAME")
+    add.add_argument("--site", action="append", metavar="SITE_NAME", dest="site_list", default=None,
+                     help="Only watch the listed sites.")
+    remove = commands.add_parser("remove", help="Stop watching usernames.")
+    remove.add_argument("usernames", nargs="+", metavar="USERNAME")
+    run = commands.add_parser("run", help="Check the due pairs and print the changes.")
+    run.add_argument("--loop", action="store_true", default=False,
+                     help="Keep checking, every --sleep seconds.")
+    run.add_argument("--sleep", type=float, default=60,
+                     help="Seconds between rounds of --loop.")
+    args = parser.parse_args()
+
+    with open(args.json_file, "r", encoding="utf-8") as raw:
+        site_data = json.load(raw)
+    store = WatchStore(args.db)
+    if args.command == "add":
+        for username in args.usernames:
+            store.add(username, args.site_list or list(site_data))
+    elif args.command == "remove":
+        for username in args.usernames:
+            store.remove(username)
+    else:
+        while True:
+            events, counts = watch_once(store, site_data)
+            for event in events:
+                print(json.dumps(event), flush=True)
+            print(json.dumps(counts), file=sys.stderr)
+            if not args.loop:
+                break
+            sleep(args.sleep)
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
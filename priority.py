@@ -0,0 +1,291 @@
+"""
+Candidate prioritization
+
+Orders usernames created by functions.prepare and
+functions.idioticly_create_combinations so the most likely ones are
+probed first. Scores change while the run goes on: every hit reported
+by the sites raises the weight of the tokens the username was made of,
+which pulls related candidates to the front of the queue.
+"""
+import heapq
+import re
+from itertools import count
+
+import functions
+from looker.profiling import span
+
+# Weights of the different kinds of tokens taken from the target data.
+KNOWN_SCORE = 1000.0
+TOKEN_WEIGHT = 10.0
+NUMBER_WEIGHT = 4.0
+NAME_NUMBER_BONUS = 15.0
+PIECE_PENALTY = 2.0
+HIT_BOOST = 1.5
+
+# Targets of a batch whose candidates are generated at the same time.
+WINDOW_TARGETS = 8
+
+NAME_NUMBER = re.compile(r"^([^\d]+?)[._-]?(\d+)$")
+
+
+class CandidateQueue:
+    """Priority queue of candidate usernames.
+
+    Candidates with the highest score are popped first. Scores are
+    recomputed when a hit is reported, entries which became outdated are
+    skipped when popping (lazy deletion), so updates cost only a heap push.
+    """
+
+    def __init__(self, tokens=(), numbers=(), known=()):
+        """Create Candidate Queue.
+
+        Keyword Arguments:
+        tokens                 -- Iterable of full words known about the
+                                  target (name, surname, nicknames...).
+        numbers                -- Iterable of numbers known about the target
+                                  (lucky numbers, parts of birthday date).
+        known                  -- Iterable of usernames the target is known
+                                  to use.
+        """
+        self.weights = {}
+        for token in tokens:
+            if token:
+                self.weights[token.lower()] = TOKEN_WEIGHT
+        for number in numbers:
+            if number:
+                self.weights[number] = NUMBER_WEIGHT
+        self.numbers = {number for number in numbers if number}
+        self.known = {username.lower() for username in known if username}
+
+        self.heap = []
+        self.scores = {}
+        self.done = set()
+        self.by_token = {}
+        self.counter = count()
+
+    @classmethod
+    def from_target(cls, name, surname, l_number, nickname, birthday_date, pet_name, known_username):
+        """Create queue from the same data that functions.prepare gets."""
+        numbers = list(l_number) + list(birthday_date)
+        # people like to use only the last two digits of the year
+        numbers += [part[-2:] for part in birthday_date if len(part) == 4]
+        tokens = [name, surname] + list(nickname) + list(pet_name)
+        return cls(tokens=tokens, numbers=numbers, known=known_username)
+
+    def tokens_in(self, candidate):
+        """Return tokens (longer than one character) contained in candidate."""
+        candidate = candidate.lower()
+        return [token for token in self.weights if len(token) > 1 and token in candidate]
+
+    def score(self, candidate):
+        """Score candidate, higher means more likely to be used by the target."""
+        lowered = candidate.lower()
+        if lowered in self.known:
+            return KNOWN_SCORE
+        if not lowered:
+            return 0.0
+
+        tokens = self.tokens_in(lowered)
+        if not tokens:
+            # Only prefixes created by create_mutations, longer is better.
+            return len(lowered) / 10.0
+
+        covered = [False] * len(lowered)
+        score = 0.0
+        pieces = 0
+        for token in tokens:
+            start = lowered.find(token)
+            while start != -1:
+                for i in range(start, start + len(token)):
+                    covered[i] = True
+                score += self.weights[token]
+                pieces += 1
+                start = lowered.find(token, start + len(token))
+
+        # Share of the candidate made of full tokens, glued single letter
+        # prefixes lower it. Every additional piece makes it less likely.
+        coverage = sum(covered) / len(lowered)
+        score = score / pieces * coverage - PIECE_PENALTY * (pieces - 1)
+
+        match = NAME_NUMBER.match(lowered)
+        if match and match.group(2) in self.numbers and match.group(1) in self.weights:
+            score += NAME_NUMBER_BONUS
+        return score
+
+    def push(self, candidate):
+        """Add candidate to the queue (duplicates are ignored)."""
+        if candidate in self.scores or candidate in self.done:
+            return
+        score = self.score(candidate)
+        self.scores[candidate] = score
+        for token in self.tokens_in(candidate):
+            self.by_token.setdefault(token, set()).add(candidate)
+        heapq.heappush(self.heap, (-score, next(self.counter), candidate))
+
+    def extend(self, candidates):
+        for candidate in candidates:
+            self.push(candidate)
+
+    def peek(self):
+        """Return (score, candidate) of the best candidate, or None if empty."""
+        while self.heap:
+            score, _, candidate = self.heap[0]
+            if self.scores.get(candidate) == -score:
+                return -score, candidate
+            heapq.heappop(self.heap)
+        return None
+
+    def discard(self, candidate):
+        """Remove candidate, it will not be queued again.
+
+        Return Value:
+        True if candidate was in the queue.
+        """
+        self.done.add(candidate)
+        if candidate not in self.scores:
+            return False
+        del self.scores[candidate]
+        for token in self.tokens_in(candidate):
+            self.by_token[token].discard(candidate)
+        return True
+
+    def pop(self):
+        """Remove and return the best candidate.
+
+        Raises IndexError if the queue is empty.
+        """
+        best = self.peek()
+        if best is None:
+            raise IndexError("pop from an empty candidate queue")
+        self.discard(best[1])
+        return best[1]
+
+    def report_hit(self, candidate, found=1):
+        """Raise priority of candidates related to one that was found.
+
+        Keyword Arguments:
+        candidate              -- Username that was found on some sites.
+        found                  -- Number of sites the username was found on.
+        """
+        for token in self.tokens_in(candidate):
+            self.weights[token] *= HIT_BOOST ** found
+            for related in self.by_token.get(token, ()):
+                score = self.score(related)
+                self.scores[related] = score
+                heapq.heappush(self.heap, (-score, next(self.counter), related))
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __iter__(self):
+        # Drains the queue, so hits reported while iterating are respected.
+        while self.scores:
+            yield self.pop()
+
+
+def target_queue(name, surname, l_number, nickname, birthday_date, pet_name, known_username,
+                 combinations=False):
+    """Return queue with all candidates generated for one target.
+
+    Combinations of the candidates (functions.idioticly_create_combinations)
+    are only added when combinations is True: there are O(n^3) of them, so
+    probing them multiplies the run time.
+    """
+    target = (name, surname, l_number, nickname, birthday_date, pet_name, known_username)
+    with span("candidates"):
+        everything = functions.prepare(*target)
+        queue = CandidateQueue.from_target(*target)
+        queue.extend(everything)
+        if combinations:
+            queue.extend(functions.idioticly_create_combinations(list(everything)))
+    return queue
+
+
+class MergedQueue:
+    """Candidates of many targets as one stream.
+
+    Every username is probed once, even if it was generated for several
+    targets; the best scored candidate of the active targets goes first.
+    Hits are reported to the queues of all targets which had the candidate.
+
+    Queues are taken from the iterable only when needed: at most window
+    targets are active, the next one is built when one of them runs out of
+    candidates, so a large batch is never expanded into memory at once.
+    Targets are numbered in the order they are taken. A target built after
+    one of its candidates was probed does not get it again; it is added to
+    the owners of the candidate and gets its hits reported.
+    """
+
+    def __init__(self, queues, window=WINDOW_TARGETS):
+        """Create Merged Queue.
+
+        Keyword Arguments:
+        queues                 -- Iterable of CandidateQueue objects, one
+                                  per target, consumed lazily.
+        window                 -- Number of targets whose queues are built
+                                  at the same time.
+        """
+        self.source = iter(queues)
+        self.window = window
+        # Target number -> queue, of the active targets
+        self.queues = {}
+        self.taken = 0
+        # Candidate -> indexes of targets which had it, for all popped ones
+        self.owners = {}
+        self.hits = {}
+
+    def fill(self):
+        """Build queues of the next targets until window of them are active."""
+        while self.source is not None and len(self.queues) < self.window:
+            queue = next(self.source, None)
+            if queue is None:
+                self.source = None
+                break
+            number = self.taken
+            self.taken += 1
+            for candidate in [candidate for candidate in queue.scores if candidate in self.owners]:
+                queue.discard(candidate)
+                self.owners[candidate].append(number)
+                if candidate in self.hits:
+                    queue.report_hit(candidate, self.hits[candidate])
+            if queue.scores:
+                self.queues[number] = queue
+
+    def pop(self):
+        """Remove and return (candidate, indexes of targets which had it).
+
+        Raises IndexError if all queues are empty.
+        """
+        self.fill()
+        best = None
+        for queue in self.queues.values():
+            head = queue.peek()
+            if head is not None and (best is None or head[0] > best[0]):
+                best = head
+        if best is None:
+            raise IndexError("pop from an empty merged queue")
+        candidate = best[1]
+        owners = [number for number, queue in self.queues.items() if queue.discard(candidate)]
+        self.owners[candidate] = owners
+        for number in owners:
+            if not self.queues[number].scores:
+                del self.queues[number]
+        return candidate, owners
+
+    def report_hit(self, candidate, found=1):
+        self.hits[candidate] = found
+        for number in self.owners.get(candidate, ()):
+            if number in self.queues:
+                self.queues[number].report_hit(candidate, found)
+
+    def __len__(self):
+        """Number of candidates left in the active queues."""
+        self.fill()
+        return len(set().union(*(queue.scores for queue in self.queues.values())))
+
+    def __iter__(self):
+        while True:
+            self.fill()
+            if not self.queues:
+                return
+            yield self.pop()
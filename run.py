@@ -1,13 +1,47 @@
-from ui_sherlock_pro import *
-import functions
-from multiprocessing import Pool
-from looker.sherlock import *
+import os
+import sys
+
+from ui_sherlock_pro import get_data, read_targets, target_label
+from priority import MergedQueue, target_queue
+from looker.profiling import enable_from_environment, get_profiler, span
 
 if __name__ == '__main__':
-    name, surname, l_number, nickname, birthday_date, pet_name, known_username = get_data()
-    everything = functions.prepare(name, surname, l_number, nickname, birthday_date, pet_name, known_username)
-    all = functions.idioticly_create_combinations(list(everything))
+    #SHERLOCK_PROFILE=folder zapisuje czas poszczegolnych etapow calego przebiegu
+    profile = enable_from_environment()
+
+    #python run.py arkusz.json [wiecej.jsonl osoby.csv] sprawdza wszystkie osoby z plikow bez pytania
+    batch = sys.argv[1:]
+
+    #SHERLOCK_COMBINATIONS=1 sprawdza tez kombinacje nazw, jest ich bardzo duzo
+    combinations = os.environ.get("SHERLOCK_COMBINATIONS", "") not in ("", "0")
+    if batch:
+        #osoby czytane z plikow dopiero gdy kolejka ich potrzebuje
+        targets = read_targets(batch)
+    else:
+        targets = [get_data()]
+
+    #requests i reszta ladowane dopiero gdy beda potrzebne, nie przy imporcie
+    with span("load"):
+        from looker.sherlock import main
+
+    #kolejka sprawdza najpierw nazwy ktore najbardziej pasuja do osob,
+    #nazwy wspolne dla kilku osob sprawdzamy tylko raz
+    #kandydaci kolejnej osoby tworzeni dopiero gdy kolejka jej potrzebuje
+    labels = []
+
+    def queues():
+        for target in targets:
+            labels.append(target_label(target))
+            yield target_queue(*target, combinations=combinations)
+
+    queue = MergedQueue(queues())
 
 #wyswietlamy wszytskie utworzone nazwy uzytkownika
-    for word in everything:
-        main(word)
+    for word, owners in queue:
+        #argumenty programu to pliki z osobami, nie opcje sherlocka
+        #w indeksie wynikow zapisujemy dla kogo byla ta nazwa
+        if main(word, [arg for owner in owners for arg in ("--target", labels[owner])]):
+            queue.report_hit(word)
+
+    if profile:
+        get_profiler().write(os.path.join(profile, "run"))
@@ -1,7 +1,58 @@
 import unittest
+import re
 from functions import *
 from run import *
 from looker.sherlock import *
+from priority import CandidateQueue, MergedQueue, target_queue
+import ui_sherlock_pro
+from looker import probe
+from looker.pool import ProbePool, RunStats
+import threading
+import os
+import tempfile
+from looker.resolver import Resolver, ResolvingAdapter
+from looker import http2
+from looker.tor import CircuitPool
+from looker.pool import get_pool, get_session
+from looker import validate
+from looker import fingerprint
+from looker import markers
+import daemon
+from looker.index import ResultIndex, site_hashes
+from looker import latency
+from looker import archive
+from looker import watch
+from looker import profiling
+from looker import warmup
+from looker import budget
+from looker import site_list
+from looker.tests import offline
+from looker import scheduler
+from concurrent.futures import ThreadPoolExecutor
+import time
+import subprocess
+import sys
+import socket
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import requests
+import gzip
+import atexit
+import shutil
+try:
+    import numpy
+    from looker import analytics
+except ImportError:
+    numpy = analytics = None
+
+# Lock files of the host budgets of the tests, not the ones of the user;
+# processes started by the tests use them too.
+SLOTS_DIRECTORY = tempfile.mkdtemp(prefix="sherlock-hosts-")
+os.environ["SHERLOCK_HOST_SLOTS"] = SLOTS_DIRECTORY
+scheduler.SLOTS_DIRECTORY = SLOTS_DIRECTORY
+atexit.register(shutil.rmtree, SLOTS_DIRECTORY, True)
+
 """
 File with tests that are running every time that project is pushed to github
 if you want to trigger them manualy run this file
@@ -30,7 +81,1462 @@ class TestSherlockPro(unittest.TestCase):
         input = "mateusz"
         ex_output = 1
         msg = "Sherlock returned with 0 results wit known viable output grater than 0"
-        self.assertEqual(main(input),ex_output,msg)
+        site_data = load_site_data("data.json")
+        transport = offline.SyntheticTransport(site_data, claimed=[input])
+        allowed = sum(re.search(net_info.get("regexCheck") or "", input) is not None for net_info in site_data.values())
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(main(input, ["--folderoutput", directory], transport=transport),ex_output,msg)
+            with open(os.path.join(directory, input + ".txt")) as found:
+                self.assertIn(f"Total Websites : {allowed}",found.read())
+
+    def test_candidate_queue_order(self):
+        queue = CandidateQueue.from_target("mateusz","kojro",["16"],[],["30","06","2000"],[],["matrix"])
+        queue.extend(["m","ma","mateusz","mateusz2000","matrix","mateuszmateuszmateusz"])
+        ex_output = ["matrix","mateusz2000","mateusz","mateuszmateuszmateusz","ma","m"]
+        msg = "candidates should be ordered from the most likely one"
+        self.assertEqual(list(queue),ex_output,msg)
+
+    def test_candidate_queue_report_hit(self):
+        queue = CandidateQueue(tokens=["mateusz","kojro"])
+        queue.extend(["mateusz","kojro","kojrokojro","mateuszmateusz"])
+        self.assertEqual(queue.pop(),"mateusz")
+        queue.report_hit("mateusz")
+        msg = "hit should raise priority of related candidates"
+        self.assertEqual(queue.pop(),"mateuszmateusz",msg)
+
+    def test_merged_queue(self):
+        queue = MergedQueue([target_queue("jan","kowal",[],[],[],[],[]), target_queue("anna","kowal",[],[],[],[],[])])
+        candidates = list(queue)
+        msg = "candidates shared by targets should be probed once"
+        self.assertEqual(len(candidates),len({candidate for candidate, owners in candidates}),msg)
+        self.assertIn(("kowal",[0,1]),candidates)
+
+    def test_merged_queue_lazy(self):
+        built = []
+
+        def queues():
+            for name in ["jan", "anna", "ewa"]:
+                built.append(name)
+                yield target_queue(name,"kowal",[],[],[],[],[])
+        queue = MergedQueue(queues(), window=1)
+        first, owners = queue.pop()
+        msg = "queues of later targets should only be built when needed"
+        self.assertEqual(built,["jan"],msg)
+        candidates = [first] + [candidate for candidate, owners in queue]
+        self.assertEqual(built,["jan","anna","ewa"])
+        msg = "candidates of targets built later should not be probed again"
+        self.assertEqual(candidates.count("kowal"),1,msg)
+        self.assertEqual(queue.owners["kowal"],[0,1,2])
+
+    def test_target_queue_combinations(self):
+        target = ("jan","kowal",[],[],[],[],[])
+        everything = prepare(*target)
+        msg = "combinations should only be probed when asked for"
+        self.assertEqual(len(target_queue(*target)),len(set(everything)),msg)
+        combined = set(target_queue(*target, combinations=True))
+        self.assertIn("jankowaljan",combined)
+        self.assertEqual(combined,set(everything) | set(idioticly_create_combinations(list(everything))))
+
+
+class TestBatchInput(unittest.TestCase):
+
+    def write(self, name, text):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_formats(self):
+        paths = [
+            self.write("a.json", '\ufeff[{"name": "jan", "l_number": ["7"], "birthday_date": "24.04.2000"}]'),
+            self.write("b.jsonl", '{"name": "anna", "nickname": "ania,anka"}\n\n{"surname": "nowak"}\n'),
+            self.write("c.csv", 'name,surname,l_number,known_username\npiotr,kowal,"3,5",pk\n'),
+        ]
+        ex_output = [
+            ("jan", "", ["7"], [], ["24", "04", "2000"], [], []),
+            ("anna", "", [], ["ania", "anka"], [], [], []),
+            ("", "nowak", [], [], [], [], []),
+            ("piotr", "kowal", ["3", "5"], [], [], [], ["pk"]),
+        ]
+        self.assertEqual(list(ui_sherlock_pro.read_targets(paths)),ex_output)
+
+    def test_arkusz(self):
+        targets = list(ui_sherlock_pro.read_targets(["arkusz.json"]))
+        self.assertEqual(targets[0][4],["24","04","2000"])
+
+    def test_bad_record(self):
+        with self.assertRaises(ValueError):
+            list(ui_sherlock_pro.read_targets([self.write("d.jsonl", '["jan"]\n')]))
+
+
+class TestPreparedProbes(unittest.TestCase):
+
+    def setUp(self):
+        with open("data.json", "r", encoding="utf-8") as raw:
+            self.site_data = json.load(raw)
+
+    def test_prepared_url(self):
+        session = requests.session()
+        sites = probe.prepare_sites(self.site_data)
+        for input in ["blue","Zoe.1","noonewouldeverusethis7"]:
+            username = probe.PreparedUsername(input)
+            headers = probe.prepare_headers(session, {})
+            for social_network, net_info in self.site_data.items():
+                url = (net_info.get("urlProbe") or net_info["url"]).format(input)
+                ex_output = session.prepare_request(requests.Request("GET", url)).url
+                msg = f"prepared probe URL differs for {social_network}"
+                self.assertEqual(sites[social_network].request(username, headers).url.lower(),ex_output.lower(),msg)
+
+    def test_prepared_cost(self):
+        legacy, prepared = probe.benchmark(self.site_data, rounds=5)
+        msg = "prepared probes should be cheaper than building requests from scratch"
+        self.assertLess(prepared,legacy,msg)
+
+
+class TestProbePool(unittest.TestCase):
+
+    def test_bounded_threads(self):
+        pool = ProbePool(max_workers=4, max_inflight=8)
+        stats = RunStats()
+        before = threading.active_count()
+        for run in range(5):
+            futures = [pool.submit(sum, [i, run], stats=stats) for i in range(50)]
+            [future.result() for future in futures]
+        msg = "pool should not create more threads than max_workers"
+        self.assertLessEqual(threading.active_count() - before,4,msg)
+        pool.shutdown()
+        summary = stats.summary()
+        self.assertEqual(summary["submitted"],250)
+        self.assertLessEqual(summary["peak_inflight"],8)
+
+    def test_backpressure(self):
+        pool = ProbePool(max_workers=1, max_inflight=1)
+        release = threading.Event()
+        pool.submit(release.wait)
+        submitted = threading.Event()
+        threading.Thread(target=lambda: (pool.submit(int), submitted.set())).start()
+        msg = "submit should block while the pool is full"
+        self.assertFalse(submitted.wait(0.2),msg)
+        release.set()
+        self.assertTrue(submitted.wait(5))
+        pool.shutdown()
+
+    def test_small_job_during_sweep(self):
+        pool = ProbePool(max_workers=2, max_inflight=64)
+        sweep = pool.job("sweep")
+        lookup = pool.job("lookup")
+        sweep_futures = [pool.submit(time.sleep, 0.02, job=sweep) for i in range(60)]
+        lookup_futures = [pool.submit(time.sleep, 0.02, job=lookup) for i in range(4)]
+        [future.result() for future in lookup_futures]
+        msg = "small job should not wait for the queued probes of a big one"
+        self.assertGreater(sum(not future.done() for future in sweep_futures),40,msg)
+        [future.result() for future in sweep_futures]
+        pool.shutdown()
+
+    def test_priority_and_caps(self):
+        pool = ProbePool(max_workers=1, max_inflight=16)
+        order = []
+        release = threading.Event()
+        pool.submit(release.wait)
+        low = pool.job("low")
+        high = pool.job("high", priority=1)
+        futures = [pool.submit(order.append, "low", job=low) for i in range(3)]
+        futures += [pool.submit(order.append, "high", job=high) for i in range(3)]
+        release.set()
+        [future.result() for future in futures]
+        self.assertEqual(order,["high"]*3+["low"]*3)
+        pool.shutdown()
+
+    def test_host_budget(self):
+        pool = ProbePool(max_workers=8, max_inflight=64)
+        pool.scheduler.host_budget = 2
+        lock = threading.Lock()
+        peaks = {}
+        running = {}
+
+        def probe(key):
+            with lock:
+                running[key] = running.get(key,0) + 1
+                peaks[key] = max(peaks.get(key,0),running[key])
+            time.sleep(0.02)
+            with lock:
+                running[key] -= 1
+
+        futures = [pool.submit(probe, "host", job=pool.job(str(i)), host="example.com") for i in range(6)]
+        capped = pool.job("capped", max_running=3)
+        futures += [pool.submit(probe, "capped", job=capped) for i in range(6)]
+        [future.result() for future in futures]
+        msg = "no host should get more probes at once than its budget"
+        self.assertEqual(peaks["host"],2,msg)
+        self.assertEqual(peaks["capped"],3)
+        self.assertEqual(pool.scheduler.summary(),{"running": 0, "hosts": 0, "jobs": []})
+        pool.shutdown()
+
+    @unittest.skipIf(scheduler.fcntl is None, "host budgets are per process without fcntl")
+    def test_host_budget_between_processes(self):
+        directory = tempfile.TemporaryDirectory()
+        # Another process running probes against the host takes its budget.
+        holder = subprocess.Popen([sys.executable, "-c",
+                                   "import sys; from looker.scheduler import HostSlots; "
+                                   "slots = HostSlots(sys.argv[1]); "
+                                   "print([slots.acquire('example.com', 2) for _ in range(2)], flush=True); "
+                                   "sys.stdin.read()", directory.name],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        self.assertEqual(holder.stdout.readline().strip(),"[0, 1]")
+        slots = scheduler.HostSlots(directory.name)
+        self.assertIsNone(slots.acquire("example.com", 2))
+        pool = ThreadPoolExecutor(max_workers=2)
+        fair = scheduler.FairScheduler(pool, 2, host_budget=2, slots=slots)
+        future = fair.submit(scheduler.Job("lookup"), "example.com", int, ("7",))
+        other = fair.submit(scheduler.Job("other"), "example.org", int, ("8",))
+        self.assertEqual(other.result(timeout=5),8)
+        msg = "probes should wait while other processes use up the budget of their host"
+        self.assertFalse(future.done(),msg)
+        holder.stdin.close()
+        holder.wait()
+        self.assertEqual(future.result(timeout=5),7)
+        self.assertEqual(slots.held["example.com"],set())
+        pool.shutdown()
+        directory.cleanup()
+
+    @unittest.skipIf(scheduler.fcntl is None, "host budgets are per process without fcntl")
+    def test_private_lock_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "hosts")
+            slots = scheduler.HostSlots(path)
+            self.assertEqual(slots.acquire("example.com", 1),0)
+            msg = "lock files should be private to the user"
+            self.assertEqual(os.stat(path).st_mode & 0o777,0o700,msg)
+            self.assertEqual(os.stat(os.path.join(path, "example.com")).st_mode & 0o777,0o600,msg)
+            slots.release("example.com", 0)
+        self.assertEqual(scheduler.get_host_slots().directory,SLOTS_DIRECTORY)
+
+
+class TestResolver(unittest.TestCase):
+
+    def test_prefetch_and_disk_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache_path = os.path.join(directory, "dns.json")
+            resolver = Resolver(cache_path=cache_path)
+            self.assertEqual(resolver.prefetch(["localhost"]),1)
+            self.assertEqual(resolver.prefetch(["localhost"]),0)
+            self.assertIsNotNone(resolver.lookup("localhost"))
+
+            other = Resolver(cache_path=cache_path)
+            msg = "other processes should use addresses from the cache file"
+            self.assertEqual(other.missing(["localhost"]),[],msg)
+            self.assertEqual(other.summary()["hits"],0)
+
+    def test_adapter_uses_cache(self):
+        resolver = Resolver()
+        resolver.entries["sherlock.invalid"] = [float("inf"), ["127.0.0.1"], 0.05]
+        adapter = ResolvingAdapter(resolver)
+        pool = adapter.poolmanager.connection_from_url("http://sherlock.invalid:9/")
+        connection = pool._new_conn()
+        try:
+            connection.connect()
+        except Exception:
+            # nothing listens there, but the name must not be resolved
+            pass
+        msg = "connection should use the cached address"
+        self.assertEqual(resolver.summary()["saved_ms"],50,msg)
+
+    def test_adapter_falls_back_to_next_address(self):
+        site = start_site()
+        resolver = Resolver()
+        # nothing listens on 127.0.0.2, the site is on the second address
+        resolver.entries["sherlock.invalid"] = [float("inf"), ["127.0.0.2", "127.0.0.1"], 0.05]
+        session = requests.Session()
+        session.mount("http://", ResolvingAdapter(resolver))
+        try:
+            r = session.get(f"http://sherlock.invalid:{site.server_address[1]}/blue", timeout=5)
+        finally:
+            session.close()
+            site.shutdown()
+        msg = "connection should try the other cached addresses of the host"
+        self.assertEqual(r.status_code,200,msg)
+        self.assertIsNotNone(resolver.lookup("sherlock.invalid"))
+
+
+@unittest.skipIf(http2.httpx is None, "httpx[http2] is not installed")
+class TestHTTP2(unittest.TestCase):
+
+    def transport(self, handler):
+        transport = http2.H2Transport(max_streams=2)
+        transport.client = http2.httpx.Client(transport=http2.httpx.MockTransport(handler))
+        return transport
+
+    def request(self, url):
+        return requests.Request("GET", url, headers={"User-Agent": "x"}).prepare()
+
+    def test_multiplexed_response(self):
+        def handler(request):
+            return http2.httpx.Response(404, content=b"Not Found",
+                                        headers={"Content-Type": "text/html; charset=utf-8"},
+                                        extensions={"http_version": b"HTTP/2"})
+        transport = self.transport(handler)
+        r = transport.send("example.com", self.request("https://example.com/blue"), {})
+        self.assertEqual(r.status_code,404)
+        self.assertEqual(r.text,"Not Found")
+        self.assertTrue(transport.support["example.com"])
+
+    def test_fallback(self):
+        def handler(request):
+            raise http2.httpx.RemoteProtocolError("broken stream")
+        transport = self.transport(handler)
+        self.assertIsNone(transport.send("example.com", self.request("https://example.com/blue"), {}))
+        msg = "host should use HTTP/1.1 after a protocol error"
+        self.assertFalse(transport.support["example.com"],msg)
+        self.assertIsNone(transport.send("example.com", self.request("http://example.com/blue"), {}))
+        self.assertEqual(transport.summary()["fallback"],2)
+
+    def test_body_limit(self):
+        served = []
+
+        def chunks():
+            for _ in range(100):
+                served.append(8192)
+                yield b"x" * 8192
+
+        def handler(request):
+            return http2.httpx.Response(200, content=chunks(), headers={"Content-Type": "text/html"},
+                                        extensions={"http_version": b"HTTP/2"})
+        transport = self.transport(handler)
+        site = probe.prepare_sites({"Site": {"url": "https://example.com/{}", "errorType": "message",
+                                             "errorMsg": "User not found"}})["Site"]
+        r = probe.send_probe(get_session(), site, probe.PreparedUsername("blue"), {}, {}, http2=transport,
+                             body_limit=16384)
+        msg = "the rest of the page should not be downloaded over HTTP/2"
+        self.assertLess(len(served),10,msg)
+        self.assertEqual(len(r.content),16384)
+        self.assertLessEqual(r.compressed_bytes,len(served)*8192)
+        self.assertEqual(transport.host_streams("example.com")._value,2)
+
+    def test_deadline(self):
+        timeouts = []
+
+        def handler(request):
+            timeouts.append(request.extensions["timeout"]["read"])
+            raise http2.httpx.ReadTimeout("stalled", request=request)
+        transport = self.transport(handler)
+        msg = "the deadline of the site should apply over HTTP/2"
+        with self.assertRaises(requests.exceptions.ReadTimeout, msg=msg):
+            transport.send("example.com", self.request("https://example.com/blue"), {"timeout": 2.0})
+        self.assertEqual(timeouts,[2.0])
+        self.assertEqual(transport.host_streams("example.com")._value,2)
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    """Local site: users whose name starts with "blue" exist."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        code = 200 if "/blue" in self.path else 404
+        data = b"<html><title>profile</title>" + (b"hello" if code == 200 else b"Not Found") + b"</html>"
+        self.send_response(code)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+
+class RedirectHandler(SiteHandler):
+    """Local site which redirects profiles to their URL with a trailing slash."""
+
+    def do_GET(self, body=True):
+        if self.path.endswith("/"):
+            return super().do_GET(body)
+        self.send_response(301)
+        self.send_header("Location", self.path + "/")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class CountingHandler(SiteHandler):
+    """Local site which records the paths it was asked for."""
+
+    def do_GET(self, body=True):
+        self.server.paths.append(self.path)
+        super().do_GET(body)
+
+
+class StallHandler(SiteHandler):
+    """Local site whose first answer stalls."""
+
+    def do_GET(self, body=True):
+        with self.server.lock:
+            self.server.calls += 1
+            first = self.server.calls == 1
+        if first:
+            time.sleep(1.5)
+        super().do_GET(body)
+
+
+class KeepAliveHandler(SiteHandler):
+    """Local site keeping connections open; records the client ports it served."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self, body=True):
+        self.server.ports.add(self.client_address[1])
+        super().do_GET(body)
+
+
+class ETagHandler(SiteHandler):
+    """Local site answering conditional requests; server.existing lists its users."""
+
+    def do_GET(self, body=True):
+        username = self.path.rsplit("/", 1)[-1]
+        code = 200 if username in self.server.existing else 404
+        etag = f'"{username}-{code}"'
+        self.server.requests.append(self.headers.get("If-None-Match"))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        data = b"<html>" + (b"hello" if code == 200 else b"Not Found") + b"</html>"
+        self.send_response(code)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+
+class SoftHandler(SiteHandler):
+    """Local site which answers 200 with a generic page for unknown users."""
+
+    def do_GET(self, body=True):
+        username = self.path.rsplit("/", 1)[-1]
+        if username.startswith("blue"):
+            data = f"<html><title>{username} - profile</title>posts of {username}: " + "photo " * 200
+        else:
+            data = f"<html><title>Oops</title>Sorry, we could not find {username}. " + "menu item " * 300
+        data = (data + "</html>").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+
+def start_site(handler=SiteHandler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_blackhole():
+    """Return listening socket which accepts connections and never answers."""
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+    return listener
+
+
+class SocksStandIn(socketserver.ThreadingTCPServer):
+    """Minimal SOCKS5 server which records the credentials it was given."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        self.usernames = []
+        super().__init__(("127.0.0.1", 0), SocksHandler)
+
+
+class SocksHandler(socketserver.BaseRequestHandler):
+
+    def recv(self, size):
+        data = b""
+        while len(data) < size:
+            data += self.request.recv(size - len(data))
+        return data
+
+    def handle(self):
+        _, methods = self.recv(2)
+        self.recv(methods)
+        self.request.sendall(b"\x05\x02")
+        _, length = self.recv(2)
+        username = self.recv(length).decode()
+        length = self.recv(1)[0]
+        self.recv(length)
+        self.server.usernames.append(username)
+        self.request.sendall(b"\x01\x00")
+        _, _, _, address_type = self.recv(4)
+        if address_type == 3:
+            host = self.recv(self.recv(1)[0]).decode()
+        else:
+            host = socket.inet_ntoa(self.recv(4))
+        port = int.from_bytes(self.recv(2), "big")
+        upstream = socket.create_connection((host, port))
+        self.request.sendall(b"\x05\x00\x00\x01" + bytes(4) + bytes(2))
+        threading.Thread(target=self.pipe, args=(upstream, self.request), daemon=True).start()
+        self.pipe(self.request, upstream)
+
+    def pipe(self, source, destination):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                destination.sendall(data)
+        except OSError:
+            pass
+        finally:
+            destination.close()
+
+
+class TestCircuitPool(unittest.TestCase):
+
+    def test_round_robin_and_rotation(self):
+        circuits = CircuitPool(size=3)
+        proxies = [circuits.proxy_for("example.com") for i in range(6)]
+        self.assertEqual(len(set(proxies)),3)
+        self.assertEqual(proxies[:3],proxies[3:])
+        circuits.rotate_oldest()
+        msg = "rotated circuit should get new credentials"
+        self.assertNotIn(circuits.proxy_for(),proxies,msg)
+
+    def test_per_host(self):
+        circuits = CircuitPool(size=4, per_host=True)
+        self.assertEqual(circuits.proxy_for("github.com"),circuits.proxy_for("github.com"))
+
+    def test_sherlock_over_socks(self):
+        site = start_site()
+        socks = SocksStandIn()
+        threading.Thread(target=socks.serve_forever, daemon=True).start()
+        circuits = CircuitPool(size=4, socks_ports=(socks.server_address[1],), session=get_session())
+        port = site.server_address[1]
+        site_data = {f"Site{i}": {"errorType": "status_code", "url": f"http://localhost:{port}/{{}}", "urlMain": ""}
+                     for i in range(8)}
+        results = sherlock("blue", site_data, unique_tor=True, circuit_pool=circuits, print_found_only=True)
+        site.shutdown()
+        socks.shutdown()
+        self.assertEqual({result["exists"] for result in results.values()},{"yes"})
+        msg = "requests should be spread over all circuits"
+        self.assertEqual(len(set(socks.usernames)),4,msg)
+
+    def test_rotation_closes_connections_of_every_session(self):
+        circuits = CircuitPool(size=1, session=requests.session())
+        hedge_session = requests.session()
+        circuits.attach(hedge_session)
+        circuits.attach(hedge_session)
+        old_proxy = circuits.proxy_for()
+        for session in circuits.sessions:
+            session.get_adapter("http://example.com/").proxy_manager_for(old_proxy)
+        circuits.rotate_oldest()
+        msg = "connections over a replaced circuit should be closed in every session"
+        for session in circuits.sessions:
+            self.assertNotIn(old_proxy,session.get_adapter("http://example.com/").proxy_manager,msg)
+        self.assertEqual(len(circuits.sessions),2)
+
+
+class TestValidate(unittest.TestCase):
+
+    def test_report_and_prune(self):
+        site = start_site()
+        url = f"http://localhost:{site.server_address[1]}/{{}}"
+        site_data = {
+            "Ok": {"errorType": "status_code", "url": url, "urlMain": "",
+                   "username_claimed": "blue", "username_unclaimed": "red"},
+            "Drift": {"errorType": "message", "errorMsg": "No such user", "url": url, "urlMain": "",
+                      "username_claimed": "blue", "username_unclaimed": "red"},
+            "Down": {"errorType": "status_code", "url": "http://localhost:1/{}", "urlMain": "",
+                     "username_claimed": "blue", "username_unclaimed": "red"},
+            "Untested": {"errorType": "status_code", "url": url, "urlMain": ""},
+        }
+        report = validate.validate(site_data)
+        site.shutdown()
+        statuses = {name: result["status"] for name, result in report["sites"].items()}
+        ex_output = {"Ok": "ok", "Drift": "drift", "Down": "error", "Untested": "untested"}
+        self.assertEqual(statuses,ex_output)
+        msg = "message site whose status codes differ should get status_code suggested"
+        self.assertEqual(report["sites"]["Drift"]["suggested_errorType"],"status_code",msg)
+        self.assertEqual(sorted(validate.prune(site_data, report)),["Down","Ok","Untested"])
+
+    def test_prune_listed_sites(self):
+        site = start_site()
+        url = f"http://localhost:{site.server_address[1]}/{{}}"
+        site_data = {
+            "Ok": {"errorType": "status_code", "url": url, "urlMain": "",
+                   "username_claimed": "blue", "username_unclaimed": "red"},
+            "Drift": {"errorType": "message", "errorMsg": "No such user", "url": url, "urlMain": "",
+                      "username_claimed": "blue", "username_unclaimed": "red"},
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            data_path = os.path.join(directory, "data.json")
+            pruned_path = os.path.join(directory, "pruned.json")
+            with open(data_path, "w") as out:
+                json.dump(site_data, out)
+            validate.main(["--json", data_path, "--site", "Drift", "--prune", pruned_path,
+                           "--report", os.path.join(directory, "report.json")])
+            site.shutdown()
+            with open(pruned_path) as raw:
+                msg = "pruning should only drop drifted sites, not the sites which were not validated"
+                self.assertEqual(sorted(json.load(raw)),["Ok"],msg)
+
+
+class TestSoft404(unittest.TestCase):
+
+    def test_generic_page_not_found(self):
+        site = start_site(SoftHandler)
+        url = f"http://localhost:{site.server_address[1]}/{{}}"
+        site_data = {"Soft": {"errorType": "status_code", "url": url, "urlMain": "",
+                              "username_claimed": "blue", "username_unclaimed": "noonewouldeverusethis7"}}
+        fingerprints = fingerprint.calibrate(site_data)
+        self.assertIn("Soft",fingerprints)
+        results = {username: sherlock(username, site_data, fingerprints=fingerprints)["Soft"]["exists"]
+                   for username in ["blue", "red"]}
+        site.shutdown()
+        msg = "generic page of unknown user should be reported as not found"
+        self.assertEqual(results,{"blue": "yes", "red": "no"},msg)
+
+    def test_simhash_distance(self):
+        page = "lorem ipsum dolor sit amet " * 50
+        self.assertEqual(fingerprint.simhash(page),fingerprint.simhash(page))
+        self.assertGreater(bin(fingerprint.simhash(page) ^ fingerprint.simhash("other words in here " * 50)).count("1"),fingerprint.MAX_DISTANCE)
+
+
+class LongHandler(SiteHandler):
+    """Local site with long pages, which tell early whether the user exists."""
+
+    def do_GET(self, body=True):
+        username = self.path.rsplit("/", 1)[-1]
+        head = b"<h1>Profile</h1>" if username.startswith("blue") else b"<h1>User not found</h1>"
+        data = head + b"x" * 1000000
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            try:
+                self.wfile.write(data)
+            except OSError:
+                pass
+
+
+class TestMarkers(unittest.TestCase):
+
+    def test_lists_of_markers(self):
+        found = markers.compile_markers(("Not found", "Gone"), ("Joined",))
+        self.assertEqual(found.verdict(b"<p>Joined 2012</p>"),"yes")
+        self.assertEqual(found.verdict(b"<p>Gone</p>"),"no")
+        msg = "site with positive markers should report pages without markers as not found"
+        self.assertEqual(found.verdict(b"<p>maintenance</p>"),"no",msg)
+        self.assertEqual(markers.compile_markers(("Not found",), ()).verdict(b"<p></p>"),"yes")
+
+    def test_marker_across_chunks(self):
+        scanner = markers.compile_markers(("User not found",), ()).scanner()
+        self.assertIsNone(scanner.feed(b"<h1>User no"))
+        self.assertEqual(scanner.feed(b"t found</h1>"),"no")
+
+    def test_encoding(self):
+        found = markers.compile_markers(("Użytkownik nie istnieje",), (), "iso-8859-2")
+        self.assertEqual(found.verdict("<p>Użytkownik nie istnieje</p>".encode("iso-8859-2")),"no")
+        self.assertEqual(found.verdict("<p>Użytkownik nie istnieje</p>".encode("utf-8")),"no")
+
+    def test_early_stop(self):
+        site = start_site(LongHandler)
+        url = f"http://localhost:{site.server_address[1]}/{{}}"
+        site_data = {"Long": {"errorType": "message", "errorMsg": ["Account suspended", "User not found"],
+                              "url": url, "urlMain": ""}}
+        prepared = probe.prepare_sites(site_data)["Long"]
+        session = get_session()
+        r = probe.send_probe(session, prepared, probe.PreparedUsername("red"), {},
+                             prepared.send_settings(session))
+        results = {username: sherlock(username, site_data)["Long"]["exists"] for username in ["blue", "red"]}
+        site.shutdown()
+        self.assertEqual(r.marker_verdict,"no")
+        msg = "page should not be downloaded after the marker was found"
+        self.assertLess(len(r.content),100000,msg)
+        self.assertEqual(results,{"blue": "yes", "red": "no"})
+
+
+class GzipHandler(SiteHandler):
+    """Local site which compresses its pages when asked to."""
+
+    def do_GET(self, body=True):
+        username = self.path.rsplit("/", 1)[-1]
+        text = "Profile" if username.startswith("blue") else "User not found"
+        data = (f"<html><title>{text}</title>" + "<p>posts</p>" * 5000 + "</html>").encode()
+        self.server.accept_encodings.append(self.headers.get("Accept-Encoding", ""))
+        self.send_response(200)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = gzip.compress(data)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+
+class ChunkedGzipHandler(GzipHandler):
+    """Local site which sends its compressed pages in chunks, without Content-Length."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self, body=True):
+        username = self.path.rsplit("/", 1)[-1]
+        text = "Profile" if username.startswith("blue") else "User not found"
+        data = gzip.compress((f"<html><title>{text}</title>" + "<p>posts</p>" * 5000 + "</html>").encode())
+        self.server.sent_bytes = len(data)
+        self.send_response(200)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        if body:
+            for start in range(0, len(data), 100):
+                chunk = data[start:start + 100]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+
+
+class GzipTailHandler(GzipHandler):
+    """Local site with compressed pages which tell at their end whether the user exists."""
+
+    def do_GET(self, body=True):
+        username = self.path.rsplit("/", 1)[-1]
+        text = "Profile" if username.startswith("blue") else "User not found"
+        data = gzip.compress(("<html>" + "<p>posts</p>" * 5000 + f"<p>{text}</p></html>").encode())
+        self.send_response(200)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_compressed_bytes(self):
+        site = start_site(GzipHandler)
+        site.accept_encodings = []
+        url = f"http://localhost:{site.server_address[1]}/{{}}"
+        site_data = {"Gzip": {"errorType": "message", "errorMsg": "User not found", "url": url, "urlMain": ""}}
+        stats = RunStats()
+        results = {username: sherlock(username, site_data, stats=stats)["Gzip"]["exists"]
+                   for username in ["blue", "red"]}
+        site.shutdown()
+        self.assertEqual(results,{"blue": "yes", "red": "no"})
+        self.assertIn("gzip",site.accept_encodings[0])
+        transfer = stats.transfer_summary()["Gzip"]
+        msg = "compressed page should need fewer bytes than it decompresses to"
+        self.assertLess(transfer["compressed_bytes"]*10,transfer["decompressed_bytes"],msg)
+        self.assertEqual(stats.summary()["compressed_bytes"],transfer["compressed_bytes"])
+
+    def test_chunked_compressed_bytes(self):
+        site = start_site(ChunkedGzipHandler)
+        url = f"http://127.0.0.1:{site.server_port}/{{}}"
+        site_data = {"Chunked": {"errorType": "message", "errorMsg": "User not found", "url": url, "urlMain": ""}}
+        stats = RunStats()
+        self.assertEqual(sherlock("blue", site_data, print_found_only=True, stats=stats)["Chunked"]["exists"],"yes")
+        site.shutdown()
+        transfer = stats.transfer_summary()["Chunked"]
+        msg = "chunked pages should count the compressed bytes they were sent in"
+        self.assertEqual(transfer["compressed_bytes"],site.sent_bytes,msg)
+        self.assertLess(transfer["compressed_bytes"]*10,transfer["decompressed_bytes"])
+
+
+class TestDaemon(unittest.TestCase):
+
+    def test_streamed_job(self):
+        site = start_site()
+        url = f"http://localhost:{site.server_address[1]}/{{}}"
+        site_data = {"Local": {"errorType": "status_code", "url": url, "urlMain": ""}}
+        server = daemon.serve(daemon.Service(site_data), port=0)
+        api = f"http://127.0.0.1:{server.server_address[1]}"
+        job = requests.post(api + "/jobs", json={"nickname": ["blue"], "max_candidates": 6}).json()
+        with requests.get(f"{api}/jobs/{job['id']}/events", stream=True) as r:
+            events = [json.loads(line) for line in r.iter_lines() if line]
+        state = requests.get(f"{api}/jobs/{job['id']}").json()
+        server.shutdown()
+        site.shutdown()
+        self.assertEqual(events[-1],{"event": "end", "status": "done"})
+        self.assertEqual(sum(event["event"] == "checked" for event in events),6)
+        self.assertIn("blue",[event["username"] for event in events if event["event"] == "found"])
+        self.assertEqual(state["checked"],6)
+        self.assertEqual(len(state["accounts"]),state["found"])
+
+    def test_invalid_job(self):
+        server = daemon.serve(daemon.Service({}), port=0)
+        api = f"http://127.0.0.1:{server.server_address[1]}"
+        statuses = [requests.post(api + "/jobs", json=body, timeout=5).status_code
+                    for body in ({"nickname": ["blue"], "max_candidates": None},
+                                 {"nickname": ["blue"], "birthday_date": 19900101},
+                                 {"nickname": ["blue"], "weight": [1]})]
+        server.shutdown()
+        msg = "fields of the wrong type should be answered with 400"
+        self.assertEqual(statuses,[400]*3,msg)
+
+
+class TestResultIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.index = ResultIndex(os.path.join(self.directory.name, "results.sqlite"))
+
+    def tearDown(self):
+        self.index.close()
+        self.directory.cleanup()
+
+    def test_queries(self):
+        run_id = self.index.start_run()
+        found = {"exists": "yes", "url_user": "https://example.com/x", "http_status": 200, "response_time_ms": 10}
+        missing = {"exists": "no", "url_user": "", "http_status": 404, "response_time_ms": 12}
+        self.index.add_results(run_id, "jan", {"GitHub": found, "Reddit": found})
+        self.index.add_results(run_id, "anna", {"GitHub": found, "Reddit": missing})
+        self.index.link_targets("jan", ["Jan Kowal"])
+        self.assertEqual(self.index.found_on(["GitHub", "Reddit"]),["jan"])
+        self.assertEqual(self.index.found_on(["GitHub"]),["anna","jan"])
+        self.assertEqual([site for site, url, run in self.index.accounts("anna")],["GitHub"])
+        self.assertEqual(len(self.index.target_accounts("Jan Kowal")),2)
+        self.assertEqual(self.index.summary()["results"],4)
+
+    def test_streamed_results(self):
+        site = start_site()
+        url = f"http://localhost:{site.server_address[1]}/{{}}"
+        site_data = {"Local": {"errorType": "status_code", "url": url, "urlMain": ""}}
+        run_id = self.index.start_run()
+        sherlock("blue", site_data, on_result=lambda social_network, results_site:
+                 self.index.add(run_id, "blue", social_network, results_site))
+        site.shutdown()
+        self.index.flush()
+        self.assertEqual(self.index.found_on(["Local"], run_id),["blue"])
+
+    def test_incremental_run(self):
+        site = start_site(CountingHandler)
+        site.paths = []
+        url = f"http://localhost:{site.server_address[1]}/{{}}"
+        site_data = {f"Site{i}": {"errorType": "status_code", "url": url + f"?site={i}", "urlMain": "", "rank": i}
+                     for i in range(10)}
+        run_id = self.index.start_run()
+        self.index.add_results(run_id, "blue", sherlock("blue", site_data), site_hashes(site_data))
+        self.assertEqual(len(site.paths),10)
+
+        site_data["Site3"]["errorType"] = "message"
+        site_data["Site3"]["errorMsg"] = "Not Found"
+        site_data["Site5"]["rank"] = 100
+        cached = self.index.fresh_results("blue", site_hashes(site_data))
+        results = sherlock("blue", site_data, cached=cached)
+        site.shutdown()
+        msg = "only the site whose definition changed should be probed again"
+        self.assertEqual(site.paths[10:],["/blue?site=3"],msg)
+        self.assertEqual({result["exists"] for result in results.values()},{"yes"})
+        self.assertEqual(self.index.fresh_results("blue", site_hashes(site_data), max_age=-1),{})
+
+    def test_import_output(self):
+        output = os.path.join(self.directory.name, "output")
+        os.mkdir(output)
+        with open(os.path.join(output, "jan.txt"), "w", encoding="utf-8") as f:
+            f.write("https://github.com/jan\nhttps://unknown.example/jan\nTotal Websites : 2")
+        site_data = {"GitHub": {"errorType": "status_code", "url": "https://github.com/{}", "urlMain": ""}}
+        self.assertEqual(self.index.import_output(output, site_data),1)
+        self.assertEqual(self.index.found_on(["GitHub"]),["jan"])
+
+
+class TestLatency(unittest.TestCase):
+
+    def test_deadline(self):
+        history = latency.LatencyHistory()
+        self.assertIsNone(history.hedge_after("Site"))
+        self.assertEqual(history.deadline("Site"),latency.MAX_DEADLINE_SEC)
+        history.seed({"Site": [100] * 19 + [5000]})
+        self.assertEqual(history.hedge_after("Site"),5.0)
+        history.seed({"Fast": [10] * 20})
+        self.assertEqual(history.deadline("Fast"),latency.MIN_DEADLINE_SEC)
+
+    def test_probe_settings(self):
+        listener = start_blackhole()
+        url = f"http://127.0.0.1:{listener.getsockname()[1]}/{{}}"
+        site = probe.prepare_sites({"Hanging": {"errorType": "status_code", "url": url, "urlMain": ""}})["Hanging"]
+        latency.get_latency_history().seed({"Hanging": [10] * 20})
+        session = get_session()
+        settings = latency.probe_settings(site, session)
+        self.assertEqual(settings["timeout"],latency.MIN_DEADLINE_SEC)
+        self.assertEqual(settings["allow_redirects"],site.allow_redirects)
+        start = time.time()
+        with self.assertRaises(requests.exceptions.Timeout):
+            probe.send_probe(session, site, probe.PreparedUsername("blue"), probe.HEADERS, settings)
+        listener.close()
+        msg = "a host which never answers should fail at the deadline of its site"
+        self.assertLess(time.time()-start,latency.MIN_DEADLINE_SEC+2,msg)
+
+    def test_hedged_probe(self):
+        site = start_site(StallHandler)
+        site.lock = threading.Lock()
+        site.calls = 0
+        url = f"http://localhost:{site.server_address[1]}/{{}}"
+        site_data = {"Stalling": {"errorType": "status_code", "url": url, "urlMain": ""}}
+        latency.get_latency_history().seed({"Stalling": [20] * 20})
+        start = time.time()
+        results = sherlock("blue", site_data)
+        elapsed = time.time() - start
+        site.shutdown()
+        self.assertEqual(results["Stalling"]["exists"],"yes")
+        self.assertEqual(site.calls,2)
+        msg = "duplicate of the stalled probe should answer first"
+        self.assertLess(elapsed,1.0,msg)
+
+    def test_queued_probe_not_hedged(self):
+        pool = ProbePool(max_workers=1)
+        release = threading.Event()
+        pool.submit(release.wait)
+        future = pool.submit(sum, [1, 2])
+        duplicates = []
+        threading.Timer(0.3, release.set).start()
+        future, hedged = latency.first_answer(future, 0.05, lambda: duplicates.append(1))
+        msg = "time spent waiting for a worker should not count as slow"
+        self.assertEqual((future.result(), hedged, duplicates),(3, False, []),msg)
+        pool.shutdown()
+
+    def test_index_latencies(self):
+        directory = tempfile.TemporaryDirectory()
+        index = ResultIndex(os.path.join(directory.name, "results.sqlite"))
+        run_id = index.start_run()
+        for elapsed in range(5):
+            index.add(run_id, "jan", "Site", {"exists": "no", "response_time_ms": elapsed})
+        index.add(run_id, "jan", "Site", {"exists": "error", "response_time_ms": 99})
+        index.flush()
+        self.assertEqual(index.latencies(3),{"Site": [2,3,4]})
+        index.close()
+        directory.cleanup()
+
+
+class TestArchive(unittest.TestCase):
+
+    def test_record_and_replay(self):
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, "sweep.archive")
+        site = start_site(LongHandler)
+        url = f"http://localhost:{site.server_address[1]}/{{}}"
+        site_data = {"Long": {"errorType": "message", "errorMsg": "User not found", "url": url, "urlMain": ""},
+                     "Status": {"errorType": "status_code", "url": url, "urlMain": ""},
+                     "Down": {"errorType": "status_code", "url": "http://localhost:1/{}", "urlMain": ""}}
+        writer = archive.ArchiveWriter(path)
+        for username in ["blue", "red"]:
+            sherlock(username, site_data, archive=writer)
+        site.shutdown()
+        writer.close()
+
+        probes = list(archive.read_archive(path))
+        self.assertEqual(len(probes),6)
+        long_page = next(probe for probe in probes if probe.site == "Long" and probe.username == "red")
+        msg = "archive should keep the body prefix even after the marker decided"
+        self.assertEqual(len(long_page.body()),archive.BODY_PREFIX,msg)
+        self.assertTrue(next(probe for probe in probes if probe.site == "Down").failed)
+
+        self.assertTrue(long_page.meta["truncated"])
+        replayed = {(probe.site, probe.username): exists for probe, exists in archive.replay(path, site_data)}
+        expected = {(probe.site, probe.username): probe.meta["exists"] for probe in probes}
+        # The errorMsg of Long could have been after the kept prefix.
+        expected[("Long", "blue")] = "error"
+        self.assertEqual(replayed,expected)
+
+        site_data["Long"]["errorMsg"] = "<h1>Profile</h1>"
+        replayed = {probe.username: exists for probe, exists in archive.replay(path, site_data) if probe.site == "Long"}
+        msg = "replay should classify with the current site data, not guess past the kept prefix"
+        self.assertEqual(replayed,{"blue": "no", "red": "error"},msg)
+
+        with open(path, "ab") as f:
+            f.write(archive.RECORD.pack(10, 10, 200, 1, 0.0))
+        self.assertEqual(len(list(archive.read_archive(path))),6)
+
+        writer = archive.ArchiveWriter(path)
+        writer.record("Status", "green", None, request_url="http://example.com/green")
+        writer.close()
+        probes = list(archive.read_archive(path))
+        msg = "records appended after a crash should not land behind the torn record"
+        self.assertEqual(len(probes),7,msg)
+        self.assertEqual(probes[-1].request_url,"http://example.com/green")
+        self.assertEqual(probes[0].request_url,url.format(probes[0].username))
+        directory.cleanup()
+
+
+class TestWatch(unittest.TestCase):
+
+    def test_intervals(self):
+        self.assertEqual(watch.next_interval(watch.MIN_INTERVAL, False, 0.0),2*watch.MIN_INTERVAL)
+        self.assertEqual(watch.next_interval(watch.MAX_INTERVAL, False, 0.0),watch.MAX_INTERVAL)
+        msg = "pairs of often changing sites should not back off as far"
+        self.assertLess(watch.next_interval(watch.MAX_INTERVAL, False, 0.5),watch.MAX_INTERVAL,msg)
+        self.assertEqual(watch.next_interval(watch.MAX_INTERVAL, True, 0.0),watch.MIN_INTERVAL)
+
+    def test_state_changes(self):
+        directory = tempfile.TemporaryDirectory()
+        store = watch.WatchStore(os.path.join(directory.name, "watch.sqlite"))
+        site = start_site(ETagHandler)
+        site.existing = {"blue"}
+        site.requests = []
+        url = f"http://localhost:{site.server_address[1]}/{{}}"
+        site_data = {"Local": {"errorType": "status_code", "url": url, "urlMain": ""}}
+        store.add("blue", ["Local"])
+        store.add("red", ["Local"])
+
+        events, counts = watch.watch_once(store, site_data, now=1000)
+        self.assertEqual((events, counts["checked"]),([], 2))
+        events, counts = watch.watch_once(store, site_data, now=1000)
+        msg = "pairs should only be checked when they are due"
+        self.assertEqual(counts["checked"],0,msg)
+
+        later = 1000 + 2 * watch.MIN_INTERVAL
+        events, counts = watch.watch_once(store, site_data, now=later)
+        msg = "unchanged pages should be answered with 304"
+        self.assertEqual((events, counts["not_modified"]),([], 2),msg)
+
+        site.existing = {"red"}
+        events, counts = watch.watch_once(store, site_data, now=later + watch.MAX_INTERVAL)
+        site.shutdown()
+        store.close()
+        directory.cleanup()
+        self.assertEqual(sorted((event["username"], event["event"]) for event in events),
+                         [("blue","deleted"),("red","created")])
+
+
+# Cumulative import times (-X importtime, microseconds) which must not be
+# exceeded; generous, so slow machines pass, but far below what eager
+# imports would cost. looker.sherlock takes about 150 ms, all but about
+# 15 ms of which are requests and colorama.
+RUN_IMPORT_BUDGET_US = 50000
+SHERLOCK_IMPORT_BUDGET_US = 250000
+SHERLOCK_OWN_IMPORT_BUDGET_US = 30000
+
+# Subsystems only imported by the runs which use them.
+OPTIONAL_MODULES = ("looker.archive", "looker.budget", "looker.fingerprint", "looker.http2", "looker.index",
+                    "looker.site_list", "looker.tor", "looker.warmup", "asyncio", "sqlite3")
+
+
+class TestImportTime(unittest.TestCase):
+
+    def import_times(self, module):
+        stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stderr
+        times = {}
+        for line in stderr.splitlines():
+            if line.startswith("import time:") and "|" in line:
+                _, cumulative, name = line.split("|")
+                if cumulative.strip().isdigit():
+                    times[name.strip()] = int(cumulative)
+        return times
+
+    def test_slim_entry_point(self):
+        times = self.import_times("run")
+        msg = "run.py should not import requests before it is needed"
+        self.assertNotIn("requests",times,msg)
+        self.assertLess(times["run"],RUN_IMPORT_BUDGET_US)
+
+    def test_sherlock_import_budget(self):
+        times = self.import_times("looker.sherlock")
+        msg = "optional and unused dependencies should not be imported"
+        self.assertNotIn("httpx",times,msg)
+        self.assertNotIn("requests_futures",times,msg)
+        for module in OPTIONAL_MODULES:
+            self.assertNotIn(module,times,msg)
+        self.assertLess(times["looker.sherlock"],SHERLOCK_IMPORT_BUDGET_US)
+        own = times["looker.sherlock"] - times["requests"] - times.get("colorama", 0)
+        self.assertLess(own,SHERLOCK_OWN_IMPORT_BUDGET_US)
+
+
+class TestWarmup(unittest.TestCase):
+
+    def test_warm_up_and_rewarm(self):
+        site = start_site(KeepAliveHandler)
+        site.ports = set()
+        url = f"http://127.0.0.1:{site.server_port}/{{}}"
+        site_data = {name: {"errorType": "status_code", "url": url, "urlMain": url}
+                     for name in ("Blue", "Green", "Red")}
+        session = get_session()
+        warmer = warmup.Warmer(session, get_pool(), connections=3, rate=1000)
+        prepared_sites = probe.prepare_sites(site_data)
+        self.assertEqual(warmer.warm_up(prepared_sites),3)
+        origin = next(iter(warmer.origins))
+        self.assertEqual(warmer.idle(origin),3)
+        msg = "warming the same hosts again should not open connections"
+        self.assertEqual(warmer.warm_up(prepared_sites),0,msg)
+        warm_ports = {connection.sock.getsockname()[1]
+                      for connection in warmer.connection_pool(origin).pool.queue
+                      if connection is not None and warmup.is_connected(connection)}
+
+        results = sherlock("blue", site_data, print_found_only=True)
+        self.assertEqual(results["Blue"]["exists"],"yes")
+        msg = "probes should go over the warmed connections"
+        self.assertLessEqual(site.ports,warm_ports,msg)
+
+        for connection in warmer.connection_pool(origin).pool.queue:
+            if connection is not None:
+                connection.close()
+        self.assertEqual(warmer.rewarm(),3)
+        summary = warmer.summary()
+        self.assertEqual((summary["hosts"],summary["opened"],summary["rewarmed"]),(1,6,3))
+        site.shutdown()
+
+    def test_bounded_wait(self):
+        listeners = [start_blackhole() for _ in range(3)]
+        site_data = {f"Site{number}": {"errorType": "status_code", "urlMain": "",
+                                       "url": f"http://127.0.0.1:{listener.getsockname()[1]}/{{}}"}
+                     for number, listener in enumerate(listeners)}
+        warmer = warmup.Warmer(requests.session(), get_pool(), rate=2)
+        start = time.time()
+        warmer.warm_up(probe.prepare_sites(site_data), timeout=0.2)
+        msg = "probing should not wait for hosts which are slow to warm"
+        self.assertLess(time.time()-start,0.5,msg)
+        self.assertGreaterEqual(warmer.summary()["late"],1)
+        for listener in listeners:
+            listener.close()
+
+
+class TestBudget(unittest.TestCase):
+
+    def setUp(self):
+        budget._sizes.clear()
+
+    def test_request_caps(self):
+        site = start_site()
+        url = f"http://127.0.0.1:{site.server_port}/{{}}"
+        site_data = {f"Site{number}": {"errorType": "status_code", "url": url, "urlMain": url}
+                     for number in range(5)}
+        run_budget = budget.Budget(max_requests=3, max_site_requests=1)
+        results = sherlock("blue", site_data, print_found_only=True, budget=run_budget)
+        statuses = [results[name]["exists"] for name in site_data]
+        msg = "sites over the budget should be skipped, the others checked"
+        self.assertEqual(statuses,["yes"]*3+["skipped"]*2,msg)
+        report = run_budget.report()
+        self.assertEqual((report["requests"],report["skipped_requests"]),(3,2))
+        site.shutdown()
+
+    def test_byte_cap(self):
+        site = start_site(LongHandler)
+        url = f"http://127.0.0.1:{site.server_port}/{{}}"
+        site_data = {f"Site{number}": {"errorType": "message", "errorMsg": "User not found",
+                                       "url": url, "urlMain": url}
+                     for number in range(5)}
+        run_budget = budget.Budget(max_bytes=300000)
+        results = sherlock("blue", site_data, print_found_only=True, budget=run_budget)
+        report = run_budget.report()
+        msg = "pages should not take more than the budget"
+        self.assertLessEqual(report["used_bytes"],300000,msg)
+        self.assertEqual(report["strategy_prefix"],0)
+        msg = "message pages which do not fit should be skipped, not classified cut short"
+        self.assertEqual([results[name]["exists"] for name in site_data],["skipped"]*5,msg)
+        site.shutdown()
+
+    def test_compressed_message_pages(self):
+        site = start_site(GzipTailHandler)
+        url = f"http://127.0.0.1:{site.server_port}/{{}}"
+        site_data = {"Site": {"errorType": "message", "errorMsg": "User not found",
+                              "url": url, "urlMain": url}}
+        self.assertEqual(sherlock("blue", site_data, print_found_only=True,
+                                  budget=budget.Budget(max_bytes=1000000))["Site"]["exists"],"yes")
+        compressed, decompressed = budget._sizes["Site"]
+        self.assertGreater(decompressed,compressed)
+        # The reservation is sized from the compressed page, the message is
+        # at the end of the decompressed one.
+        results = sherlock("nobody", site_data, print_found_only=True,
+                           budget=budget.Budget(max_bytes=1000000))
+        msg = "compressed message pages should be read to the end"
+        self.assertEqual(results["Site"]["exists"],"no",msg)
+        site.shutdown()
+
+    def test_chunked_pages(self):
+        site = start_site(ChunkedGzipHandler)
+        url = f"http://127.0.0.1:{site.server_port}/{{}}"
+        site_data = {"Site": {"errorType": "message", "errorMsg": "User not found",
+                              "url": url, "urlMain": url}}
+        run_budget = budget.Budget(max_bytes=1000000)
+        results = sherlock("blue", site_data, print_found_only=True, budget=run_budget)
+        site.shutdown()
+        self.assertEqual(results["Site"]["exists"],"yes")
+        msg = "chunked pages should be charged the bytes they took on the wire"
+        self.assertGreaterEqual(run_budget.report()["used_bytes"],site.sent_bytes+budget.HEAD_ESTIMATE,msg)
+
+    def test_parse_size(self):
+        self.assertEqual(budget.parse_size("20M"),20*1024*1024)
+        self.assertEqual(budget.parse_size("1500"),1500)
+
+
+class TestSiteList(unittest.TestCase):
+
+    def test_cached_ranks(self):
+        class CountingProvider(site_list.RankProvider):
+            name = "Counting"
+
+            def __init__(self):
+                self.asked = []
+
+            def rank(self, domain):
+                self.asked.append(domain)
+                return len(domain)
+
+        with tempfile.TemporaryDirectory() as directory:
+            provider = CountingProvider()
+            cache = site_list.RankCache(os.path.join(directory, "ranks.json"), max_age=100)
+            ranks = site_list.fetch_ranks(["a.com", "bb.com", "a.com"], provider, cache, workers=2)
+            self.assertEqual(ranks,{"a.com": 5, "bb.com": 6})
+            cache.save()
+            cache = site_list.RankCache(os.path.join(directory, "ranks.json"), max_age=100)
+            site_list.fetch_ranks(["a.com", "bb.com"], provider, cache)
+            msg = "cached ranks should not be fetched again until they expire"
+            self.assertEqual(sorted(provider.asked),["a.com","bb.com"],msg)
+            cache.max_age = -1
+            site_list.fetch_ranks(["a.com"], provider, cache)
+            self.assertEqual(len(provider.asked),3)
+
+    def test_failed_ranks(self):
+        class FailingProvider(site_list.RankProvider):
+            name = "Counting"
+
+            def rank(self, domain):
+                raise OSError("unreachable")
+
+        with self.assertRaises(TypeError):
+            site_list.RankProvider()
+        cache = site_list.RankCache(None, max_age=-1)
+        cache.put("Counting:a.com", 5)
+        ranks = site_list.fetch_ranks(["a.com", "bb.com"], FailingProvider(), cache)
+        msg = "failed lookups should keep the last known rank, not report the domain unranked"
+        self.assertEqual(ranks,{"a.com": 5},msg)
+
+    def test_offline_listing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            data_path = os.path.join(directory, "data.json")
+            rank_path = os.path.join(directory, "top.csv")
+            listing_path = os.path.join(directory, "sites.md")
+            with open(data_path, "w") as out:
+                json.dump({"Small": {"urlMain": "https://small.example/"},
+                           "Big": {"urlMain": "https://www.big.example/"},
+                           "Lost": {"urlMain": "https://lost.example/"}}, out)
+            with open(rank_path, "w") as out:
+                out.write("1,big.example\n7,small.example\n")
+            argv = ["--rank", "--rank-file", rank_path, "--json", data_path, "--output", listing_path,
+                    "--cache", os.path.join(directory, "ranks.json")]
+            site_list.main(argv)
+            with open(data_path) as raw:
+                data = json.load(raw)
+            self.assertEqual({name: site["rank"] for name, site in data.items()},{"Big": 1, "Small": 7, "Lost": 0})
+            self.assertEqual(list(site_list.rank_order(data)),["Big","Small","Lost"])
+            modified = [os.stat(path).st_mtime_ns for path in (data_path, listing_path)]
+            time.sleep(0.01)
+            site_list.main(argv)
+            msg = "files should only be written when their content changes"
+            self.assertEqual([os.stat(path).st_mtime_ns for path in (data_path, listing_path)],modified,msg)
+
+    def test_run_as_script(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "data.json"), "w") as out:
+                json.dump({"Big": {"urlMain": "https://big.example/"}}, out)
+            with open(os.path.join(directory, "top.csv"), "w") as out:
+                out.write("1,big.example\n")
+            script = os.path.join(os.path.dirname(os.path.realpath(__file__)), "looker", "site_list.py")
+            finished = subprocess.run([sys.executable, script, "--rank", "--rank-file", "top.csv"],
+                                      cwd=directory, capture_output=True, text=True)
+            msg = "site_list.py should run as a script, outside of the package"
+            self.assertEqual(finished.returncode,0,msg+"\n"+finished.stderr)
+            with open(os.path.join(directory, "data.json")) as raw:
+                self.assertEqual(json.load(raw)["Big"]["rank"],1)
+
+
+# Probes per second sherlock() must handle without network (offline
+# transport); a fraction of what the engine does, so slow machines pass.
+MIN_PROBES_PER_SEC = 1000
+
+
+class TestOffline(unittest.TestCase):
+
+    def test_every_error_type(self):
+        site_data = load_site_data("data.json")
+        transport = offline.SyntheticTransport(site_data)
+        for error_type in ("status_code", "message", "response_url"):
+            social_network, net_info = next((name, info) for name, info in site_data.items()
+                                            if info["errorType"] == error_type)
+            for key, expected in (("username_claimed", "yes"), ("username_unclaimed", "no")):
+                with self.subTest(error_type=error_type, expected=expected):
+                    results = sherlock(net_info[key], {social_network: dict(net_info)},
+                                       print_found_only=True, transport=transport)
+                    self.assertEqual(results[social_network]["exists"],expected)
+
+    def test_recorded_responses(self):
+        site_data = {name: info for name, info in list(load_site_data("data.json").items())[:20]}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "run.archive")
+            writer = archive.ArchiveWriter(path)
+            live = sherlock("blue", {name: dict(info) for name, info in site_data.items()}, print_found_only=True,
+                            archive=writer, transport=offline.SyntheticTransport(site_data, claimed=["blue"]))
+            writer.close()
+            transport = offline.RecordedTransport(path)
+            replayed = sherlock("blue", {name: dict(info) for name, info in site_data.items()},
+                                print_found_only=True, transport=transport)
+            msg = "recorded responses should give the results of the recorded run"
+            self.assertEqual({name: result["exists"] for name, result in replayed.items()},
+                             {name: result["exists"] for name, result in live.items()},msg)
+            unrecorded = sherlock("red", {name: dict(info) for name, info in site_data.items()},
+                                  print_found_only=True, transport=transport)
+            msg = "probes which were not recorded should fail instead of going to the network"
+            self.assertEqual({result["exists"] for result in unrecorded.values()} - {"illegal"},{"error"},msg)
+
+    def test_recorded_redirects(self):
+        site = start_site(RedirectHandler)
+        url = f"http://127.0.0.1:{site.server_port}/{{}}"
+        site_data = {"Site": {"errorType": "status_code", "url": url, "urlMain": url}}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "run.archive")
+            writer = archive.ArchiveWriter(path)
+            live = sherlock("blue", {"Site": dict(site_data["Site"])}, print_found_only=True, archive=writer)
+            writer.close()
+            site.shutdown()
+            self.assertEqual(live["Site"]["exists"],"yes")
+            replayed = sherlock("blue", {"Site": dict(site_data["Site"])}, print_found_only=True,
+                                transport=offline.RecordedTransport(path))
+            msg = "redirected probes should be replayed from the URL they were sent to"
+            self.assertEqual(replayed["Site"]["exists"],"yes",msg)
+
+    def test_all_sites_in_parallel(self):
+        msg = "claimed and unclaimed usernames of every site should be detected"
+        self.assertEqual(offline.check_all_sites(processes=2),[],msg)
+
+    def test_throughput(self):
+        site_data = load_site_data("data.json")
+        rate = offline.throughput(site_data, ["blue", "noonewouldeverusethis7", "mateusz", "kojro"])
+        msg = f"engine handled {rate:.0f} probes/s, less than {MIN_PROBES_PER_SEC}"
+        self.assertGreaterEqual(rate,MIN_PROBES_PER_SEC,msg)
+
+
+@unittest.skipIf(analytics is None, "numpy is not installed")
+class TestAnalytics(unittest.TestCase):
+
+    runs = {"john": {"A": {"exists": "yes", "response_time_ms": 10}, "B": {"exists": "yes", "response_time_ms": 30},
+                     "C": {"exists": "no", "response_time_ms": ""}},
+            "john92": {"A": {"exists": "yes", "response_time_ms": 20}, "B": {"exists": "no", "response_time_ms": 40},
+                       "C": {"exists": "error", "response_time_ms": ""}},
+            "smith92": {"A": {"exists": "no", "response_time_ms": 50}, "B": {"exists": "yes", "response_time_ms": 60},
+                        "C": {"exists": "yes", "response_time_ms": 70}}}
+
+    def test_aggregates(self):
+        results = analytics.Results.from_results(self.runs)
+        checked, hits, errors = results.hit_rates()
+        self.assertEqual((checked.tolist(),hits.tolist(),errors.tolist()),([3,3,2],[2,2,1],[0,0,1]))
+        self.assertEqual(results.latencies()[:,0].tolist(),[20,40,70])
+        tokens, checked, hits = results.tokens()
+        self.assertEqual(dict(zip(tokens,hits.tolist())),{"john":3,"92":3,"smith":2})
+        counts = results.co_occurrence()
+        msg = "co-occurrence should count usernames found on both sites"
+        self.assertEqual(counts.tolist(),[[2,1,0],[1,2,1],[0,1,1]],msg)
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "results.sqlite")
+            index = ResultIndex(path)
+            run_id = index.start_run()
+            for username, results in self.runs.items():
+                index.add_results(run_id, username, results)
+                index.link_targets(username, ["John Smith"])
+            index.close()
+            summary = analytics.Results.load(path, run_id).summary()
+            self.assertEqual(summary["totals"],{"rows":9,"usernames":3,"sites":3,"hits":5,"errors":1})
+            self.assertEqual(summary["sites"][-1],{"site":"C","checked":2,"hits":1,"errors":1,"hit_rate":0.5,
+                                                   "p50_ms":70,"p90_ms":70,"p99_ms":70})
+            self.assertEqual({token["token"] for token in summary["tokens"]},{"john","smith","92"})
+            out = os.path.join(directory, "analytics.json")
+            analytics.main(["--index", path, "--json", out])
+            with open(out) as raw:
+                self.assertEqual(json.load(raw)["co_occurrence"][0]["sites"],["A","B"])
+
+    def test_illegal_not_checked(self):
+        runs = {"john": {"A": {"exists": "yes"}, "B": {"exists": "illegal"}},
+                "john.smith": {"A": {"exists": "illegal"}, "B": {"exists": "illegal"}}}
+        results = analytics.Results.from_results(runs)
+        msg = "usernames illegal on a site should not count as checked"
+        self.assertEqual(results.hit_rates()[0].tolist(),[1,0],msg)
+        tokens, checked, hits = results.tokens()
+        self.assertEqual(dict(zip(tokens,checked.tolist())),{"john":1,"smith":0},msg)
+
+    def test_missing_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "results.sqlite")
+            with self.assertRaises(FileNotFoundError):
+                analytics.Results.load(path)
+            msg = "loading a missing index should not create it"
+            self.assertFalse(os.path.exists(path),msg)
+
+    def test_million_rows(self):
+        rng = numpy.random.default_rng(0)
+        rows = 1000000
+        results = analytics.Results(rng.integers(0, 100000, rows), rng.integers(0, 300, rows),
+                                    rng.choice([0, 1, 3], rows, p=[0.8, 0.15, 0.05]), rng.gamma(2, 200, rows),
+                                    [f"user{number}" for number in range(100000)], [f"Site{number}" for number in range(300)])
+        start = time.perf_counter()
+        summary = results.summary()
+        msg = "a million rows should be summarized in seconds"
+        self.assertLess(time.perf_counter()-start,10,msg)
+        self.assertEqual(summary["totals"]["rows"],rows)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def tearDown(self):
+        profiling.disable()
+
+    def test_disabled_is_free(self):
+        profiling.disable()
+        msg = "spans should be a shared no-op while profiling is off"
+        self.assertIs(profiling.span("wait"),profiling.NULL_SPAN,msg)
+        start = time.perf_counter()
+        for i in range(100000):
+            with profiling.span("wait"):
+                pass
+        self.assertLess(time.perf_counter() - start,0.5)
+
+    def test_spans_and_samples(self):
+        profiler = profiling.enable(sample_interval=0.001, allocations=True)
+
+        def busy():
+            end = time.perf_counter() + 0.05
+            while time.perf_counter() < end:
+                pass
+
+        with profiling.span("run"):
+            with profiling.span("classify"):
+                data = [bytes(1000) for i in range(100)]
+                busy()
+            with profiling.span("output"):
+                pass
+        stages = profiler.summary()["stages"]
+        self.assertEqual(set(stages),{"run","classify","output"})
+        self.assertGreaterEqual(stages["classify"]["wall_sec"],0.05)
+        self.assertGreater(stages["classify"]["cpu_sec"],0.02)
+        self.assertGreater(stages["classify"]["alloc_bytes"],100000)
+        self.assertGreaterEqual(stages["run"]["wall_sec"],stages["classify"]["wall_sec"])
+        with tempfile.TemporaryDirectory() as directory:
+            paths = profiler.write(os.path.join(directory, "mateusz"))
+            with open(paths[1]) as folded:
+                stacks = dict(line.rsplit(" ", 1) for line in folded.read().splitlines())
+            self.assertEqual(set(stacks),{"run","run;classify","run;output"})
+            self.assertGreaterEqual(int(stacks["run;classify"]),50000)
+            with open(paths[2]) as folded:
+                samples = folded.read()
+            msg = "samples should be folded below the span they ran in"
+            self.assertIn(";run;classify;",samples,msg)
+            self.assertIn("busy",samples)
+            with open(paths[0]) as summary:
+                self.assertIn("classify",json.load(summary)["stages"])
 
 
 if __name__ == '__main__':
@@ -1,3 +1,4 @@
+import csv
 import json as j
 
 def get_data():
@@ -17,3 +18,78 @@ def get_data():
     known_username = input("paste any known usernames, that were used on socjal media before:").split(",")
     print(name, surname, l_number, nickname, birthday_date, pet_name, known_username)
     return name, surname, l_number, nickname, birthday_date, pet_name, known_username
+
+
+#pola arkusza ktore sa listami, w csv i z palca podaje sie je po przecinku
+LIST_FIELDS = ("l_number", "nickname", "pet_name", "known_username")
+
+
+def target_from_record(data):
+    """Convert one target record (arkusz.json schema) to the target tuple.
+
+    Lists may also be given as comma separated strings, like get_data()
+    reads them.
+
+    Return Value:
+    Tuple of (name, surname, l_number, nickname, birthday_date, pet_name,
+    known_username) as returned by get_data().
+    """
+    if not isinstance(data, dict):
+        raise ValueError("target must be a JSON object")
+    lists = {}
+    for field in LIST_FIELDS:
+        value = data.get(field) or []
+        if isinstance(value, str):
+            value = value.split(",")
+        if not isinstance(value, list):
+            raise ValueError(f"{field} must be a list")
+        lists[field] = [str(item).strip() for item in value if str(item).strip()]
+    birthday_date = data.get("birthday_date") or []
+    if isinstance(birthday_date, str):
+        birthday_date = birthday_date.split(".")
+    if not isinstance(birthday_date, list):
+        raise ValueError("birthday_date must be a string or a list")
+    birthday_date = [str(part).strip() for part in birthday_date if str(part).strip()]
+    return (str(data.get("name") or "").strip(), str(data.get("surname") or "").strip(),
+            lists["l_number"], lists["nickname"], birthday_date,
+            lists["pet_name"], lists["known_username"])
+
+
+def read_records(path):
+    """Yield target records of a .json, .jsonl or .csv file.
+
+    JSON files hold one object or a list of them, JSON Lines files one
+    object per line, CSV files one target per row with the field names in
+    the header. JSON Lines and CSV files are read as they are consumed.
+    """
+    # utf-8-sig: arkusze zapisane w notatniku zaczynaja sie od BOM
+    with open(path, "r", encoding="utf-8-sig", newline="") as raw:
+        if path.endswith(".jsonl"):
+            for number, line in enumerate(raw, 1):
+                if line.strip():
+                    try:
+                        yield j.loads(line)
+                    except ValueError as err:
+                        raise ValueError(f"{path}:{number}: {err}") from None
+        elif path.endswith(".csv"):
+            yield from csv.DictReader(raw)
+        else:
+            data = j.load(raw)
+            if isinstance(data, list):
+                yield from data
+            else:
+                yield data
+
+
+def read_targets(paths):
+    """Yield target tuples of all records of all files, in order."""
+    for path in paths:
+        for record in read_records(path):
+            yield target_from_record(record)
+
+
+def target_label(target):
+    """Return name of a target tuple, used to find its results later."""
+    name, surname, l_number, nickname, birthday_date, pet_name, known_username = target
+    label = " ".join(part for part in (name, surname) if part)
+    return label or next(iter(nickname + known_username), "") or "target"